@@ -1,8 +1,10 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, UploadFile, File, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
@@ -13,13 +15,22 @@ from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 import httpx
+import httpcore
 import hashlib
 import hmac
 import secrets
 import re
 import asyncio
+import contextvars
+import random
 import json
+import time
+import heapq
+import socket
+import ipaddress
+from urllib.parse import urlsplit
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.responses import StreamingResponse
 
 ROOT_DIR = Path(__file__).parent
@@ -130,6 +141,8 @@ class AdminConfig(BaseModel):
     valor_minimo_saque: Optional[float] = None
     valor_minimo_transferencia: Optional[float] = None
     comissao_indicacao: Optional[float] = None
+    limite_pagador_cobrancas_hora: Optional[int] = None
+    limite_pagador_diario: Optional[float] = None
     nome_sistema: Optional[str] = None
     logo_url: Optional[str] = None
 
@@ -151,6 +164,12 @@ class ExternalTransactionCreate(BaseModel):
     user: ExternalUserData
     custom_page_id: Optional[int] = None  # Opcional - se não informado, usa configuração do usuário
 
+class ExternalTransactionBatch(BaseModel):
+    transactions: List[ExternalTransactionCreate]
+
+class ApiKeyWebhookConfig(BaseModel):
+    url: str
+
 class PushSubscription(BaseModel):
     endpoint: str
     keys: dict
@@ -166,19 +185,84 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt leva ~200ms por chamada: roda num pool de threads dedicado (bcrypt libera o GIL)
+# para não travar o event loop. O semáforo limita a concorrência; quem excede espera na fila.
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_password_semaphore = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+password_pool_stats = {"na_fila": 0, "em_execucao": 0, "max_na_fila": 0, "concluidas": 0}
+
+async def _run_password_task(fn, *args):
+    password_pool_stats["na_fila"] += 1
+    password_pool_stats["max_na_fila"] = max(password_pool_stats["max_na_fila"], password_pool_stats["na_fila"])
+    started = False
+    try:
+        async with _password_semaphore:
+            password_pool_stats["na_fila"] -= 1
+            password_pool_stats["em_execucao"] += 1
+            started = True
+            try:
+                return await asyncio.get_running_loop().run_in_executor(_password_executor, fn, *args)
+            finally:
+                password_pool_stats["em_execucao"] -= 1
+                password_pool_stats["concluidas"] += 1
+    finally:
+        # Cancelado ainda na fila
+        if not started:
+            password_pool_stats["na_fila"] -= 1
+
+async def hash_password_async(password: str) -> str:
+    return await _run_password_task(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_task(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Cache curto do usuário autenticado: {user_id: (expira_em, documento)}
+# Toda escrita em db.users deve chamar invalidate_user_cache para o usuário alterado.
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '5'))
+USER_CACHE_MAX_ENTRIES = 10000
+_user_cache = {}
+
+def invalidate_user_cache(*user_ids: str):
+    """Descarta usuários do cache de autenticação (ou todos, se nenhum for informado)"""
+    if not user_ids:
+        _user_cache.clear()
+        return
+    for user_id in user_ids:
+        _user_cache.pop(user_id, None)
+
+async def get_cached_user(user_id: str):
+    """Documento do usuário (sem _id), servido do cache enquanto válido"""
+    cached = _user_cache.get(user_id)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return dict(cached[1])
+    
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if user is None:
+        return None
+    if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+        _user_cache.clear()
+    _user_cache[user_id] = (now + USER_CACHE_TTL_SECONDS, user)
+    return dict(user)
+
+def public_user(user: dict):
+    """Cópia do documento do usuário sem campos sensíveis"""
+    return {k: v for k, v in user.items() if k not in ("senha", "two_factor_secret")}
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Token inválido")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = await get_cached_user(user_id)
         if user is None:
             raise HTTPException(status_code=401, detail="Usuário não encontrado")
         return user
@@ -190,8 +274,8 @@ async def get_admin_user(user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Acesso negado")
     return user
 
-async def get_config(admin_id: str = None):
-    """Obtém configuração do sistema. Se admin_id fornecido, busca config específica da rede"""
+async def _load_config(admin_id: str = None):
+    """Lê a configuração do banco. Se admin_id fornecido, busca config específica da rede"""
     if admin_id:
         config = await db.admin_configs.find_one({"admin_id": admin_id}, {"_id": 0})
         if config:
@@ -212,27 +296,48 @@ async def get_config(admin_id: str = None):
             "valor_minimo_saque": 10.0,
             "valor_minimo_transferencia": 1.0,
             "comissao_indicacao": 1.0,
+            "limite_pagador_cobrancas_hora": 0,
+            "limite_pagador_diario": 0.0,
             "nome_sistema": "BravePix",
             "logo_url": ""
         }
-        await db.config.insert_one(config)
+        await db.config.insert_one(dict(config))
     return config
 
-async def get_user_network_admin(user_id: str):
-    """Encontra o admin raiz da rede do usuário"""
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user:
-        return None
-    
-    # Se é admin e é o admin raiz (sem promoted_by ou promoted_by é ele mesmo)
-    if user.get("role") == "admin" and not user.get("promoted_by"):
-        return user
-    
-    # Se é admin promovido, retorna ele mesmo (ele tem sua própria config)
-    if user.get("role") == "admin":
-        return user
-    
-    # Se é usuário comum, sobe a cadeia até encontrar um admin
+# Cache em memória das configurações: {admin_id ou "system": {"expires": ..., "version": ..., "config": ...}}
+# Dentro do TTL não há leitura no banco; ao expirar, só o contador de versão é consultado e
+# a config (que pode ter um logo base64 de vários MB) só é relida se outro worker a alterou.
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get('CONFIG_CACHE_TTL_SECONDS', '10'))
+_config_cache = {}
+
+async def _get_config_version():
+    doc = await db.config.find_one({"type": "version"}, {"_id": 0, "version": 1})
+    return doc.get("version", 0) if doc else 0
+
+async def get_config(admin_id: str = None):
+    """Obtém configuração do sistema (com cache). Se admin_id fornecido, busca config específica da rede"""
+    key = admin_id or "system"
+    now = time.monotonic()
+    entry = _config_cache.get(key)
+    if entry and entry["expires"] > now:
+        return dict(entry["config"])
+    
+    version = await _get_config_version()
+    if entry and entry["version"] == version:
+        entry["expires"] = now + CONFIG_CACHE_TTL_SECONDS
+        return dict(entry["config"])
+    
+    config = await _load_config(admin_id)
+    _config_cache[key] = {"expires": now + CONFIG_CACHE_TTL_SECONDS, "version": version, "config": config}
+    return dict(config)
+
+async def invalidate_config_cache():
+    """Descarta o cache local e incrementa a versão para que os demais workers releiam a config"""
+    _config_cache.clear()
+    await db.config.update_one({"type": "version"}, {"$inc": {"version": 1}}, upsert=True)
+
+async def _resolve_network_admin_by_chain(user: dict):
+    """Sobe a cadeia de indicadores até encontrar um admin (usuários ainda sem network_admin_id)"""
     current = user
     visited = set()
     while current:
@@ -250,29 +355,121 @@ async def get_user_network_admin(user_id: str):
     
     return None
 
+async def get_user_network_admin_id(user_id: str):
+    """Retorna o ID do admin da rede do usuário com uma única leitura indexada"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1, "role": 1, "network_admin_id": 1, "indicador_id": 1})
+    if not user:
+        return None
+    
+    # Admin (raiz ou promovido) é o admin da própria rede
+    if user.get("role") == "admin":
+        return user["id"]
+    
+    if "network_admin_id" in user:
+        return user["network_admin_id"]
+    
+    admin = await _resolve_network_admin_by_chain(user)
+    return admin["id"] if admin else None
+
 async def get_config_for_user(user_id: str):
     """Obtém a configuração aplicável para um usuário baseado em sua rede"""
-    admin = await get_user_network_admin(user_id)
-    if admin:
-        config = await get_config(admin["id"])
+    admin_id = await get_user_network_admin_id(user_id)
+    if admin_id:
+        config = await get_config(admin_id)
         if config and config.get("admin_id"):
             return config
     return await get_config()
 
-async def get_network_user_ids(admin_id: str):
-    """Retorna todos os IDs de usuários na rede do admin (incluindo o próprio admin)"""
-    network_ids = [admin_id]
+async def build_user_ancestry(indicador: dict):
+    """Campos denormalizados de rede para um novo indicado de `indicador`.
     
-    # Busca recursivamente todos os usuários indicados pelo admin e seus indicados
-    async def get_referrals(user_id):
-        referrals = await db.users.find({"indicador_id": user_id}, {"_id": 0, "id": 1}).to_list(1000)
-        for ref in referrals:
-            if ref["id"] not in network_ids:
-                network_ids.append(ref["id"])
-                await get_referrals(ref["id"])
-    
-    await get_referrals(admin_id)
-    return network_ids
+    ancestor_ids vai do indicador direto até a raiz; network_admin_id é o admin mais próximo.
+    """
+    if "ancestor_ids" in indicador:
+        ancestor_ids = [indicador["id"]] + indicador["ancestor_ids"]
+    else:
+        ancestor_ids = [indicador["id"]]
+        current = indicador
+        while current.get("indicador_id") and current["indicador_id"] not in ancestor_ids:
+            ancestor_ids.append(current["indicador_id"])
+            current = await db.users.find_one({"id": current["indicador_id"]}, {"_id": 0, "id": 1, "indicador_id": 1})
+            if not current:
+                break
+    
+    if indicador.get("role") == "admin":
+        network_admin_id = indicador["id"]
+    else:
+        network_admin_id = await get_user_network_admin_id(indicador["id"])
+    
+    return {"ancestor_ids": ancestor_ids, "network_admin_id": network_admin_id}
+
+# Cache de rede por admin (ver _network_admins_cache). Como na config, um contador de versão em
+# db.config (type "network_version") é incrementado a cada mudança de rede; as entradas de outra
+# versão são descartadas, então um usuário criado ou movido em um worker aparece nos demais em
+# até NETWORK_VERSION_CHECK_SECONDS.
+NETWORK_CACHE_TTL_SECONDS = float(os.environ.get('NETWORK_CACHE_TTL_SECONDS', '60'))
+NETWORK_VERSION_CHECK_SECONDS = 1.0
+_network_version = {"value": None, "checked_at": 0.0}
+
+async def _get_network_version():
+    now = time.monotonic()
+    if _network_version["value"] is None or now - _network_version["checked_at"] >= NETWORK_VERSION_CHECK_SECONDS:
+        doc = await db.config.find_one({"type": "network_version"}, {"_id": 0, "version": 1})
+        _network_version.update(value=doc.get("version", 0) if doc else 0, checked_at=now)
+    return _network_version["value"]
+
+async def is_in_admin_network(admin_id: str, user_id: str) -> bool:
+    """Verifica se o usuário está na rede do admin (incluindo o próprio admin) com uma leitura
+    indexada pelo caminho de ancestrais, sem carregar a subárvore"""
+    if user_id == admin_id:
+        return True
+    return await db.users.find_one({"id": user_id, "ancestor_ids": admin_id}, {"_id": 1}) is not None
+
+# Cache por admin dos admins da sua subárvore: {admin_id: (expira_em, versão, [ids])}
+_network_admins_cache = {}
+
+async def get_network_admin_ids(admin_id: str):
+    """Retorna o admin e os admins promovidos abaixo dele na árvore de indicações.
+    
+    Toda a rede do admin é exatamente o conjunto de documentos cujo network_admin_id
+    está nessa lista (normalmente poucos IDs).
+    """
+    version = await _get_network_version()
+    cached = _network_admins_cache.get(admin_id)
+    if cached and cached[0] > time.monotonic() and cached[1] == version:
+        return cached[2]
+    
+    admin_ids = [admin_id]
+    async for sub_admin in db.users.find({"ancestor_ids": admin_id, "role": "admin"}, {"_id": 0, "id": 1}):
+        admin_ids.append(sub_admin["id"])
+    
+    _network_admins_cache[admin_id] = (time.monotonic() + NETWORK_CACHE_TTL_SECONDS, version, admin_ids)
+    return admin_ids
+
+async def network_filter(admin_id: str):
+    """Filtro pela chave de tenant (network_admin_id) para todos os documentos da rede do admin"""
+    admin_ids = await get_network_admin_ids(admin_id)
+    if len(admin_ids) == 1:
+        return {"network_admin_id": admin_id}
+    return {"network_admin_id": {"$in": admin_ids}}
+
+async def network_admin_of(user: dict):
+    """Chave de tenant a ser gravada nos documentos do usuário"""
+    if user.get("role") == "admin":
+        return user["id"]
+    if "network_admin_id" in user:
+        return user["network_admin_id"]
+    return await get_user_network_admin_id(user["id"])
+
+async def invalidate_network_cache(*admin_ids: str):
+    """Descarta a rede em cache dos admins informados (ou de todos, se nenhum for informado)
+    e incrementa a versão para que os demais workers releiam"""
+    if not admin_ids:
+        _network_admins_cache.clear()
+    for admin_id in admin_ids:
+        _network_admins_cache.pop(admin_id, None)
+    await db.config.update_one({"type": "network_version"}, {"$inc": {"version": 1}}, upsert=True)
+    _network_version["value"] = None
 
 def generate_wallet_id():
     """Gera ID de carteira único"""
@@ -282,6 +479,58 @@ def validate_cpf_cnpj(value: str) -> bool:
     clean = re.sub(r'[^\d]', '', value)
     return len(clean) == 11 or len(clean) == 14
 
+# ===================== AGGREGATION HELPERS =====================
+
+# Expressões reutilizadas nos pipelines de soma (equivalentes às somas que eram feitas em Python)
+STATUS_PAID = {"$eq": ["$status", "paid"]}
+VALOR_EXPR = {"$ifNull": ["$valor", 0]}
+VALOR_LIQUIDO_EXPR = {"$ifNull": ["$valor_liquido", 0]}
+# Usa valor_liquido se existir e for positivo, senão usa valor bruto
+VALOR_CREDITADO_EXPR = {"$cond": [{"$gt": [VALOR_LIQUIDO_EXPR, 0]}, "$valor_liquido", VALOR_EXPR]}
+VALOR_RETIDO_EXPR = {"$ifNull": ["$valor_total_retido", {"$ifNull": ["$valor_solicitado", 0]}]}
+
+def when(condition: dict, expr=1):
+    """Expressão que vale expr quando a condição é verdadeira e 0 caso contrário"""
+    return {"$cond": [condition, expr, 0]}
+
+async def aggregate_totals(collection, match: dict, **sums):
+    """Conta e soma documentos no MongoDB, trazendo apenas os totais.
+    
+    Cada kwarg é o nome do total e a expressão somada, ex.:
+    aggregate_totals(db.transactions, query, volume=when(STATUS_PAID, VALOR_EXPR))
+    Retorna sempre "count" e todos os totais pedidos (0 quando não há documentos).
+    """
+    group = {"_id": None, "count": {"$sum": 1}}
+    for name, expr in sums.items():
+        group[name] = {"$sum": expr}
+    result = await collection.aggregate([{"$match": match}, {"$group": group}]).to_list(1)
+    totals = result[0] if result else {}
+    return {"count": totals.get("count", 0), **{name: totals.get(name, 0) for name in sums}}
+
+async def aggregate_daily_totals(collection, match: dict, days: int = 7, **sums):
+    """Totais por dia (UTC) dos últimos `days` dias, agrupados pelo prefixo de data do created_at.
+    
+    Retorna uma lista em ordem cronológica com {"date": date, "count": ..., <sums>...},
+    incluindo dias sem movimento.
+    """
+    today = datetime.now(timezone.utc).date()
+    first_day = today - timedelta(days=days - 1)
+    group = {"_id": {"$substrBytes": ["$created_at", 0, 10]}, "count": {"$sum": 1}}
+    for name, expr in sums.items():
+        group[name] = {"$sum": expr}
+    pipeline = [
+        {"$match": {**match, "created_at": {"$gte": first_day.isoformat()}}},
+        {"$group": group}
+    ]
+    rows = {row["_id"]: row async for row in collection.aggregate(pipeline)}
+    
+    daily = []
+    for i in range(days):
+        date = first_day + timedelta(days=i)
+        row = rows.get(date.isoformat(), {})
+        daily.append({"date": date, "count": row.get("count", 0), **{name: row.get(name, 0) for name in sums}})
+    return daily
+
 # ===================== PUSH NOTIFICATION HELPERS =====================
 
 # VAPID keys for Web Push
@@ -362,6 +611,7 @@ async def process_auto_withdrawal(user_id: str):
     withdrawal = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user_id,
+        "network_admin_id": await network_admin_of(user),
         "valor_solicitado": round(valor_liquido, 2),
         "taxa_percentual": taxa_saque_depix,
         "valor_taxa": round(valor_taxa, 2),
@@ -379,12 +629,18 @@ async def process_auto_withdrawal(user_id: str):
     }
     
     await db.withdrawals.insert_one(withdrawal)
+    await apply_balance_delta(
+        user_id,
+        total_sacado=withdrawal["valor_total_retido"],
+        total_auto_sacado=withdrawal["valor_total_retido"]
+    )
     
     # Zera o saldo de comissões
     await db.users.update_one(
         {"id": user_id},
         {"$set": {"saldo_comissoes": 0}}
     )
+    invalidate_user_cache(user_id)
     
     # Notifica os admins sobre o novo saque
     await send_push_to_admins(
@@ -395,6 +651,652 @@ async def process_auto_withdrawal(user_id: str):
     
     logger.info(f"Saque automático criado para user {user_id}: R${valor_liquido:.2f}")
 
+# ===================== FASTDEPIX CLIENT =====================
+
+# Cliente HTTP único (pool de conexões com keep-alive) para todas as chamadas ao provedor.
+# FASTDEPIX_BASE_URL pode apontar para um stub local em testes.
+FASTDEPIX_BASE_URL = os.environ.get('FASTDEPIX_BASE_URL', 'https://fastdepix.space/api/v1').rstrip('/')
+FASTDEPIX_HTTP2 = os.environ.get('FASTDEPIX_HTTP2', 'false').lower() == 'true'
+FASTDEPIX_MAX_CONNECTIONS = int(os.environ.get('FASTDEPIX_MAX_CONNECTIONS', '100'))
+FASTDEPIX_MAX_KEEPALIVE = int(os.environ.get('FASTDEPIX_MAX_KEEPALIVE', '20'))
+FASTDEPIX_CONNECT_TIMEOUT = float(os.environ.get('FASTDEPIX_CONNECT_TIMEOUT', '5'))
+FASTDEPIX_TIMEOUT = float(os.environ.get('FASTDEPIX_TIMEOUT', '30'))
+
+_fastdepix_client = None
+
+def get_fastdepix_client() -> httpx.AsyncClient:
+    """Retorna o cliente compartilhado do FastDePix (criado no startup ou na primeira chamada)"""
+    global _fastdepix_client
+    if _fastdepix_client is None or _fastdepix_client.is_closed:
+        http2 = FASTDEPIX_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("FASTDEPIX_HTTP2 ativo mas o pacote h2 não está instalado; usando HTTP/1.1")
+                http2 = False
+        _fastdepix_client = httpx.AsyncClient(
+            base_url=FASTDEPIX_BASE_URL,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=FASTDEPIX_MAX_CONNECTIONS,
+                max_keepalive_connections=FASTDEPIX_MAX_KEEPALIVE,
+                keepalive_expiry=30.0
+            ),
+            timeout=httpx.Timeout(FASTDEPIX_TIMEOUT, connect=FASTDEPIX_CONNECT_TIMEOUT)
+        )
+    return _fastdepix_client
+
+async def close_fastdepix_client():
+    global _fastdepix_client
+    if _fastdepix_client is not None:
+        await _fastdepix_client.aclose()
+        _fastdepix_client = None
+
+# Circuit breaker: após FASTDEPIX_BREAKER_FAILURES falhas seguidas (rede, timeout, 5xx/429) o
+# circuito abre e as chamadas falham na hora com ProviderUnavailable. Passados
+# FASTDEPIX_BREAKER_RESET_SECONDS, uma única chamada de teste (half-open) decide se fecha ou reabre.
+FASTDEPIX_BREAKER_FAILURES = int(os.environ.get('FASTDEPIX_BREAKER_FAILURES', '5'))
+FASTDEPIX_BREAKER_RESET_SECONDS = float(os.environ.get('FASTDEPIX_BREAKER_RESET_SECONDS', '30'))
+FASTDEPIX_MAX_RETRIES = int(os.environ.get('FASTDEPIX_MAX_RETRIES', '2'))
+FASTDEPIX_RETRY_BACKOFF = 0.2
+# Orçamento de tempo padrão de uma requisição HTTP para chamadas ao provedor; o cliente pode
+# reduzir com o header X-Request-Timeout (segundos), mas nunca abaixo do mínimo
+FASTDEPIX_REQUEST_BUDGET_SECONDS = float(os.environ.get('FASTDEPIX_REQUEST_BUDGET_SECONDS', '20'))
+FASTDEPIX_MIN_REQUEST_BUDGET_SECONDS = float(os.environ.get('FASTDEPIX_MIN_REQUEST_BUDGET_SECONDS', '10'))
+
+class ProviderUnavailable(Exception):
+    """Provedor indisponível (circuito aberto) ou orçamento de tempo esgotado"""
+
+_fastdepix_breaker = {"state": "closed", "failures": 0, "opened_at": 0.0, "probe": False}
+fastdepix_stats = {"chamadas": 0, "falhas": 0, "retentativas": 0, "rejeitadas": 0, "aberturas": 0}
+
+# Prazo (time.monotonic) da requisição HTTP em andamento; None fora de requisições
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+class RequestDeadlineMiddleware:
+    """Define o prazo da requisição usado como orçamento nas chamadas ao provedor"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        budget = FASTDEPIX_REQUEST_BUDGET_SECONDS
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-timeout":
+                try:
+                    budget = min(budget, max(float(value), FASTDEPIX_MIN_REQUEST_BUDGET_SECONDS))
+                except ValueError:
+                    pass
+                break
+        token = _request_deadline.set(time.monotonic() + budget)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_deadline.reset(token)
+
+def fastdepix_breaker_state() -> str:
+    if _fastdepix_breaker["state"] == "open" and time.monotonic() - _fastdepix_breaker["opened_at"] >= FASTDEPIX_BREAKER_RESET_SECONDS:
+        _fastdepix_breaker["state"] = "half_open"
+    return _fastdepix_breaker["state"]
+
+def fastdepix_available() -> bool:
+    state = fastdepix_breaker_state()
+    return state == "closed" or (state == "half_open" and not _fastdepix_breaker["probe"])
+
+def _breaker_acquire():
+    if not fastdepix_available():
+        fastdepix_stats["rejeitadas"] += 1
+        raise ProviderUnavailable("Provedor de pagamento temporariamente indisponível")
+    if _fastdepix_breaker["state"] == "half_open":
+        _fastdepix_breaker["probe"] = True
+
+def _breaker_record(success: bool):
+    _fastdepix_breaker["probe"] = False
+    if success:
+        _fastdepix_breaker.update(state="closed", failures=0)
+        return
+    fastdepix_stats["falhas"] += 1
+    _fastdepix_breaker["failures"] += 1
+    if _fastdepix_breaker["state"] == "half_open" or _fastdepix_breaker["failures"] >= FASTDEPIX_BREAKER_FAILURES:
+        if _fastdepix_breaker["state"] != "open":
+            fastdepix_stats["aberturas"] += 1
+            logger.warning(f"FastDePix circuit opened after {_fastdepix_breaker['failures']} failures")
+        _fastdepix_breaker.update(state="open", opened_at=time.monotonic())
+
+def provider_unavailable_http(e: ProviderUnavailable) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(max(1, int(FASTDEPIX_BREAKER_RESET_SECONDS)))}
+    )
+
+async def fastdepix_request(method: str, path: str, api_key: str, timeout: float = None, retries: int = None, **kwargs) -> httpx.Response:
+    """Chamada autenticada ao FastDePix pelo cliente compartilhado (path relativo a FASTDEPIX_BASE_URL).
+    
+    Passa pelo circuit breaker e respeita o prazo da requisição HTTP em andamento. GETs são
+    repetidos em falhas transitórias; POSTs só quando a conexão nem chegou a ser aberta,
+    para não duplicar cobranças. Levanta ProviderUnavailable se o circuito estiver aberto ou o
+    orçamento acabar.
+    """
+    deadline = _request_deadline.get()
+    max_retries = FASTDEPIX_MAX_RETRIES if retries is None else retries
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    attempt = 0
+    while True:
+        _breaker_acquire()
+        full_timeout = call_timeout = timeout or FASTDEPIX_TIMEOUT
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.05:
+                _fastdepix_breaker["probe"] = False
+                raise ProviderUnavailable("Tempo limite da requisição esgotado")
+            call_timeout = min(call_timeout, remaining)
+        
+        fastdepix_stats["chamadas"] += 1
+        response = None
+        try:
+            response = await get_fastdepix_client().request(method, path, headers=headers, timeout=call_timeout, **kwargs)
+        except httpx.TransportError as e:
+            # Timeout causado pelo prazo encurtado do chamador não diz nada sobre o provedor
+            if isinstance(e, httpx.TimeoutException) and call_timeout < full_timeout:
+                _fastdepix_breaker["probe"] = False
+            else:
+                _breaker_record(False)
+            retryable = method == "GET" or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            error = e
+        except BaseException:
+            _fastdepix_breaker["probe"] = False
+            raise
+        else:
+            if response.status_code < 500 and response.status_code != 429:
+                _breaker_record(True)
+                return response
+            _breaker_record(False)
+            retryable = method == "GET"
+        
+        if not retryable or attempt >= max_retries or not fastdepix_available():
+            if response is not None:
+                return response
+            raise error
+        
+        attempt += 1
+        fastdepix_stats["retentativas"] += 1
+        delay = FASTDEPIX_RETRY_BACKOFF * 2 ** (attempt - 1) * (0.5 + random.random())
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            if response is not None:
+                return response
+            raise error
+        await asyncio.sleep(delay)
+
+# ===================== MERCHANT WEBHOOKS =====================
+
+# Notificações para integradores: cada API key pode cadastrar uma URL que recebe
+# transaction.paid / transaction.expired das transações criadas com ela.
+# Os eventos ficam em db.merchant_webhook_deliveries e são enviados pelo job
+# MERCHANT_WEBHOOK_JOB (worker líder), com retry exponencial e limite por endpoint.
+MERCHANT_WEBHOOK_JOB = "merchant_webhook_dispatcher"
+MERCHANT_WEBHOOK_TIMEOUT = float(os.environ.get('MERCHANT_WEBHOOK_TIMEOUT', '10'))
+MERCHANT_WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('MERCHANT_WEBHOOK_MAX_ATTEMPTS', '8'))
+MERCHANT_WEBHOOK_ENDPOINT_CONCURRENCY = int(os.environ.get('MERCHANT_WEBHOOK_ENDPOINT_CONCURRENCY', '4'))
+MERCHANT_WEBHOOK_BATCH = 200
+MERCHANT_WEBHOOK_BACKOFF_BASE = 10      # segundos: 10, 20, 40, ... até o teto
+MERCHANT_WEBHOOK_BACKOFF_MAX = 3600
+MERCHANT_WEBHOOK_RETENTION_DAYS = 30
+
+merchant_webhook_stats = {"enfileirados": 0, "entregues": 0, "falhas": 0, "descartados": 0}
+_merchant_webhook_client = None
+_merchant_webhook_wakeup = asyncio.Event()
+_merchant_endpoint_semaphores = {}
+
+class _PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Resolve o host no momento da conexão e só conecta num endereço público validado.
+    
+    Validar a URL e deixar o httpx resolver de novo abre espaço para DNS rebinding (o host
+    responde um IP público na validação e um interno na entrega). Aqui o IP validado é o IP
+    conectado; SNI e verificação do certificado continuam usando o hostname original.
+    """
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+    
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await resolve_public_addresses(host, port)
+        except ValueError as e:
+            raise httpcore.ConnectError(str(e))
+        return await self._backend.connect_tcp(
+            addresses[0], port, timeout=timeout, local_address=local_address, socket_options=socket_options
+        )
+    
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("Webhooks só podem ser entregues por TCP")
+    
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+def get_merchant_webhook_client() -> httpx.AsyncClient:
+    global _merchant_webhook_client
+    if _merchant_webhook_client is None or _merchant_webhook_client.is_closed:
+        transport = httpx.AsyncHTTPTransport()
+        # httpx não expõe o network_backend do httpcore (versões fixadas em requirements.txt)
+        transport._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=30.0,
+            network_backend=_PublicAddressBackend()
+        )
+        _merchant_webhook_client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(MERCHANT_WEBHOOK_TIMEOUT, connect=5.0),
+            follow_redirects=False  # um redirect levaria a entrega para um destino não validado
+        )
+    return _merchant_webhook_client
+
+async def close_merchant_webhook_client():
+    global _merchant_webhook_client
+    if _merchant_webhook_client is not None:
+        await _merchant_webhook_client.aclose()
+        _merchant_webhook_client = None
+
+def external_transaction_view(transaction: dict) -> dict:
+    """Representação da transação na API externa (consulta e webhooks)"""
+    return {
+        "id": transaction["id"],
+        "amount": transaction["valor"],
+        "status": transaction["status"],
+        "qr_code": transaction.get("qr_code"),
+        "qr_code_base64": transaction.get("qr_code_base64"),
+        "pix_copy_paste": transaction.get("pix_copia_cola"),
+        "custom_id": transaction.get("custom_id"),
+        "qr_status": transaction.get("qr_status"),
+        "paid_at": transaction.get("paid_at"),
+        "created_at": transaction["created_at"]
+    }
+
+async def resolve_public_addresses(host: str, port: int) -> list:
+    """Resolve o host e exige que todos os endereços sejam globais (nada de loopback, rede
+    privada, link-local/metadata da nuvem ou faixas reservadas). Levanta ValueError com o motivo"""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError("Não foi possível resolver o host do webhook")
+    if not infos:
+        raise ValueError("Não foi possível resolver o host do webhook")
+    addresses = []
+    for info in infos:
+        raw = info[4][0]
+        address = ipaddress.ip_address(raw.split("%", 1)[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError("URL do webhook aponta para um endereço não permitido")
+        addresses.append(raw)
+    return addresses
+
+async def merchant_webhook_url_error(url: str, resolve: bool = True) -> Optional[str]:
+    """Valida a URL de webhook de um integrador: só https e só para endereços públicos.
+    
+    No cadastro o host também é resolvido (resolve=True). Nas entregas basta a checagem da URL:
+    o endereço é validado de novo a cada conexão por _PublicAddressBackend. Retorna o motivo da
+    recusa ou None.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or 443
+    except ValueError:
+        return "URL do webhook inválida"
+    if parts.scheme != "https" or not parts.hostname:
+        return "URL do webhook deve começar com https://"
+    if parts.username or parts.password:
+        return "URL do webhook não pode conter credenciais"
+    if resolve:
+        try:
+            await resolve_public_addresses(parts.hostname, port)
+        except ValueError as e:
+            return str(e)
+    return None
+
+def sign_merchant_webhook(secret: str, timestamp: str, body: bytes) -> str:
+    return hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+
+async def enqueue_merchant_events(event: str, transactions: list):
+    """Enfileira o evento para as transações criadas por API keys com webhook cadastrado"""
+    key_ids = {tx["api_key_id"] for tx in transactions if tx.get("api_key_id")}
+    if not key_ids:
+        return 0
+    keys_with_webhook = {
+        k["id"] async for k in db.api_keys.find(
+            {"id": {"$in": list(key_ids)}, "webhook_url": {"$nin": [None, ""]}},
+            {"_id": 0, "id": 1}
+        )
+    }
+    now = datetime.now(timezone.utc)
+    deliveries = []
+    for tx in transactions:
+        if tx.get("api_key_id") not in keys_with_webhook:
+            continue
+        delivery_id = str(uuid.uuid4())
+        deliveries.append({
+            "_id": delivery_id,
+            "api_key_id": tx["api_key_id"],
+            "parceiro_id": tx["parceiro_id"],
+            "transaction_id": tx["id"],
+            "event": event,
+            "payload": {
+                "id": delivery_id,
+                "event": event,
+                "created_at": now.isoformat(),
+                "data": external_transaction_view(tx)
+            },
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now
+        })
+    if deliveries:
+        await db.merchant_webhook_deliveries.insert_many(deliveries)
+        merchant_webhook_stats["enfileirados"] += len(deliveries)
+        _merchant_webhook_wakeup.set()
+    return len(deliveries)
+
+async def _deliver_merchant_webhook(delivery: dict, key: Optional[dict]) -> UpdateOne:
+    """Envia uma entrega e devolve a atualização do seu estado"""
+    now = datetime.now(timezone.utc)
+    attempts = delivery.get("attempts", 0) + 1
+    if not key or not key.get("webhook_url") or key.get("status") != "active":
+        merchant_webhook_stats["descartados"] += 1
+        return UpdateOne({"_id": delivery["_id"]}, {"$set": {"status": "discarded", "finished_at": now}})
+    
+    url = key["webhook_url"]
+    semaphore = _merchant_endpoint_semaphores.setdefault(url, asyncio.Semaphore(MERCHANT_WEBHOOK_ENDPOINT_CONCURRENCY))
+    body = json.dumps(delivery["payload"], separators=(",", ":")).encode()
+    timestamp = str(int(now.timestamp()))
+    status_code = None
+    error = None
+    async with semaphore:
+        try:
+            # URLs cadastradas antes da validação; o endereço é checado na conexão
+            url_error = await merchant_webhook_url_error(url, resolve=False)
+            if url_error:
+                raise ValueError(url_error)
+            response = await get_merchant_webhook_client().post(
+                url,
+                content=body,
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Webhook-Id": delivery["_id"],
+                    "X-Webhook-Event": delivery["event"],
+                    "X-Webhook-Timestamp": timestamp,
+                    "X-Webhook-Signature": sign_merchant_webhook(key["webhook_secret"], timestamp, body)
+                }
+            )
+            status_code = response.status_code
+            if 200 <= status_code < 300:
+                merchant_webhook_stats["entregues"] += 1
+                return UpdateOne({"_id": delivery["_id"]}, {
+                    "$set": {"status": "delivered", "finished_at": now, "last_status_code": status_code},
+                    "$inc": {"attempts": 1}
+                })
+            error = f"HTTP {status_code}"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+    
+    merchant_webhook_stats["falhas"] += 1
+    update = {"attempts": attempts, "last_error": error, "last_status_code": status_code}
+    if attempts >= MERCHANT_WEBHOOK_MAX_ATTEMPTS:
+        update.update({"status": "failed", "finished_at": now})
+    else:
+        delay = min(MERCHANT_WEBHOOK_BACKOFF_BASE * 2 ** (attempts - 1), MERCHANT_WEBHOOK_BACKOFF_MAX)
+        update["next_attempt_at"] = now + timedelta(seconds=delay)
+    return UpdateOne({"_id": delivery["_id"]}, {"$set": update})
+
+async def dispatch_merchant_webhooks() -> int:
+    """Envia um lote de entregas vencidas. Retorna quantas foram tentadas"""
+    deliveries = await db.merchant_webhook_deliveries.find(
+        {"status": "pending", "next_attempt_at": {"$lte": datetime.now(timezone.utc)}}
+    ).sort("next_attempt_at", 1).to_list(MERCHANT_WEBHOOK_BATCH)
+    if not deliveries:
+        return 0
+    
+    keys = {
+        k["id"]: k async for k in db.api_keys.find(
+            {"id": {"$in": list({d["api_key_id"] for d in deliveries})}},
+            {"_id": 0, "id": 1, "status": 1, "webhook_url": 1, "webhook_secret": 1}
+        )
+    }
+    updates = await asyncio.gather(*(_deliver_merchant_webhook(d, keys.get(d["api_key_id"])) for d in deliveries))
+    await db.merchant_webhook_deliveries.bulk_write(list(updates), ordered=False)
+    return len(deliveries)
+
+async def process_merchant_webhooks():
+    """Job de background que envia os webhooks dos integradores"""
+    while True:
+        try:
+            sent = await dispatch_merchant_webhooks()
+        except Exception as e:
+            logger.error(f"Error dispatching merchant webhooks: {e}")
+            sent = 0
+        
+        if sent < MERCHANT_WEBHOOK_BATCH:
+            _merchant_webhook_wakeup.clear()
+            try:
+                await asyncio.wait_for(_merchant_webhook_wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+# ===================== PIX CHARGES =====================
+
+# Com ASYNC_QR_ACQUISITION (ou o header "Prefer: respond-async") a transação é gravada como
+# pending na hora e o QR é obtido em background; o cliente recebe o PIX pelo stream SSE
+# (/transactions/{id}/events) ou por uma nova leitura, com qr_status pending → ready/failed.
+ASYNC_QR_ACQUISITION = os.environ.get('ASYNC_QR_ACQUISITION', 'false').lower() == 'true'
+
+_background_tasks = set()
+
+def spawn_background(coro):
+    """create_task mantendo referência até o fim (evita que a task seja coletada).
+    Roda em contexto novo para não herdar o prazo da requisição que a criou."""
+    task = asyncio.create_task(coro, context=contextvars.Context())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def wants_async_qr(prefer: Optional[str]) -> bool:
+    return ASYNC_QR_ACQUISITION or "respond-async" in (prefer or "").lower()
+
+def pix_charge_payload(amount: float, name: str, cpf_cnpj: Optional[str], user_type: Optional[str] = None) -> dict:
+    """Payload de criação de cobrança no FastDePix"""
+    cpf_cnpj_clean = (cpf_cnpj or "").replace(".", "").replace("-", "").replace("/", "")
+    if not user_type:
+        # Determinar tipo de usuário baseado no CPF/CNPJ
+        user_type = "company" if len(cpf_cnpj_clean) == 14 else "individual"
+    return {
+        "amount": amount,
+        "user": {
+            "name": name,
+            "cpf_cnpj": cpf_cnpj_clean,
+            "user_type": user_type
+        }
+    }
+
+async def request_pix_charge(transaction: dict, payload: dict, api_key: str) -> Optional[str]:
+    """Gera o PIX no FastDePix e preenche a transação. Retorna a mensagem de erro, se houver"""
+    error = None
+    try:
+        response = await fastdepix_request("POST", "/transactions", api_key, json=payload, timeout=30.0)
+        logger.info(f"FastDePix response for {transaction['id']}: {response.status_code} - {response.text}")
+        result = response.json() if response.status_code in [200, 201] else {}
+        if result.get("success"):
+            tx_data = result.get("data", {})
+            transaction["fastdepix_id"] = tx_data.get("id")
+            transaction["qr_code"] = tx_data.get("qr_code")
+            transaction["pix_copia_cola"] = tx_data.get("qr_code_text")
+        else:
+            error = f"Provedor respondeu HTTP {response.status_code}"
+    except ProviderUnavailable as e:
+        error = str(e)
+    except Exception as e:
+        logger.error(f"FastDePix API error: {e}")
+        error = "Falha ao comunicar com o provedor"
+    transaction["qr_status"] = "failed" if error else "ready"
+    return error
+
+async def complete_pix_charge(transaction: dict, payload: dict, api_key: str):
+    """Obtém o QR de uma transação já gravada e avisa os streams abertos"""
+    error = await request_pix_charge(transaction, payload, api_key)
+    await db.transactions.update_one(
+        {"id": transaction["id"]},
+        {"$set": {
+            "fastdepix_id": transaction["fastdepix_id"],
+            "qr_code": transaction["qr_code"],
+            "pix_copia_cola": transaction["pix_copia_cola"],
+            "qr_status": transaction["qr_status"],
+            "qr_error": error
+        }}
+    )
+    schedule_transaction_poll(transaction)
+    publish_transaction_status(transaction["id"], transaction_status_view(transaction))
+
+async def create_pix_charge(transaction: dict, payload: dict, api_key: Optional[str], acquire_async: bool = False) -> dict:
+    """Gera o PIX (na hora ou em background) e grava a transação"""
+    if api_key and not fastdepix_available():
+        raise provider_unavailable_http(ProviderUnavailable("Provedor de pagamento temporariamente indisponível"))
+    if api_key and acquire_async:
+        transaction["qr_status"] = "pending"
+        await db.transactions.insert_one(transaction)
+        del transaction["_id"]
+        await record_payer_activity([transaction])
+        spawn_background(complete_pix_charge(dict(transaction), payload, api_key))
+        return transaction
+    
+    if api_key:
+        await request_pix_charge(transaction, payload, api_key)
+    await db.transactions.insert_one(transaction)
+    del transaction["_id"]
+    await record_payer_activity([transaction])
+    schedule_transaction_poll(transaction)
+    return transaction
+
+# ===================== IDEMPOTENCY =====================
+
+# Idempotency-Key nos endpoints que criam cobrança: a primeira requisição reserva a chave
+# em db.idempotency_keys; repetições com o mesmo payload recebem a resposta gravada sem nova
+# chamada ao provedor, e duplicatas concorrentes esperam a primeira terminar.
+# A reserva tem dono e locked_until, renovado enquanto o handler roda: se o worker morrer no
+# meio, a reserva vence em IDEMPOTENCY_LOCK_SECONDS e uma repetição assume a chave.
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = 35  # um pouco acima do timeout da chamada ao provedor
+IDEMPOTENCY_LOCK_SECONDS = 15
+
+_idempotency_inflight = {}
+_IDEMPOTENCY_TAKEOVER = object()
+
+def request_fingerprint(data: BaseModel) -> str:
+    return hashlib.sha256(json.dumps(data.model_dump(), sort_keys=True, default=str).encode()).hexdigest()
+
+async def _take_over_idempotency_key(record_id: str, fingerprint: str, owner: str) -> bool:
+    """Assume uma reserva "processing" cujo dono parou de renovar (worker caiu)"""
+    now = datetime.now(timezone.utc)
+    record = await db.idempotency_keys.find_one_and_update(
+        {
+            "_id": record_id,
+            "status": "processing",
+            "fingerprint": fingerprint,
+            "$or": [
+                {"locked_until": {"$lt": now}},
+                # Reservas anteriores ao locked_until
+                {"locked_until": {"$exists": False}, "created_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+            ]
+        },
+        {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+    )
+    return record is not None
+
+async def _wait_idempotent_result(record_id: str, fingerprint: str, owner: str):
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record is None:
+            return None
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key já utilizada com outro payload")
+        if record["status"] == "done":
+            return record["response"]
+        if await _take_over_idempotency_key(record_id, fingerprint, owner):
+            return _IDEMPOTENCY_TAKEOVER
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="Requisição com esta Idempotency-Key ainda em processamento")
+        # Na mesma instância acorda assim que a original termina; entre workers, relê a cada 250ms
+        event = _idempotency_inflight.get(record_id)
+        try:
+            await asyncio.wait_for(event.wait() if event else asyncio.sleep(0.25), timeout=0.25)
+        except asyncio.TimeoutError:
+            pass
+
+async def _renew_idempotency_lock(record_id: str, owner: str):
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LOCK_SECONDS / 3)
+        try:
+            await db.idempotency_keys.update_one(
+                {"_id": record_id, "owner": owner, "status": "processing"},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+            )
+        except Exception as e:
+            logger.error(f"Error renewing idempotency lock {record_id}: {e}")
+
+async def run_idempotent(scope: str, idempotency_key: Optional[str], data: BaseModel, handler):
+    """Executa handler() uma única vez por (scope, Idempotency-Key); sem chave, apenas executa"""
+    if not idempotency_key:
+        return await handler()
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key muito longa")
+    
+    record_id = f"{scope}:{idempotency_key}"
+    fingerprint = request_fingerprint(data)
+    owner = uuid.uuid4().hex
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": record_id,
+                "fingerprint": fingerprint,
+                "status": "processing",
+                "owner": owner,
+                "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+                "created_at": now
+            })
+            break
+        except DuplicateKeyError:
+            response = await _wait_idempotent_result(record_id, fingerprint, owner)
+            if response is _IDEMPOTENCY_TAKEOVER:
+                break
+            if response is not None:
+                return response
+            # A requisição original falhou e liberou a chave: tenta reservar de novo
+    
+    _idempotency_inflight[record_id] = asyncio.Event()
+    renew = asyncio.create_task(_renew_idempotency_lock(record_id, owner))
+    try:
+        response = await handler()
+    except BaseException:
+        # Erros não são gravados: o cliente pode repetir a mesma chave
+        await db.idempotency_keys.delete_one({"_id": record_id, "status": "processing", "owner": owner})
+        raise
+    else:
+        await db.idempotency_keys.update_one(
+            {"_id": record_id, "owner": owner},
+            {"$set": {"status": "done", "response": response}, "$unset": {"locked_until": ""}}
+        )
+        return response
+    finally:
+        renew.cancel()
+        _idempotency_inflight.pop(record_id).set()
+
 # ===================== INITIALIZATION =====================
 
 async def init_admin():
@@ -403,165 +1305,1091 @@ async def init_admin():
     # Apenas garante que a configuração existe
     await get_config()
 
-# ===================== BACKGROUND POLLING JOB =====================
+async def ensure_indexes():
+    """Cria os índices usados nos caminhos quentes (idempotente)"""
+    await db.balances.create_index("user_id", unique=True)
+    await db.users.create_index("id", unique=True)
+    await db.users.create_index("indicador_id")
+    await db.users.create_index("ancestor_ids")
+    await db.users.create_index([("network_admin_id", 1), ("role", 1)])
+    await db.transactions.create_index("id", unique=True)
+    await db.transactions.create_index([("status", 1), ("created_at", 1)])
+    await db.transactions.create_index([("network_admin_id", 1), ("status", 1), ("created_at", -1)])
+    await db.withdrawals.create_index([("network_admin_id", 1), ("status", 1), ("created_at", -1)])
+    await db.transfers.create_index("network_admin_id")
+    await db.commissions.create_index("network_admin_id")
+    await db.tickets.create_index([("network_admin_id", 1), ("status", 1)])
+    await db.webhook_inbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.api_keys.create_index("key")
+    await db.reconciliation_reports.create_index("id", unique=True)
+    await db.reconciliation_reports.create_index([("started_at", -1)])
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 3600)
+    await db.api_keys.create_index("id", unique=True)
+    await db.merchant_webhook_deliveries.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.merchant_webhook_deliveries.create_index("finished_at", expireAfterSeconds=MERCHANT_WEBHOOK_RETENTION_DAYS * 86400)
+    await db.webhook_inbox.create_index("processed_at", expireAfterSeconds=WEBHOOK_INBOX_RETENTION_DAYS * 86400)
+    await db.payer_counters.create_index([("documento", 1), ("hour", 1)])
+    await db.payer_counters.create_index("expires_at", expireAfterSeconds=0)
+
+# ===================== MIGRATIONS =====================
+
+async def backfill_user_ancestry(force: bool = False):
+    """Preenche ancestor_ids e network_admin_id de todos os usuários (idempotente).
+    
+    Carrega apenas id/indicador_id/role de cada usuário e resolve os caminhos em memória.
+    Sem force, só roda se algum usuário ainda não tiver os campos.
+    """
+    if not force and not await db.users.find_one({"ancestor_ids": {"$exists": False}}, {"_id": 1}):
+        return 0
+    
+    nodes = {}
+    async for u in db.users.find({}, {"_id": 0, "id": 1, "indicador_id": 1, "role": 1}):
+        nodes[u["id"]] = u
+    
+    updates = []
+    for user_id, node in nodes.items():
+        ancestor_ids = []
+        network_admin_id = user_id if node.get("role") == "admin" else None
+        current = node
+        while current.get("indicador_id") and current["indicador_id"] not in ancestor_ids and current["indicador_id"] != user_id:
+            ancestor_ids.append(current["indicador_id"])
+            current = nodes.get(current["indicador_id"])
+            if not current:
+                break
+            if network_admin_id is None and current.get("role") == "admin":
+                network_admin_id = current["id"]
+        
+        updates.append(UpdateOne(
+            {"id": user_id},
+            {"$set": {"ancestor_ids": ancestor_ids, "network_admin_id": network_admin_id}}
+        ))
+    
+    for i in range(0, len(updates), 1000):
+        await db.users.bulk_write(updates[i:i + 1000], ordered=False)
+    
+    logger.info(f"Ancestralidade preenchida para {len(updates)} usuários")
+    return len(updates)
+
+# Coleções que carregam a chave de tenant network_admin_id e o campo do dono de cada documento
+TENANT_COLLECTIONS = {
+    "transactions": "parceiro_id",
+    "withdrawals": "parceiro_id",
+    "transfers": "remetente_id",
+    "commissions": "indicador_id",
+    "tickets": "parceiro_id"
+}
+
+async def restamp_network_admin(user_ids: list, network_admin_id: str):
+    """Atualiza a chave de tenant dos documentos dos usuários que mudaram de rede"""
+    for i in range(0, len(user_ids), 1000):
+        batch = user_ids[i:i + 1000]
+        for collection_name, owner_field in TENANT_COLLECTIONS.items():
+            await db[collection_name].update_many(
+                {owner_field: {"$in": batch}},
+                {"$set": {"network_admin_id": network_admin_id}}
+            )
+        await db.transfers.update_many(
+            {"destinatario_id": {"$in": batch}},
+            {"$set": {"destinatario_network_admin_id": network_admin_id}}
+        )
 
-async def process_paid_transaction(transaction: dict, config: dict):
-    """Processa uma transação quando confirmada como paga"""
-    transaction_id = transaction["id"]
+async def backfill_network_admin_ids(force: bool = False):
+    """Grava network_admin_id nos documentos que ainda não têm (idempotente).
     
-    # Atualiza status
-    paid_at = datetime.now(timezone.utc).isoformat()
-    await db.transactions.update_one(
-        {"id": transaction_id},
-        {"$set": {"status": "paid", "paid_at": paid_at}}
+    Depende de backfill_user_ancestry: usa o network_admin_id já resolvido de cada usuário.
+    """
+    pending = []
+    for collection_name in TENANT_COLLECTIONS:
+        if force or await db[collection_name].find_one({"network_admin_id": {"$exists": False}}, {"_id": 1}):
+            pending.append(collection_name)
+    if not pending:
+        return
+    
+    networks = {}
+    async for u in db.users.find({}, {"_id": 0, "id": 1, "network_admin_id": 1}):
+        networks.setdefault(u.get("network_admin_id"), []).append(u["id"])
+    
+    for network_admin_id, user_ids in networks.items():
+        for i in range(0, len(user_ids), 1000):
+            batch = user_ids[i:i + 1000]
+            for collection_name in pending:
+                owner_field = TENANT_COLLECTIONS[collection_name]
+                await db[collection_name].update_many(
+                    {owner_field: {"$in": batch}, **({} if force else {"network_admin_id": {"$exists": False}})},
+                    {"$set": {"network_admin_id": network_admin_id}}
+                )
+            if "transfers" in pending:
+                await db.transfers.update_many(
+                    {"destinatario_id": {"$in": batch}, **({} if force else {"destinatario_network_admin_id": {"$exists": False}})},
+                    {"$set": {"destinatario_network_admin_id": network_admin_id}}
+                )
+    
+    logger.info(f"Chave de tenant preenchida em: {', '.join(pending)}")
+
+async def backfill_deposit_counters():
+    """Reconstrói deposit_counters e first_deposit_at a partir das transações pagas (idempotente).
+    
+    Grava com $max/$min: rodar de novo não duplica e nunca reduz um contador que a liquidação
+    já incrementou enquanto a varredura rodava.
+    """
+    counters = {}
+    first_deposits = {}
+    async for tx in db.transactions.find(
+        {"status": "paid", **DEPOSIT_QUERY},
+        {"_id": 0, "parceiro_id": 1, "valor": 1, "created_at": 1}
+    ):
+        day = deposit_day(tx["created_at"])
+        counter = counters.setdefault((tx["parceiro_id"], day), {"valor": 0, "quantidade": 0})
+        counter["valor"] += tx.get("valor", 0)
+        counter["quantidade"] += 1
+        if tx["parceiro_id"] not in first_deposits or tx["created_at"] < first_deposits[tx["parceiro_id"]]:
+            first_deposits[tx["parceiro_id"]] = tx["created_at"]
+    
+    counter_updates = [
+        UpdateOne(
+            {"_id": deposit_counter_id(user_id, day)},
+            {"$set": {"user_id": user_id, "day": day}, "$max": counter},
+            upsert=True
+        )
+        for (user_id, day), counter in counters.items()
+    ]
+    user_updates = [
+        UpdateOne({"id": user_id}, {"$min": {"first_deposit_at": first_deposit_at}})
+        for user_id, first_deposit_at in first_deposits.items()
+    ]
+    for i in range(0, len(counter_updates), 1000):
+        await db.deposit_counters.bulk_write(counter_updates[i:i + 1000], ordered=False)
+    for i in range(0, len(user_updates), 1000):
+        await db.users.bulk_write(user_updates[i:i + 1000], ordered=False)
+    invalidate_user_cache()
+    
+    logger.info(f"Contadores de depósito reconstruídos: {len(counter_updates)} dias de {len(user_updates)} usuários")
+    return len(counter_updates)
+
+DEPOSIT_BACKFILL_LEASE = "deposit_counters_backfill"
+DEPOSIT_BACKFILL_MARKER = {"type": "migration", "name": "deposit_counters"}
+DEPOSIT_BACKFILL_WAIT_SECONDS = 300
+
+async def ensure_deposit_counters():
+    """Roda backfill_deposit_counters uma única vez, antes de o worker aceitar tráfego.
+    
+    Só o dono do lease executa; os demais workers esperam o marcador em db.config, para que
+    nenhuma liquidação deste código concorra com a varredura.
+    """
+    started = time.monotonic()
+    while not await db.config.find_one(DEPOSIT_BACKFILL_MARKER, {"_id": 1}):
+        if await acquire_lease(DEPOSIT_BACKFILL_LEASE):
+            renew = asyncio.create_task(_renew_lease(DEPOSIT_BACKFILL_LEASE))
+            try:
+                if not await db.config.find_one(DEPOSIT_BACKFILL_MARKER, {"_id": 1}):
+                    await backfill_deposit_counters()
+                    await db.config.update_one(
+                        DEPOSIT_BACKFILL_MARKER,
+                        {"$set": {"done_at": datetime.now(timezone.utc).isoformat(), "worker": WORKER_ID}},
+                        upsert=True
+                    )
+            finally:
+                renew.cancel()
+                await release_lease(DEPOSIT_BACKFILL_LEASE)
+            return
+        if time.monotonic() - started > DEPOSIT_BACKFILL_WAIT_SECONDS:
+            logger.warning("Timed out waiting for the deposit counters backfill on another worker")
+            return
+        await asyncio.sleep(1)
+
+# ===================== DEPOSIT COUNTERS =====================
+
+# Total depositado por usuário e dia útil (UTC, pela data de criação da cobrança), mantido pela
+# liquidação: os limites diários viram uma leitura por _id em vez de somar as transações do dia.
+# A data do primeiro depósito fica no próprio usuário (first_deposit_at).
+DEPOSIT_QUERY = {"tipo": {"$nin": ["transfer_out", "transfer_in"]}}
+
+def deposit_day(created_at) -> str:
+    return _parse_created_at(created_at).date().isoformat()
+
+def deposit_counter_id(user_id: str, day: str) -> str:
+    return f"{user_id}:{day}"
+
+async def record_deposit(transaction: dict):
+    """Soma uma cobrança liquidada ao contador do dia do parceiro"""
+    day = deposit_day(transaction["created_at"])
+    await db.deposit_counters.update_one(
+        {"_id": deposit_counter_id(transaction["parceiro_id"], day)},
+        {
+            "$inc": {"valor": transaction["valor"], "quantidade": 1},
+            "$setOnInsert": {"user_id": transaction["parceiro_id"], "day": day}
+        },
+        upsert=True
+    )
+
+async def get_deposit_totals(user_id: str, day: str = None) -> dict:
+    """Depositado pelo usuário no dia (hoje por padrão): uma leitura pontual"""
+    day = day or datetime.now(timezone.utc).date().isoformat()
+    counter = await db.deposit_counters.find_one(
+        {"_id": deposit_counter_id(user_id, day)},
+        {"_id": 0, "valor": 1, "quantidade": 1}
     )
+    return counter or {"valor": 0, "quantidade": 0}
+
+# ===================== PAYER VELOCITY =====================
+
+# Contadores por documento do pagador (CPF/CNPJ só com dígitos) em baldes de uma hora, somando
+# todos os parceiros: cobranças geradas e valores pagos. As janelas de 1h e 24h são deslizantes
+# (o balde mais antigo entra proporcionalmente ao trecho ainda dentro da janela) e saem de uma
+# única consulta indexada, sem varrer o histórico. Os baldes expiram sozinhos (TTL).
+# Os limites vêm da config do sistema (limite_pagador_*); 0 ou ausente desativa. As variáveis
+# de ambiente só valem enquanto o admin não definiu o campo.
+PAYER_MAX_CHARGES_PER_HOUR = int(os.environ.get('PAYER_MAX_CHARGES_PER_HOUR', '0'))
+PAYER_DAILY_LIMIT = float(os.environ.get('PAYER_DAILY_LIMIT', '0'))
+PAYER_BUCKET_RETENTION_HOURS = 26
+
+def normalize_payer_document(value: Optional[str]) -> Optional[str]:
+    digits = "".join(c for c in (value or "") if c.isdigit())
+    return digits if len(digits) in (11, 14) else None
+
+def _payer_bucket(documento: str, moment: datetime):
+    hour = moment.replace(minute=0, second=0, microsecond=0)
+    return f"{documento}:{hour.strftime('%Y-%m-%dT%H')}", hour
+
+async def record_payer_activity(transactions: list, paid: bool = False):
+    """Soma cobranças geradas (ou pagas, com paid=True) aos baldes da hora atual de cada pagador"""
+    counts = {}
+    for transaction in transactions:
+        documento = normalize_payer_document(transaction.get("cpf_cnpj"))
+        if documento:
+            counter = counts.setdefault(documento, [0, 0])
+            counter[0] += 1
+            counter[1] += transaction.get("valor", 0)
+    if not counts:
+        return
     
-    # Atualiza saldo do parceiro
-    user = await db.users.find_one({"id": transaction["parceiro_id"]})
-    if user:
-        valor_liquido = transaction.get("valor_liquido", transaction["valor"])
-        await db.users.update_one(
-            {"id": user["id"]},
+    now = datetime.now(timezone.utc)
+    count_field, amount_field = ("pagas", "valor_pago") if paid else ("cobrancas", "valor_cobrado")
+    updates = []
+    for documento, (quantidade, valor) in counts.items():
+        bucket_id, hour = _payer_bucket(documento, now)
+        updates.append(UpdateOne(
+            {"_id": bucket_id},
             {
-                "$inc": {
-                    "saldo_disponivel": valor_liquido,
-                    "valor_movimentado": transaction["valor"]
+                "$inc": {count_field: quantidade, amount_field: valor},
+                "$setOnInsert": {
+                    "documento": documento,
+                    "hour": hour.isoformat(),
+                    "expires_at": hour + timedelta(hours=PAYER_BUCKET_RETENTION_HOURS)
                 }
-            }
-        )
+            },
+            upsert=True
+        ))
+    await db.payer_counters.bulk_write(updates, ordered=False)
+
+async def load_payer_windows(documentos: list) -> dict:
+    """Janelas deslizantes de 1h e 24h por documento: {"hora": {...}, "dia": {...}}"""
+    now = datetime.now(timezone.utc)
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
+    # Fração da hora corrente já decorrida: o balde mais antigo de cada janela pesa o restante
+    elapsed = (now - current_hour).total_seconds() / 3600
+    windows = {
+        documento: {"hora": {"cobrancas": 0, "valor_pago": 0}, "dia": {"cobrancas": 0, "valor_pago": 0}}
+        for documento in documentos
+    }
+    if not windows:
+        return windows
+    
+    buckets = await db.payer_counters.find(
+        {"documento": {"$in": list(windows)}, "hour": {"$gte": (current_hour - timedelta(hours=24)).isoformat()}},
+        {"_id": 0, "documento": 1, "hour": 1, "cobrancas": 1, "valor_pago": 1}
+    ).to_list(None)
+    for bucket in buckets:
+        age_hours = round((current_hour - datetime.fromisoformat(bucket["hour"])).total_seconds() / 3600)
+        for window, size in (("hora", 1), ("dia", 24)):
+            if age_hours < size:
+                weight = 1
+            elif age_hours == size:
+                weight = 1 - elapsed
+            else:
+                continue
+            totals = windows[bucket["documento"]][window]
+            totals["cobrancas"] += bucket.get("cobrancas", 0) * weight
+            totals["valor_pago"] += bucket.get("valor_pago", 0) * weight
+    return windows
+
+def payer_limits(config: dict) -> tuple:
+    """(máximo de cobranças por hora, valor pago máximo em 24h) por pagador; 0 desativa"""
+    max_charges = config.get("limite_pagador_cobrancas_hora")
+    daily_limit = config.get("limite_pagador_diario")
+    return (
+        PAYER_MAX_CHARGES_PER_HOUR if max_charges is None else max_charges,
+        PAYER_DAILY_LIMIT if daily_limit is None else daily_limit
+    )
+
+def payer_limit_error(window: dict, valor: float, config: dict) -> Optional[str]:
+    """Motivo da recusa de uma nova cobrança do pagador, ou None se está dentro dos limites.
+    O limite de valor considera só o que foi pago; cobranças expiradas ou com falha contam
+    apenas para o limite de cobranças por hora"""
+    max_charges, daily_limit = payer_limits(config)
+    if max_charges and window["hora"]["cobrancas"] + 1 > max_charges:
+        return "Muitas cobranças para este CPF/CNPJ na última hora. Tente novamente mais tarde"
+    if daily_limit and window["dia"]["valor_pago"] + valor > daily_limit:
+        return "Limite diário de pagamentos para este CPF/CNPJ excedido"
+    return None
+
+async def check_payer_velocity(cpf_cnpj: Optional[str], valor: float, config: dict):
+    """Recusa a cobrança (400) se o pagador estourou os limites somando todos os parceiros"""
+    documento = normalize_payer_document(cpf_cnpj)
+    if not documento or not any(payer_limits(config)):
+        return
+    windows = await load_payer_windows([documento])
+    error = payer_limit_error(windows[documento], valor, config)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+
+# ===================== PAYMENT SETTLEMENT =====================
+
+async def settle_transaction(transaction_id: str, config: dict, source: str, claim_statuses=("pending",)) -> Optional[dict]:
+    """Liquida uma transação confirmada como paga: crédito, comissão e liberação de indicação.
+    
+    Caminho único para webhook e poller. O claim condicional do status garante que cada
+    transação seja liquidada uma única vez, mesmo com entregas concorrentes.
+    Retorna a transação liquidada, ou None se ela já tinha sido processada.
+    """
+    paid_at = datetime.now(timezone.utc).isoformat()
+    transaction = await db.transactions.find_one_and_update(
+        {"id": transaction_id, "status": {"$in": list(claim_statuses)}},
+        {"$set": {"status": "paid", "paid_at": paid_at, "settled_by": source}},
+        projection={"_id": 0}
+    )
+    if not transaction:
+        return None
+    transaction.update({"status": "paid", "paid_at": paid_at, "settled_by": source})
+    unschedule_transaction_poll(transaction_id)
+    publish_transaction_status(transaction_id, transaction_status_view(transaction))
+    
+    valor = transaction["valor"]
+    valor_liquido = transaction.get("valor_liquido", valor)
+    
+    # Credita o parceiro e já recebe os campos usados no restante da liquidação
+    user = await db.users.find_one_and_update(
+        {"id": transaction["parceiro_id"]},
+        {
+            "$inc": {"saldo_disponivel": valor_liquido, "valor_movimentado": valor},
+            "$min": {"first_deposit_at": transaction["created_at"]}
+        },
+        projection={"_id": 0, "id": 1, "indicador_id": 1, "network_admin_id": 1, "valor_movimentado": 1, "indicacoes_liberadas": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if user:
+        writes = [
+            apply_balance_delta(user["id"], total_recebido=_valor_creditado(transaction)),
+            record_deposit(transaction),
+            record_payer_activity([transaction], paid=True)
+        ]
+        
+        # Libera indicação se atingiu meta
+        if user.get("valor_movimentado", 0) >= config.get("valor_minimo_indicacao", 1000) and not user.get("indicacoes_liberadas"):
+            writes.append(db.users.update_one(
+                {"id": user["id"], "indicacoes_liberadas": {"$in": [0, None]}},
+                {"$set": {"indicacoes_liberadas": 1}}
+            ))
         
         # Comissão para indicador
         indicador_id = user.get("indicador_id")
         if indicador_id:
-            # Busca o indicador para verificar se tem comissão individual
-            indicador = await db.users.find_one({"id": indicador_id})
-            # Prioriza comissão individual do indicador, senão usa config global
-            percentual_comissao = indicador.get("comissao_indicacao_individual") if indicador and indicador.get("comissao_indicacao_individual") is not None else config.get("comissao_indicacao", 1.0)
-            comissao = transaction["valor"] * percentual_comissao / 100
-            await db.users.update_one(
+            indicador = await db.users.find_one(
                 {"id": indicador_id},
-                {"$inc": {"saldo_comissoes": comissao}}
+                {"_id": 0, "id": 1, "role": 1, "network_admin_id": 1, "comissao_indicacao_individual": 1}
             )
-            
-            await db.commissions.insert_one({
+            # Prioriza comissão individual do indicador, senão usa config
+            percentual_comissao = indicador.get("comissao_indicacao_individual") if indicador and indicador.get("comissao_indicacao_individual") is not None else config.get("comissao_indicacao", 1.0)
+            comissao = valor * percentual_comissao / 100
+            writes.append(db.users.update_one({"id": indicador_id}, {"$inc": {"saldo_comissoes": comissao}}))
+            writes.append(apply_balance_delta(indicador_id, total_comissoes=comissao))
+            writes.append(db.commissions.insert_one({
                 "id": str(uuid.uuid4()),
                 "indicador_id": indicador_id,
                 "indicado_id": user["id"],
+                "network_admin_id": await network_admin_of(indicador) if indicador else user.get("network_admin_id"),
                 "transacao_id": transaction_id,
-                "valor_transacao": transaction["valor"],
+                "valor_transacao": valor,
                 "percentual": percentual_comissao,
                 "valor_comissao": comissao,
                 "status": "credited",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
-            
-            # Verifica se deve fazer saque automático de comissões
-            asyncio.create_task(process_auto_withdrawal(indicador_id))
+                "created_at": paid_at
+            }))
         
-        # Libera indicação se atingiu meta
-        updated_user = await db.users.find_one({"id": user["id"]})
-        if updated_user.get("valor_movimentado", 0) >= config.get("valor_minimo_indicacao", 1000):
-            current_liberadas = updated_user.get("indicacoes_liberadas", 0)
-            if current_liberadas == 0:
-                await db.users.update_one(
-                    {"id": user["id"]},
-                    {"$set": {"indicacoes_liberadas": 1}}
-                )
+        if transaction.get("api_key_id"):
+            writes.append(enqueue_merchant_events("transaction.paid", [transaction]))
+        
+        # Escritas independentes entre si: um round trip de latência em vez de vários
+        await asyncio.gather(*writes)
+        invalidate_user_cache(user["id"])
+        if indicador_id:
+            invalidate_user_cache(indicador_id)
+            # Verifica se deve fazer saque automático de comissões
+            spawn_background(process_auto_withdrawal(indicador_id))
     
-    logger.info(f"Transaction {transaction_id} marked as paid")
+    logger.info(f"Transaction {transaction_id} marked as paid ({source})")
+    return transaction
+
+# ===================== BACKGROUND JOB LEADER =====================
+
+# Jobs periódicos rodam em um único worker: quem detém o lease em db.locks executa o job e
+# renova o lease a cada LEADER_LEASE_SECONDS / 3. Se o dono morrer, outro worker assume
+# assim que o lease expira (ou imediatamente, se foi liberado no shutdown).
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+LEADER_LEASE_SECONDS = float(os.environ.get('LEADER_LEASE_SECONDS', '15'))
+
+_held_leases = set()
+_leader_tasks = []
+
+def is_leader(name: str) -> bool:
+    return name in _held_leases
+
+async def acquire_lease(name: str) -> bool:
+    """Adquire ou renova o lease `name` para este worker"""
+    now = datetime.now(timezone.utc)
+    try:
+        lease = await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {
+                "owner": WORKER_ID,
+                "expires_at": now + timedelta(seconds=LEADER_LEASE_SECONDS),
+                "heartbeat_at": now
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Outro worker detém um lease válido
+        lease = None
+    except Exception as e:
+        # Sem confirmar a renovação não dá para supor que o lease segue nosso: para de agir como líder
+        logger.error(f"Error acquiring lease {name}: {e}")
+        lease = None
+    if lease and lease.get("owner") == WORKER_ID:
+        _held_leases.add(name)
+        return True
+    _held_leases.discard(name)
+    return False
+
+async def release_lease(name: str):
+    _held_leases.discard(name)
+    await db.locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+async def _renew_lease(name: str):
+    """Mantém um lease renovado durante uma tarefa única (cancelar ao terminar)"""
+    while True:
+        await asyncio.sleep(LEADER_LEASE_SECONDS / 3)
+        await acquire_lease(name)
+
+async def run_as_leader(name: str, job):
+    """Mantém `job()` rodando apenas enquanto este worker detém o lease `name`"""
+    heartbeat = LEADER_LEASE_SECONDS / 3
+    task = None
+    try:
+        while True:
+            leader = await acquire_lease(name)
+            
+            if leader and (task is None or task.done()):
+                logger.info(f"Worker {WORKER_ID} assumed job {name}")
+                task = asyncio.create_task(job())
+            elif not leader and task is not None:
+                logger.info(f"Worker {WORKER_ID} lost job {name}")
+                task.cancel()
+                task = None
+            
+            await asyncio.sleep(heartbeat)
+    finally:
+        if task is not None:
+            task.cancel()
+
+def start_leader_job(name: str, job):
+    _leader_tasks.append((name, asyncio.create_task(run_as_leader(name, job))))
+
+async def stop_leader_jobs():
+    for name, task in _leader_tasks:
+        task.cancel()
+        try:
+            await release_lease(name)
+        except Exception as e:
+            logger.error(f"Error releasing lease {name}: {e}")
+    _leader_tasks.clear()
+
+# ===================== PENDING TRANSACTION POLLER =====================
+
+EXPIRATION_MINUTES = int(os.environ.get('PIX_EXPIRATION_MINUTES', '20'))  # Tempo limite para pagamento PIX
+EXPIRATION_CHECK_SECONDS = 5
+
+# Intervalo entre consultas conforme a idade da cobrança: PIX costuma ser pago nos
+# primeiros minutos, então consultamos com frequência no início e espaçamos depois.
+POLL_BACKOFF_SCHEDULE = [
+    (120, 3),    # até 2 min: a cada 3s
+    (300, 10),   # até 5 min: a cada 10s
+    (600, 20),   # até 10 min: a cada 20s
+    (None, 30),  # depois: a cada 30s até expirar
+]
+POLL_TICK_SECONDS = float(os.environ.get('POLL_TICK_SECONDS', '1'))
+POLL_CONCURRENCY = int(os.environ.get('POLL_CONCURRENCY', '10'))
+POLL_DISCOVERY_SECONDS = float(os.environ.get('POLL_DISCOVERY_SECONDS', '15'))
+# Descoberta incremental: só as pendentes criadas desde a última passada (menos uma folga que cobre
+# diferença de relógio entre workers e QRs obtidos em background), lidas em lotes de
+# POLL_DISCOVERY_BATCH; as já agendadas são conferidas por id, também em lotes.
+POLL_DISCOVERY_OVERLAP_SECONDS = float(os.environ.get('POLL_DISCOVERY_OVERLAP_SECONDS', '300'))
+POLL_DISCOVERY_BATCH = 500
+_poll_discovery = {"since": None}
+
+# Heap (próxima_consulta, transaction_id) + dados mínimos de cada cobrança agendada.
+# Entradas do heap cujo id não está mais em _poll_entries são descartadas ao sair.
+_poll_heap = []
+_poll_entries = {}
+poller_stats = {
+    "agendadas": 0, "consultas": 0, "pagas": 0, "erros": 0, "expiradas": 0,
+    "em_andamento": 0, "varreduras": 0, "varreduras_com_erro": 0, "ultima_varredura_ms": 0.0,
+    "max_varredura_ms": 0.0, "webhooks_perdidos": 0
+}
+# Limite global de consultas simultâneas ao provedor, compartilhado por todas as varreduras
+_poll_semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+_poll_sweeps = set()
+POLLER_JOB = "pending_transactions_poller"
+
+# Modo webhook-first: enquanto os webhooks de uma configuração de rede estão chegando, o poller
+# vira rede de segurança e só consulta, espaçadas, as cobranças sem evento há mais de
+# WEBHOOK_FIRST_GRACE_MINUTES. Se os webhooks param (nenhum evento na janela) ou o poller encontra
+# um pagamento que o webhook não entregou, a configuração volta na hora para a agenda normal.
+WEBHOOK_FIRST_MODE = os.environ.get('WEBHOOK_FIRST_MODE', 'true').lower() == 'true'
+WEBHOOK_HEALTHY_WINDOW_MINUTES = float(os.environ.get('WEBHOOK_HEALTHY_WINDOW_MINUTES', '10'))
+WEBHOOK_FIRST_GRACE_MINUTES = float(os.environ.get('WEBHOOK_FIRST_GRACE_MINUTES', '3'))
+WEBHOOK_FIRST_POLL_SECONDS = float(os.environ.get('WEBHOOK_FIRST_POLL_SECONDS', '120'))
+
+# Cópia local da coleção webhook_health (recarregada a cada descoberta: a inbox pode rodar em outro worker)
+_webhook_health = {}
+_webhook_config_admins = set()
+_webhook_first_keys = set()
+
+def _parse_created_at(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def _next_poll_delay(created_at: Optional[datetime]) -> float:
+    age = (datetime.now(timezone.utc) - created_at).total_seconds() if created_at else 0
+    for limit, delay in POLL_BACKOFF_SCHEDULE:
+        if limit is None or age < limit:
+            return delay
+
+def webhook_config_key(network_admin_id: Optional[str]) -> str:
+    """Configuração FastDePix que atende a rede: a do admin, se tiver webhook próprio, ou a do sistema"""
+    return network_admin_id if network_admin_id in _webhook_config_admins else "system"
+
+def webhook_healthy(config_key: str) -> bool:
+    if not WEBHOOK_FIRST_MODE:
+        return False
+    health = _webhook_health.get(config_key)
+    if not health or not health.get("last_event_at"):
+        return False
+    now = datetime.now(timezone.utc)
+    window = timedelta(minutes=WEBHOOK_HEALTHY_WINDOW_MINUTES)
+    if now - health["last_event_at"] > window:
+        return False
+    missed_at = health.get("last_missed_at")
+    return not (missed_at and now - missed_at < window)
+
+async def load_webhook_health() -> set:
+    """Recarrega a saúde dos webhooks. Retorna as configurações que deixaram de estar saudáveis"""
+    admin_configs = await db.admin_configs.find(
+        {"fastdepix_webhook_secret": {"$nin": [None, ""]}},
+        {"_id": 0, "admin_id": 1}
+    ).to_list(None)
+    _webhook_config_admins.clear()
+    _webhook_config_admins.update(c["admin_id"] for c in admin_configs)
+    
+    # Os documentos são por rede (_id = network_admin_id ou "system"), gravados pela inbox sem
+    # conhecer as configurações; aqui cada rede é agregada na configuração que a atende
+    docs = await db.webhook_health.find({}).to_list(None)
+    _webhook_health.clear()
+    for doc in docs:
+        key = webhook_config_key(None if doc["_id"] == "system" else doc["_id"])
+        health = _webhook_health.setdefault(key, {"last_event_at": None, "last_missed_at": None, "events": 0})
+        for field in ("last_event_at", "last_missed_at"):
+            value = _parse_created_at(doc.get(field))
+            if value and (health[field] is None or value > health[field]):
+                health[field] = value
+        health["events"] += doc.get("events", 0)
+    
+    healthy = {key for key in _webhook_health if webhook_healthy(key)}
+    degraded = _webhook_first_keys - healthy
+    _webhook_first_keys.clear()
+    _webhook_first_keys.update(healthy)
+    return degraded
+
+async def record_webhook_events(network_admin_ids: list):
+    """Marca a chegada de eventos para as redes informadas (uma escrita por rede).
+    Roda no worker da inbox: o mapeamento rede -> configuração fica com o poller (load_webhook_health)"""
+    counts = {}
+    for network_admin_id in network_admin_ids:
+        key = network_admin_id or "system"
+        counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    await db.webhook_health.bulk_write([
+        UpdateOne({"_id": key}, {"$set": {"last_event_at": now}, "$inc": {"events": count}}, upsert=True)
+        for key, count in counts.items()
+    ], ordered=False)
+
+async def record_webhook_miss(config_key: str):
+    """O poller achou um pagamento que o webhook não entregou: volta a configuração para a agenda normal"""
+    now = datetime.now(timezone.utc)
+    await db.webhook_health.update_one(
+        {"_id": config_key},
+        {"$set": {"last_missed_at": now.isoformat()}, "$inc": {"misses": 1}},
+        upsert=True
+    )
+    # config_key é o id da rede dona da configuração ("system" para a configuração global)
+    _webhook_health.setdefault(config_key, {})["last_missed_at"] = now
+    _webhook_first_keys.discard(config_key)
+    poller_stats["webhooks_perdidos"] += 1
+    resume_full_polling({config_key})
+
+def _poll_delay(entry: dict) -> float:
+    """Atraso até a próxima consulta: agenda normal, ou rede de segurança se os webhooks estão chegando"""
+    delay = _next_poll_delay(entry["created_at"])
+    if not webhook_healthy(webhook_config_key(entry.get("network_admin_id"))):
+        return delay
+    created_at = entry["created_at"]
+    age = (datetime.now(timezone.utc) - created_at).total_seconds() if created_at else 0
+    grace = WEBHOOK_FIRST_GRACE_MINUTES * 60
+    if age < grace:
+        return max(delay, grace - age)
+    return max(delay, WEBHOOK_FIRST_POLL_SECONDS)
+
+def _push_poll(tx_id: str, delay: float):
+    # "due" identifica a entrada válida do heap: reagendar deixa a anterior órfã
+    due = time.monotonic() + delay
+    _poll_entries[tx_id]["due"] = due
+    heapq.heappush(_poll_heap, (due, tx_id))
+
+def resume_full_polling(config_keys: set):
+    """Reagenda na agenda normal as cobranças das configurações cujos webhooks pararam"""
+    if not config_keys:
+        return
+    for tx_id, entry in _poll_entries.items():
+        if webhook_config_key(entry.get("network_admin_id")) in config_keys:
+            _push_poll(tx_id, _next_poll_delay(entry["created_at"]))
+
+def schedule_transaction_poll(transaction: dict, delay: float = None):
+    """Agenda a consulta ao provedor de uma cobrança pendente (idempotente)"""
+    # Só o worker dono do poller mantém agenda; os demais são cobertos pela descoberta periódica
+    if not is_leader(POLLER_JOB):
+        return
+    if not transaction.get("fastdepix_id") or transaction.get("status", "pending") != "pending":
+        return
+    tx_id = transaction["id"]
+    if tx_id in _poll_entries:
+        return
+    try:
+        created_at = _parse_created_at(transaction.get("created_at"))
+    except ValueError:
+        created_at = None
+    entry = _poll_entries[tx_id] = {
+        "fastdepix_id": transaction["fastdepix_id"],
+        "network_admin_id": transaction.get("network_admin_id"),
+        "created_at": created_at,
+        "polls": transaction.get("poll_count", 0)
+    }
+    if delay is None:
+        delay = _poll_delay(entry)
+    _push_poll(tx_id, delay)
+    poller_stats["agendadas"] = len(_poll_entries)
+
+def unschedule_transaction_poll(transaction_id: str):
+    _poll_entries.pop(transaction_id, None)
+    poller_stats["agendadas"] = len(_poll_entries)
+
+async def refresh_poll_schedule():
+    """Sincroniza a agenda com as pendentes do banco (novas de outros workers, pagas via webhook, expiradas)"""
+    resume_full_polling(await load_webhook_health())
+    
+    # Já agendadas que deixaram de estar pendentes (pagas via webhook em outro worker, expiradas)
+    scheduled_ids = list(_poll_entries)
+    for i in range(0, len(scheduled_ids), POLL_DISCOVERY_BATCH):
+        batch = scheduled_ids[i:i + POLL_DISCOVERY_BATCH]
+        still_pending = {
+            tx["id"] async for tx in db.transactions.find(
+                {"id": {"$in": batch}, "status": "pending"}, {"_id": 0, "id": 1}
+            )
+        }
+        for tx_id in batch:
+            if tx_id not in still_pending:
+                _poll_entries.pop(tx_id, None)
+    
+    # Novas pendentes pelo índice (status, created_at); na primeira passada após assumir o lease, todas
+    started_at = datetime.now(timezone.utc)
+    query = {"status": "pending", "fastdepix_id": {"$ne": None}}
+    if _poll_discovery["since"]:
+        since = _poll_discovery["since"] - timedelta(seconds=POLL_DISCOVERY_OVERLAP_SECONDS)
+        query["created_at"] = {"$gte": since.isoformat()}
+    cursor = db.transactions.find(
+        query,
+        {"_id": 0, "id": 1, "fastdepix_id": 1, "network_admin_id": 1, "created_at": 1, "poll_count": 1}
+    ).sort("created_at", 1)
+    while True:
+        page = await cursor.to_list(POLL_DISCOVERY_BATCH)
+        if not page:
+            break
+        for tx in page:
+            schedule_transaction_poll(tx)
+    _poll_discovery["since"] = started_at
+    
+    # Reconstrói o heap quando há muitas entradas órfãs
+    if len(_poll_heap) > 2 * len(_poll_entries) + 100:
+        _poll_heap[:] = [item for item in _poll_heap if item[1] in _poll_entries]
+        heapq.heapify(_poll_heap)
+    poller_stats["agendadas"] = len(_poll_entries)
+
+def _pop_due_polls() -> list:
+    now = time.monotonic()
+    due = []
+    while _poll_heap and _poll_heap[0][0] <= now:
+        due_time, tx_id = heapq.heappop(_poll_heap)
+        entry = _poll_entries.get(tx_id)
+        if entry and entry.get("due") == due_time:
+            entry["due"] = None
+            due.append(tx_id)
+    return due
+
+async def _poll_transaction(tx_id: str, api_key: str, config: dict) -> bool:
+    """Consulta o status de uma cobrança no provedor e liquida assim que o resultado chega.
+    Retorna True se foi paga"""
+    entry = _poll_entries.get(tx_id)
+    if not entry:
+        return False
+    async with _poll_semaphore:
+        entry["polls"] += 1
+        poller_stats["consultas"] += 1
+        poller_stats["em_andamento"] += 1
+        try:
+            response = await fastdepix_request(
+                "GET",
+                f"/transactions/{entry['fastdepix_id']}",
+                api_key,
+                timeout=10.0,
+                retries=0
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("success"):
+                    tx_data = result.get("data", {})
+                    if tx_data.get("status") == "paid":
+                        unschedule_transaction_poll(tx_id)
+                        if await settle_transaction(tx_id, config, "poller"):
+                            poller_stats["pagas"] += 1
+                            # Em modo rede de segurança, achar o pagamento antes do webhook é sinal de falha na entrega
+                            config_key = webhook_config_key(entry.get("network_admin_id"))
+                            if config_key in _webhook_first_keys:
+                                await record_webhook_miss(config_key)
+                        return True
+        except Exception as e:
+            poller_stats["erros"] += 1
+            logger.error(f"Error checking transaction {tx_id}: {e}")
+        finally:
+            poller_stats["em_andamento"] -= 1
+    
+    if tx_id in _poll_entries and not _poll_entries[tx_id].get("due"):
+        _push_poll(tx_id, _poll_delay(entry))
+    return False
+
+async def _run_poll_sweep(due: list, api_key: str, config: dict):
+    """Consulta um lote de cobranças vencidas em paralelo (limitado por _poll_semaphore)"""
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(_poll_transaction(tx_id, api_key, config) for tx_id in due))
+        
+        # Persiste a contagem de consultas em um único round trip
+        polled_at = datetime.now(timezone.utc).isoformat()
+        await db.transactions.bulk_write([
+            UpdateOne({"id": tx_id}, {"$inc": {"poll_count": 1}, "$set": {"last_polled_at": polled_at}})
+            for tx_id in due
+        ], ordered=False)
+    except Exception:
+        # Disparada sem await: sem isso o erro só apareceria como "exception was never retrieved"
+        poller_stats["varreduras_com_erro"] += 1
+        logger.exception(f"Error in poll sweep of {len(due)} transactions")
+    finally:
+        duration_ms = (time.monotonic() - started) * 1000
+        poller_stats["varreduras"] += 1
+        poller_stats["ultima_varredura_ms"] = round(duration_ms, 1)
+        poller_stats["max_varredura_ms"] = round(max(poller_stats["max_varredura_ms"], duration_ms), 1)
+
+def _take_due_polls() -> list:
+    # Circuito aberto: as consultas ficam vencidas na agenda até o provedor voltar
+    if not fastdepix_available():
+        return []
+    return _pop_due_polls()
+
+async def poll_due_transactions(api_key: str, config: dict) -> int:
+    """Consulta apenas as cobranças vencidas na agenda e espera o lote terminar"""
+    due = _take_due_polls()
+    if due:
+        await _run_poll_sweep(due, api_key, config)
+    return len(due)
+
+def start_poll_sweep(api_key: str, config: dict) -> int:
+    """Dispara a varredura das vencidas sem esperar: uma varredura lenta não atrasa o próximo tick.
+    Cobranças em consulta não estão no heap, então não são disparadas duas vezes."""
+    due = _take_due_polls()
+    if due:
+        # spawn_background mantém a referência; _poll_sweeps é o que se cancela ao perder o lease
+        task = spawn_background(_run_poll_sweep(due, api_key, config))
+        _poll_sweeps.add(task)
+        task.add_done_callback(_poll_sweeps.discard)
+    return len(due)
+
+async def expire_pending_transactions():
+    """Expira de uma vez (update_many indexado) as pendentes com mais de EXPIRATION_MINUTES"""
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(minutes=EXPIRATION_MINUTES)
+    result = await db.transactions.update_many(
+        {"status": "pending", "created_at": {"$lt": cutoff.isoformat()}},
+        {"$set": {"status": "expired", "expired_at": now.isoformat()}}
+    )
+    expired_count = result.modified_count
+    
+    # expired_at identifica este lote: avisa os integradores das transações que acabaram de expirar
+    if expired_count:
+        expired_api_txs = await db.transactions.find(
+            {"status": "expired", "expired_at": now.isoformat(), "api_key_id": {"$ne": None}},
+            {"_id": 0}
+        ).to_list(None)
+        await enqueue_merchant_events("transaction.expired", expired_api_txs)
+    
+    # Remove da agenda do poller as que acabaram de expirar
+    for tx_id, entry in list(_poll_entries.items()):
+        if entry["created_at"] and entry["created_at"] < cutoff:
+            unschedule_transaction_poll(tx_id)
+    
+    if expired_count > 0:
+        logger.info(f"Expired {expired_count} pending transactions older than {EXPIRATION_MINUTES} min")
+    poller_stats["expiradas"] += expired_count
+    return expired_count
 
 async def check_pending_transactions():
-    """Job de background que verifica transações pendentes a cada 5 segundos"""
-    EXPIRATION_MINUTES = 20  # Tempo limite para pagamento PIX
+    """Job de background: expira pendentes e consulta o provedor conforme a agenda"""
+    # Agenda começa vazia a cada posse do lease; a descoberta repopula no primeiro tick
+    _poll_heap.clear()
+    _poll_entries.clear()
+    _poll_discovery["since"] = None
+    try:
+        await _pending_transactions_loop()
+    finally:
+        # Perdeu o lease (ou shutdown): interrompe as varreduras em andamento
+        for task in list(_poll_sweeps):
+            task.cancel()
+
+async def _pending_transactions_loop():
+    last_expiration = 0.0
+    last_discovery = 0.0
     
     while True:
         try:
-            config = await get_config()
-            api_key = config.get("fastdepix_api_key")
-            
-            # 1. EXPIRAR transações pendentes com mais de 20 minutos
-            # Busca todas as transações pendentes e verifica manualmente (mais robusto)
-            now = datetime.now(timezone.utc)
-            pending_txs_to_expire = await db.transactions.find({
-                "status": "pending"
-            }).to_list(500)
-            
-            expired_count = 0
-            for tx in pending_txs_to_expire:
-                created_at_str = tx.get("created_at")
-                if created_at_str:
-                    try:
-                        # Tenta parsear o datetime
-                        if isinstance(created_at_str, str):
-                            # Remove timezone info se existir e adiciona UTC
-                            created_at_str = created_at_str.replace("Z", "+00:00")
-                            if "+" not in created_at_str and created_at_str.endswith("00:00"):
-                                created_at = datetime.fromisoformat(created_at_str)
-                            else:
-                                created_at = datetime.fromisoformat(created_at_str)
-                            if created_at.tzinfo is None:
-                                created_at = created_at.replace(tzinfo=timezone.utc)
-                        else:
-                            created_at = created_at_str
-                            if created_at.tzinfo is None:
-                                created_at = created_at.replace(tzinfo=timezone.utc)
-                        
-                        # Verifica se passou mais de 20 minutos
-                        age_minutes = (now - created_at).total_seconds() / 60
-                        if age_minutes >= EXPIRATION_MINUTES:
-                            await db.transactions.update_one(
-                                {"id": tx["id"]},
-                                {"$set": {
-                                    "status": "expired",
-                                    "expired_at": now.isoformat()
-                                }}
-                            )
-                            expired_count += 1
-                            logger.info(f"Expired transaction {tx['id']} (age: {age_minutes:.1f} min)")
-                    except Exception as parse_error:
-                        logger.error(f"Error parsing date for tx {tx.get('id')}: {parse_error}")
+            now = time.monotonic()
+            if now - last_expiration >= EXPIRATION_CHECK_SECONDS:
+                last_expiration = now
+                await expire_pending_transactions()
             
-            if expired_count > 0:
-                logger.info(f"Total expired transactions: {expired_count}")
+            if now - last_discovery >= POLL_DISCOVERY_SECONDS:
+                last_discovery = now
+                await refresh_poll_schedule()
             
-            # 2. Verificar pagamentos via FastDePix API
+            config = await get_config()
+            api_key = config.get("fastdepix_api_key")
             if api_key:
-                # Busca transações pendentes com ID do FastDePix
-                pending_txs = await db.transactions.find({
-                    "status": "pending",
-                    "fastdepix_id": {"$ne": None}
-                }).to_list(100)
-                
-                for tx in pending_txs:
-                    try:
-                        async with httpx.AsyncClient() as client_http:
-                            response = await client_http.get(
-                                f"https://fastdepix.space/api/v1/transactions/{tx['fastdepix_id']}",
-                                headers={
-                                    "Authorization": f"Bearer {api_key}",
-                                    "Content-Type": "application/json"
-                                },
-                                timeout=10.0
-                            )
-                            
-                            if response.status_code == 200:
-                                result = response.json()
-                                if result.get("success"):
-                                    tx_data = result.get("data", {})
-                                    if tx_data.get("status") == "paid":
-                                        await process_paid_transaction(tx, config)
-                    except Exception as e:
-                        logger.error(f"Error checking transaction {tx['id']}: {e}")
+                start_poll_sweep(api_key, config)
         except Exception as e:
             logger.error(f"Error in background polling: {e}")
         
-        await asyncio.sleep(5)  # Espera 5 segundos
+        await asyncio.sleep(POLL_TICK_SECONDS)
+
+# ===================== PROVIDER RECONCILIATION =====================
+
+# Conferência periódica com o FastDePix das transações dos últimos RECONCILE_LOOKBACK_HOURS:
+# pagamentos que chegaram depois de expirar ou cujo webhook se perdeu são liquidados pelo
+# caminho normal; divergências que não dá para corrigir automaticamente vão para o relatório.
+# Só as não finais (pending/expired) são conferidas todas, pelo índice (status, created_at);
+# das já pagas vai uma amostra de RECONCILE_PAID_SAMPLE por execução.
+# Para rodar contra um stub local, aponte FASTDEPIX_BASE_URL para ele.
+RECONCILE_JOB = "provider_reconciliation"
+RECONCILE_INTERVAL_MINUTES = float(os.environ.get('RECONCILE_INTERVAL_MINUTES', '60'))
+RECONCILE_LOOKBACK_HOURS = float(os.environ.get('RECONCILE_LOOKBACK_HOURS', '48'))
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '20'))
+RECONCILE_PAID_SAMPLE = int(os.environ.get('RECONCILE_PAID_SAMPLE', '200'))
+RECONCILE_PAGE_SIZE = 500
+RECONCILE_MAX_REPORTED_ITEMS = 200
+RECONCILE_COUNTERS = ("conferidas", "corrigidas", "divergentes", "erros")
+RECONCILE_NO_NETWORK = "sem_rede"
+
+async def reconcile_with_provider(
+    api_key: str,
+    config: dict,
+    lookback_hours: float = None,
+    trigger: str = "job",
+    report_id: str = None,
+    scope_admin_ids: list = None
+) -> dict:
+    """Confere as transações recentes com o provedor e grava um relatório em db.reconciliation_reports.
+    
+    O relatório é gravado como "running" no início e atualizado ao final. Com scope_admin_ids,
+    só as transações dessas redes são conferidas.
+    """
+    lookback_hours = lookback_hours or RECONCILE_LOOKBACK_HOURS
+    started_at = datetime.now(timezone.utc)
+    started = time.monotonic()
+    report = {
+        "id": report_id or str(uuid.uuid4()),
+        "trigger": trigger,
+        "status": "running",
+        "escopo": scope_admin_ids,
+        "started_at": started_at.isoformat(),
+        "lookback_hours": lookback_hours,
+        **{counter: 0 for counter in RECONCILE_COUNTERS},
+        "status_provedor": {},
+        "redes": {},
+        "correcoes": [],
+        "divergencias": []
+    }
+    await db.reconciliation_reports.insert_one(dict(report))
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    
+    async def fetch(tx: dict):
+        async with semaphore:
+            try:
+                response = await fastdepix_request("GET", f"/transactions/{tx['fastdepix_id']}", api_key, timeout=10.0)
+                if response.status_code == 200:
+                    result = response.json()
+                    if result.get("success"):
+                        return result.get("data", {}).get("status")
+                return None
+            except ProviderUnavailable:
+                raise
+            except Exception as e:
+                logger.error(f"Reconciliation error for {tx['id']}: {e}")
+                return None
+    
+    def count(tx: dict, counter: str):
+        # Totais gerais e por rede, para que cada admin veja só a parte da sua rede
+        report[counter] += 1
+        network = report["redes"].setdefault(
+            tx.get("network_admin_id") or RECONCILE_NO_NETWORK,
+            {**{c: 0 for c in RECONCILE_COUNTERS}, "status_provedor": {}}
+        )
+        network[counter] += 1
+        return network
+    
+    def note(kind: str, tx: dict, provider_status: str):
+        items = report[kind]
+        if len(items) < RECONCILE_MAX_REPORTED_ITEMS:
+            items.append({
+                "transaction_id": tx["id"],
+                "network_admin_id": tx.get("network_admin_id"),
+                "local": tx["status"],
+                "provedor": provider_status
+            })
+    
+    checked = set()
+    
+    async def check(page: list):
+        page = [tx for tx in page if tx.get("fastdepix_id") and tx["id"] not in checked]
+        checked.update(tx["id"] for tx in page)
+        provider_statuses = await asyncio.gather(*(fetch(tx) for tx in page))
+        
+        # Diff em memória; correções passam pela liquidação normal (idempotente)
+        for tx, provider_status in zip(page, provider_statuses):
+            network = count(tx, "conferidas")
+            if provider_status is None:
+                count(tx, "erros")
+                continue
+            for totals in (report, network):
+                totals["status_provedor"][provider_status] = totals["status_provedor"].get(provider_status, 0) + 1
+            if provider_status == "paid" and tx["status"] in ("pending", "expired"):
+                if await settle_transaction(tx["id"], config, "reconciliation", claim_statuses=("pending", "expired")):
+                    count(tx, "corrigidas")
+                    note("correcoes", tx, provider_status)
+            elif tx["status"] == "paid" and provider_status != "paid":
+                count(tx, "divergentes")
+                note("divergencias", tx, provider_status)
+    
+    since = (started_at - timedelta(hours=lookback_hours)).isoformat()
+    scope = {"network_admin_id": {"$in": scope_admin_ids}} if scope_admin_ids else {}
+    projection = {"_id": 0, "id": 1, "fastdepix_id": 1, "status": 1, "network_admin_id": 1}
+    cursor = db.transactions.find(
+        {"status": {"$in": ["pending", "expired"]}, "created_at": {"$gte": since}, **scope},
+        projection
+    )
+    try:
+        while True:
+            page = await cursor.to_list(RECONCILE_PAGE_SIZE)
+            if not page:
+                break
+            await check(page)
+        
+        if RECONCILE_PAID_SAMPLE > 0:
+            paid_sample = await db.transactions.aggregate([
+                {"$match": {"status": "paid", "created_at": {"$gte": since}, **scope}},
+                {"$sample": {"size": RECONCILE_PAID_SAMPLE}},
+                {"$project": projection}
+            ]).to_list(RECONCILE_PAID_SAMPLE)
+            # As liquidadas agora pela própria conferência já foram vistas acima
+            await check(paid_sample)
+        report["status"] = "completed"
+    except ProviderUnavailable as e:
+        report["status"] = "aborted"
+        report["erro"] = str(e)
+    except Exception as e:
+        report["status"] = "failed"
+        report["erro"] = str(e)
+        logger.exception(f"Reconciliation {report['id']} failed")
+    
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+    report["duracao_ms"] = round((time.monotonic() - started) * 1000, 1)
+    await db.reconciliation_reports.update_one(
+        {"id": report["id"]},
+        {"$set": {k: v for k, v in report.items() if k != "id"}}
+    )
+    logger.info(
+        f"Reconciliation {report['status']}: {report['conferidas']} checked, "
+        f"{report['corrigidas']} corrected, {report['divergentes']} mismatched in {report['duracao_ms']} ms"
+    )
+    return report
+
+async def run_reconciliation_job():
+    """Job de background que roda a reconciliação a cada RECONCILE_INTERVAL_MINUTES"""
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_MINUTES * 60)
+        try:
+            config = await get_config()
+            api_key = config.get("fastdepix_api_key")
+            if api_key:
+                await reconcile_with_provider(api_key, config)
+        except Exception as e:
+            logger.error(f"Error in provider reconciliation: {e}")
 
 @app.on_event("startup")
 async def startup():
     await init_admin()
-    # Inicia o job de polling em background
-    asyncio.create_task(check_pending_transactions())
+    await ensure_indexes()
+    await backfill_user_ancestry()
+    await backfill_network_admin_ids()
+    await ensure_deposit_counters()
+    get_fastdepix_client()
+    # Inicia o job de polling em background (apenas no worker que detém o lease)
+    start_leader_job(POLLER_JOB, check_pending_transactions)
+    start_leader_job(WEBHOOK_INBOX_JOB, process_webhook_inbox)
+    start_leader_job(MERCHANT_WEBHOOK_JOB, process_merchant_webhooks)
+    start_leader_job(RECONCILE_JOB, run_reconciliation_job)
     logger.info("Background payment polling started")
 
 # ===================== AUTH ROUTES =====================
@@ -590,6 +2418,7 @@ async def register(data: UserCreate):
             raise HTTPException(status_code=400, detail="Indicador não tem indicações disponíveis")
     
     config = await get_config()
+    ancestry = await build_user_ancestry(indicador)
     
     new_user = {
         "id": str(uuid.uuid4()),
@@ -597,7 +2426,7 @@ async def register(data: UserCreate):
         "carteira_id": generate_wallet_id(),
         "nome": data.nome,
         "email": data.email,
-        "senha": hash_password(data.senha),
+        "senha": await hash_password_async(data.senha),
         "role": "user",
         "status": "active",
         "saldo_disponivel": 0.0,
@@ -610,6 +2439,8 @@ async def register(data: UserCreate):
         "taxa_saque": config.get("taxa_saque_padrao", 1.5),
         "taxa_transferencia": config.get("taxa_transferencia_padrao", 0.5),
         "indicador_id": indicador["id"],
+        "ancestor_ids": ancestry["ancestor_ids"],
+        "network_admin_id": ancestry["network_admin_id"],
         "pagina_personalizada": {"titulo": data.nome, "cor_primaria": "#22c55e"},
         "two_factor_enabled": False,
         "two_factor_secret": None,
@@ -618,12 +2449,14 @@ async def register(data: UserCreate):
     }
     
     await db.users.insert_one(new_user)
+    await invalidate_network_cache(*new_user["ancestor_ids"])
     
     if indicador and indicador.get("role") != "admin":
         await db.users.update_one(
             {"id": indicador["id"]},
             {"$inc": {"indicacoes_usadas": 1}}
         )
+        invalidate_user_cache(indicador["id"])
         
         await db.referrals.insert_one({
             "id": str(uuid.uuid4()),
@@ -641,7 +2474,7 @@ async def register(data: UserCreate):
 @api_router.post("/auth/login")
 async def login(data: UserLogin):
     user = await db.users.find_one({"codigo": data.codigo}, {"_id": 0})
-    if not user or not verify_password(data.senha, user["senha"]):
+    if not user or not await verify_password_async(data.senha, user["senha"]):
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
     
     if user.get("status") == "blocked":
@@ -661,10 +2494,10 @@ async def login(data: UserLogin):
 
 @api_router.get("/auth/me")
 async def get_me(user: dict = Depends(get_current_user)):
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0, "senha": 0})
+    user_data = public_user(user)
     
-    # Recalcula saldo real
-    balance = await recalculate_user_balance(user["id"])
+    # Saldo real (ledger)
+    balance = await get_user_balance(user["id"])
     user_data["saldo_disponivel"] = balance["saldo_disponivel"]
     user_data["saldo_comissoes"] = balance["saldo_comissoes"]
     
@@ -676,6 +2509,7 @@ async def update_me(data: UserUpdate, user: dict = Depends(get_current_user)):
     if update_data:
         update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
         await db.users.update_one({"id": user["id"]}, {"$set": update_data})
+        invalidate_user_cache(user["id"])
     
     updated = await db.users.find_one({"id": user["id"]}, {"_id": 0, "senha": 0})
     return updated
@@ -683,13 +2517,14 @@ async def update_me(data: UserUpdate, user: dict = Depends(get_current_user)):
 @api_router.put("/auth/password")
 async def change_password(current_password: str, new_password: str, user: dict = Depends(get_current_user)):
     full_user = await db.users.find_one({"id": user["id"]})
-    if not verify_password(current_password, full_user["senha"]):
+    if not await verify_password_async(current_password, full_user["senha"]):
         raise HTTPException(status_code=400, detail="Senha atual incorreta")
     
     await db.users.update_one(
         {"id": user["id"]},
-        {"$set": {"senha": hash_password(new_password), "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"senha": await hash_password_async(new_password), "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    invalidate_user_cache(user["id"])
     return {"message": "Senha alterada com sucesso"}
 
 @api_router.post("/auth/saw-code-warning")
@@ -699,6 +2534,7 @@ async def mark_code_warning_seen(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"saw_code_warning": True}}
     )
+    invalidate_user_cache(user["id"])
     return {"success": True}
 
 # ===================== ADMIN CREDENTIALS =====================
@@ -706,7 +2542,7 @@ async def mark_code_warning_seen(user: dict = Depends(get_current_user)):
 @api_router.put("/admin/credentials")
 async def update_admin_credentials(data: AdminCredentialsUpdate, admin: dict = Depends(get_admin_user)):
     full_admin = await db.users.find_one({"id": admin["id"]})
-    if not verify_password(data.senha_atual, full_admin["senha"]):
+    if not await verify_password_async(data.senha_atual, full_admin["senha"]):
         raise HTTPException(status_code=400, detail="Senha atual incorreta")
     
     update_fields = {"updated_at": datetime.now(timezone.utc).isoformat()}
@@ -718,9 +2554,10 @@ async def update_admin_credentials(data: AdminCredentialsUpdate, admin: dict = D
         update_fields["codigo"] = data.codigo
     
     if data.senha_nova:
-        update_fields["senha"] = hash_password(data.senha_nova)
+        update_fields["senha"] = await hash_password_async(data.senha_nova)
     
     await db.users.update_one({"id": admin["id"]}, {"$set": update_fields})
+    invalidate_user_cache(admin["id"])
     
     updated = await db.users.find_one({"id": admin["id"]}, {"_id": 0, "senha": 0})
     return updated
@@ -747,6 +2584,7 @@ async def setup_2fa(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"two_factor_secret": secret}}
     )
+    invalidate_user_cache(user["id"])
     
     return {
         "secret": secret,
@@ -771,6 +2609,7 @@ async def verify_2fa(data: TwoFactorVerify, user: dict = Depends(get_current_use
         {"id": user["id"]},
         {"$set": {"two_factor_enabled": True}}
     )
+    invalidate_user_cache(user["id"])
     
     return {"message": "2FA ativado com sucesso"}
 
@@ -792,12 +2631,13 @@ async def disable_2fa(data: TwoFactorVerify, user: dict = Depends(get_current_us
         {"id": user["id"]},
         {"$set": {"two_factor_enabled": False, "two_factor_secret": None}}
     )
+    invalidate_user_cache(user["id"])
     
     return {"message": "2FA desativado com sucesso"}
 
 @api_router.get("/auth/2fa/status")
 async def get_2fa_status(user: dict = Depends(get_current_user)):
-    full_user = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    full_user = user
     return {
         "enabled": full_user.get("two_factor_enabled", False)
     }
@@ -813,7 +2653,7 @@ async def login_with_2fa(data: UserLoginWith2FA):
     import pyotp
     
     user = await db.users.find_one({"codigo": data.codigo}, {"_id": 0})
-    if not user or not verify_password(data.senha, user["senha"]):
+    if not user or not await verify_password_async(data.senha, user["senha"]):
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
     
     if user.get("status") == "blocked":
@@ -836,72 +2676,48 @@ async def login_with_2fa(data: UserLoginWith2FA):
         if not totp.verify(data.two_factor_code):
             raise HTTPException(status_code=401, detail="Código 2FA inválido")
     
-    token = create_access_token({"sub": user["id"]})
-    del user["senha"]
-    if "two_factor_secret" in user:
-        del user["two_factor_secret"]
-    
-    return {"user": user, "token": token}
-
-# ===================== DASHBOARD ROUTES =====================
-
-async def recalculate_user_balance(user_id: str):
-    """Recalcula o saldo do usuário baseado apenas em transações PAGAS"""
-    # Transações pagas que creditam saldo (exclui transfer_out pois já é tratado em transferências)
-    paid_transactions = await db.transactions.find({
-        "parceiro_id": user_id,
-        "status": "paid",
-        "tipo": {"$nin": ["transfer_out", "transfer_in"]}  # Transferências são tratadas separadamente
-    }).to_list(10000)
-    # Usa valor_liquido se existir e for positivo, senão usa valor bruto
-    total_recebido = sum(
-        t.get("valor_liquido") if t.get("valor_liquido") and t.get("valor_liquido") > 0 
-        else t.get("valor", 0) 
-        for t in paid_transactions
-    )
-    
-    # Saques aprovados (debitam saldo)
-    approved_withdrawals = await db.withdrawals.find({
-        "parceiro_id": user_id,
-        "status": "approved"
-    }).to_list(10000)
-    total_sacado = sum(w.get("valor_total_retido", w.get("valor_solicitado", 0)) for w in approved_withdrawals)
-    
-    # Saques pendentes também debitam (saldo já foi retido)
-    pending_withdrawals = await db.withdrawals.find({
-        "parceiro_id": user_id,
-        "status": "pending"
-    }).to_list(10000)
-    total_pendente_saque = sum(w.get("valor_total_retido", w.get("valor_solicitado", 0)) for w in pending_withdrawals)
-    
-    # Transferências enviadas (debitam saldo)
-    sent_transfers = await db.transfers.find({
-        "remetente_id": user_id
-    }).to_list(10000)
-    total_enviado = sum(t.get("valor", 0) for t in sent_transfers)
-    
-    # Transferências recebidas (creditam saldo)
-    received_transfers = await db.transfers.find({
-        "destinatario_id": user_id
-    }).to_list(10000)
-    total_recebido_transferencia = sum(t.get("valor_recebido", t.get("valor", 0)) for t in received_transfers)
-    
-    # Comissões recebidas
-    commissions = await db.commissions.find({
-        "indicador_id": user_id,
-        "status": "credited"
-    }).to_list(10000)
-    total_comissoes = sum(c.get("valor_comissao", 0) for c in commissions)
+    token = create_access_token({"sub": user["id"]})
+    del user["senha"]
+    if "two_factor_secret" in user:
+        del user["two_factor_secret"]
     
-    # Saques automáticos de comissão já deduzidos
-    auto_withdrawals = await db.withdrawals.find({
-        "parceiro_id": user_id,
-        "auto_withdrawal": True
-    }).to_list(10000)
-    total_auto_sacado = sum(w.get("valor_total_retido", 0) for w in auto_withdrawals)
+    return {"user": user, "token": token}
+
+# ===================== BALANCE LEDGER =====================
+
+# Totais acumulados por usuário na coleção balances (um documento por usuário).
+# Os saldos são derivados desses totais com _balance_from_totals.
+# Todo delta incrementa "seq"; o rebuild só grava o resultado da varredura se nenhum delta
+# chegou enquanto ela rodava (senão varre de novo), então nenhum delta se perde. Um documento
+# criado por um delta antes do primeiro rebuild fica com "incomplete" até ser reconstruído.
+LEDGER_REBUILD_ATTEMPTS = 5
+LEDGER_FIELDS = (
+    "total_recebido",
+    "total_sacado",
+    "total_enviado",
+    "total_recebido_transferencia",
+    "total_comissoes",
+    "total_auto_sacado"
+)
+
+def _valor_creditado(transaction: dict) -> float:
+    """Valor que uma transação paga credita no saldo (valor_liquido se positivo, senão valor bruto)"""
+    valor_liquido = transaction.get("valor_liquido")
+    if valor_liquido and valor_liquido > 0:
+        return valor_liquido
+    return transaction.get("valor", 0)
+
+def _balance_from_totals(totals: dict):
+    """Deriva os saldos a partir dos totais acumulados do ledger"""
+    total_recebido = totals.get("total_recebido", 0)
+    total_sacado = totals.get("total_sacado", 0)
+    total_enviado = totals.get("total_enviado", 0)
+    total_recebido_transferencia = totals.get("total_recebido_transferencia", 0)
+    total_comissoes = totals.get("total_comissoes", 0)
+    total_auto_sacado = totals.get("total_auto_sacado", 0)
     
     # Cálculo final
-    saldo_disponivel = total_recebido - total_sacado - total_pendente_saque - total_enviado + total_recebido_transferencia
+    saldo_disponivel = total_recebido - total_sacado - total_enviado + total_recebido_transferencia
     saldo_comissoes = total_comissoes - total_auto_sacado
     
     # Garantir que não seja negativo e arredondar para evitar erros de ponto flutuante
@@ -912,19 +2728,138 @@ async def recalculate_user_balance(user_id: str):
         "saldo_disponivel": saldo_disponivel,
         "saldo_comissoes": saldo_comissoes,
         "total_recebido": round(total_recebido, 2),
-        "total_sacado": round(total_sacado + total_pendente_saque, 2),
+        "total_sacado": round(total_sacado, 2),
         "total_enviado": round(total_enviado, 2),
         "total_recebido_transferencia": round(total_recebido_transferencia, 2),
-        "total_comissoes": round(total_comissoes, 2)
+        "total_comissoes": round(total_comissoes, 2),
+        "total_auto_sacado": round(total_auto_sacado, 2)
+    }
+
+async def recalculate_user_balance(user_id: str):
+    """Recalcula o saldo do usuário do zero, baseado apenas em transações PAGAS.
+    
+    Varre todo o histórico do usuário - use get_user_balance no caminho quente
+    e deixe esta função para rebuild/verificação do ledger.
+    """
+    # Transações pagas que creditam saldo (exclui transfer_out pois já é tratado em transferências)
+    transactions = await aggregate_totals(db.transactions, {
+        "parceiro_id": user_id,
+        "status": "paid",
+        "tipo": {"$nin": ["transfer_out", "transfer_in"]}  # Transferências são tratadas separadamente
+    }, total_recebido=VALOR_CREDITADO_EXPR)
+    
+    # Saques aprovados e pendentes debitam saldo (no pendente o saldo já foi retido)
+    # Saques automáticos de comissão são deduzidos do saldo de comissões
+    withdrawals = await aggregate_totals(
+        db.withdrawals,
+        {"parceiro_id": user_id},
+        total_sacado=when({"$in": ["$status", ["approved", "pending"]]}, VALOR_RETIDO_EXPR),
+        total_auto_sacado=when({"$eq": ["$auto_withdrawal", True]}, {"$ifNull": ["$valor_total_retido", 0]})
+    )
+    
+    # Transferências enviadas debitam e recebidas creditam saldo
+    transfers = await aggregate_totals(
+        db.transfers,
+        {"$or": [{"remetente_id": user_id}, {"destinatario_id": user_id}]},
+        total_enviado=when(
+            {"$eq": ["$remetente_id", user_id]},
+            {"$ifNull": ["$valor_enviado", VALOR_EXPR]}
+        ),
+        total_recebido_transferencia=when(
+            {"$eq": ["$destinatario_id", user_id]},
+            {"$ifNull": ["$valor_recebido", VALOR_EXPR]}
+        )
+    )
+    
+    # Comissões recebidas
+    commissions = await aggregate_totals(db.commissions, {
+        "indicador_id": user_id,
+        "status": "credited"
+    }, total_comissoes={"$ifNull": ["$valor_comissao", 0]})
+    
+    return _balance_from_totals({
+        "total_recebido": transactions["total_recebido"],
+        "total_sacado": withdrawals["total_sacado"],
+        "total_enviado": transfers["total_enviado"],
+        "total_recebido_transferencia": transfers["total_recebido_transferencia"],
+        "total_comissoes": commissions["total_comissoes"],
+        "total_auto_sacado": withdrawals["total_auto_sacado"]
+    })
+
+async def rebuild_user_balance(user_id: str):
+    """Reconstrói o documento de ledger do usuário a partir do histórico completo"""
+    try:
+        await db.balances.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"seq": 0, "incomplete": True}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # criado em paralelo por outro rebuild ou delta
+    
+    for _ in range(LEDGER_REBUILD_ATTEMPTS):
+        ledger = await db.balances.find_one({"user_id": user_id}, {"_id": 0, "seq": 1})
+        seq = ledger.get("seq") if ledger else None
+        balance = await recalculate_user_balance(user_id)
+        now = datetime.now(timezone.utc).isoformat()
+        # Grava só se nenhum delta chegou durante a varredura; ele poderia ou não estar nela
+        result = await db.balances.update_one(
+            {"user_id": user_id, "seq": seq if seq is not None else {"$exists": False}},
+            {
+                "$set": {
+                    **{field: balance[field] for field in LEDGER_FIELDS},
+                    "rebuilt_at": now,
+                    "updated_at": now
+                },
+                "$unset": {"incomplete": ""}
+            }
+        )
+        if result.matched_count:
+            return balance
+    
+    logger.warning(f"Ledger rebuild for {user_id} kept racing with new deltas; will retry on next read")
+    return balance
+
+async def get_user_balance(user_id: str):
+    """Lê o saldo do ledger (uma leitura indexada). Reconstrói se o ledger ainda não existir."""
+    ledger = await db.balances.find_one({"user_id": user_id}, {"_id": 0})
+    if not ledger or ledger.get("incomplete"):
+        return await rebuild_user_balance(user_id)
+    return _balance_from_totals(ledger)
+
+async def apply_balance_delta(user_id: str, **deltas):
+    """Aplica incrementos atômicos nos totais do ledger do usuário.
+    
+    Sempre grava (upsert): se o ledger ainda não existe, o documento nasce marcado como
+    incompleto e o próximo get_user_balance reconstrói a partir do histórico.
+    """
+    deltas = {k: v for k, v in deltas.items() if k in LEDGER_FIELDS and v}
+    if not deltas:
+        return
+    update = {
+        "$inc": {**deltas, "seq": 1},
+        "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+        "$setOnInsert": {"incomplete": True}
     }
+    try:
+        await db.balances.update_one({"user_id": user_id}, update, upsert=True)
+    except DuplicateKeyError:
+        # Upsert concorrente criou o documento: agora o update casa
+        await db.balances.update_one({"user_id": user_id}, update)
+
+async def invalidate_user_balance(*user_ids: str):
+    """Descarta o ledger dos usuários; será reconstruído na próxima leitura"""
+    await db.balances.delete_many({"user_id": {"$in": list(user_ids)}})
+
+# ===================== DASHBOARD ROUTES =====================
 
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(user: dict = Depends(get_current_user)):
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     config = await get_config()
     
-    # Recalcula saldo baseado em transações PAGAS
-    balance = await recalculate_user_balance(user["id"])
+    # Saldo real (ledger) baseado em transações PAGAS
+    balance = await get_user_balance(user["id"])
     
     # Atualiza o saldo no banco se estiver diferente
     if (user_data.get("saldo_disponivel", 0) != balance["saldo_disponivel"] or 
@@ -936,16 +2871,19 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
                 "saldo_comissoes": balance["saldo_comissoes"]
             }}
         )
+        invalidate_user_cache(user["id"])
     
-    transactions = await db.transactions.find({"parceiro_id": user["id"]}).to_list(1000)
-    today = datetime.now(timezone.utc).date()
+    # Contagens e somas calculadas no MongoDB (sem trazer o histórico para o Python)
+    paid_query = {"parceiro_id": user["id"], "status": "paid"}
+    paid_totals = await aggregate_totals(db.transactions, paid_query)
+    daily = await aggregate_daily_totals(db.transactions, paid_query, valor=VALOR_EXPR)
     
-    total_transacoes = len([t for t in transactions if t.get("status") == "paid"])
+    total_transacoes = paid_totals["count"]
     total_recebido = balance["total_recebido"]
-    transacoes_hoje = sum(1 for t in transactions if t.get("status") == "paid" and datetime.fromisoformat(t.get("created_at", "")).date() == today)
-    valor_hoje = sum(t.get("valor", 0) for t in transactions if t.get("status") == "paid" and datetime.fromisoformat(t.get("created_at", "")).date() == today)
+    transacoes_hoje = daily[-1]["count"]
+    valor_hoje = daily[-1]["valor"]
     
-    referrals = await db.referrals.find({"indicador_id": user["id"]}).to_list(1000)
+    total_indicados = await db.referrals.count_documents({"indicador_id": user["id"]})
     
     indicacoes_liberadas = user_data.get("indicacoes_liberadas", 0)
     indicacoes_usadas = user_data.get("indicacoes_usadas", 0)
@@ -977,14 +2915,14 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
     ).sort("created_at", -1).limit(5).to_list(5)
     
     # Total de comissões recebidas
-    all_commissions = await db.commissions.find({"indicador_id": user["id"]}).to_list(1000)
-    total_comissoes_recebidas = sum(c.get("valor_comissao", 0) for c in all_commissions)
+    commission_totals = await aggregate_totals(
+        db.commissions,
+        {"indicador_id": user["id"]},
+        valor={"$ifNull": ["$valor_comissao", 0]}
+    )
+    total_comissoes_recebidas = commission_totals["valor"]
     
-    chart_data = []
-    for i in range(7):
-        date = (datetime.now(timezone.utc) - timedelta(days=6-i)).date()
-        day_total = sum(t.get("valor", 0) for t in transactions if t.get("status") == "paid" and datetime.fromisoformat(t.get("created_at", "")).date() == date)
-        chart_data.append({"date": date.strftime("%d/%m"), "valor": day_total})
+    chart_data = [{"date": day["date"].strftime("%d/%m"), "valor": day["valor"]} for day in daily]
     
     return {
         "saldo_disponivel": balance["saldo_disponivel"],
@@ -994,7 +2932,7 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
         "total_recebido": total_recebido,
         "transacoes_hoje": transacoes_hoje,
         "valor_hoje": valor_hoje,
-        "total_indicados": len(referrals),
+        "total_indicados": total_indicados,
         "indicacoes_disponiveis": indicacoes_disponiveis,
         "can_refer": can_refer,
         "valor_minimo_indicacao": config.get("valor_minimo_indicacao", 1000),
@@ -1011,22 +2949,25 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
 # ===================== TRANSACTION ROUTES =====================
 
 @api_router.post("/transactions")
-async def create_transaction(data: TransactionCreate, user: dict = Depends(get_current_user)):
+async def create_transaction(
+    data: TransactionCreate,
+    user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    prefer: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        f"user:{user['id']}", idempotency_key, data,
+        lambda: _create_transaction(data, user, wants_async_qr(prefer))
+    )
+
+async def _create_transaction(data: TransactionCreate, user: dict, acquire_async: bool = False):
     config = await get_config()
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     
-    first_deposit = await db.transactions.find_one({"parceiro_id": user["id"], "status": "paid"})
-    first_deposit_time = datetime.fromisoformat(first_deposit["created_at"]) if first_deposit else None
+    first_deposit_time = _parse_created_at(user_data.get("first_deposit_at"))
     
     now = datetime.now(timezone.utc)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    today_transactions = await db.transactions.find({
-        "parceiro_id": user["id"],
-        "status": "paid",
-        "created_at": {"$gte": today_start.isoformat()}
-    }).to_list(1000)
-    today_total = sum(t.get("valor", 0) for t in today_transactions)
+    today_total = (await get_deposit_totals(user["id"], now.date().isoformat()))["valor"]
     
     if data.cpf_cnpj:
         if first_deposit_time and (now - first_deposit_time) < timedelta(hours=24):
@@ -1038,6 +2979,7 @@ async def create_transaction(data: TransactionCreate, user: dict = Depends(get_c
     else:
         if today_total + data.valor > 500:
             raise HTTPException(status_code=400, detail="Depósitos anônimos limitados a R$500,00/dia")
+    await check_payer_velocity(data.cpf_cnpj, data.valor, config)
     
     taxa_percentual = user_data.get("taxa_percentual", 2.0)
     taxa_fixa = user_data.get("taxa_fixa", 0.99)
@@ -1047,6 +2989,7 @@ async def create_transaction(data: TransactionCreate, user: dict = Depends(get_c
     transaction = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user["id"],
+        "network_admin_id": await network_admin_of(user_data),
         "valor": data.valor,
         "valor_liquido": valor_liquido,
         "taxa_percentual": taxa_percentual,
@@ -1062,45 +3005,8 @@ async def create_transaction(data: TransactionCreate, user: dict = Depends(get_c
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    api_key = config.get("fastdepix_api_key")
-    if api_key:
-        try:
-            # Determinar tipo de usuário baseado no CPF/CNPJ
-            cpf_cnpj_clean = (data.cpf_cnpj or "").replace(".", "").replace("-", "").replace("/", "")
-            user_type = "company" if len(cpf_cnpj_clean) == 14 else "individual"
-            
-            async with httpx.AsyncClient() as client_http:
-                response = await client_http.post(
-                    "https://fastdepix.space/api/v1/transactions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "amount": data.valor,
-                        "user": {
-                            "name": user_data.get("nome", "Cliente"),
-                            "cpf_cnpj": cpf_cnpj_clean,
-                            "user_type": user_type
-                        }
-                    },
-                    timeout=30.0
-                )
-                logger.info(f"FastDePix response: {response.status_code} - {response.text}")
-                if response.status_code in [200, 201]:
-                    result = response.json()
-                    if result.get("success"):
-                        tx_data = result.get("data", {})
-                        transaction["fastdepix_id"] = tx_data.get("id")
-                        transaction["qr_code"] = tx_data.get("qr_code")
-                        transaction["pix_copia_cola"] = tx_data.get("qr_code_text")
-        except Exception as e:
-            logger.error(f"FastDePix API error: {e}")
-    
-    await db.transactions.insert_one(transaction)
-    del transaction["_id"]
-    
-    return transaction
+    payload = pix_charge_payload(data.valor, user_data.get("nome", "Cliente"), data.cpf_cnpj)
+    return await create_pix_charge(transaction, payload, config.get("fastdepix_api_key"), acquire_async)
 
 @api_router.get("/transactions")
 async def list_transactions(
@@ -1150,28 +3056,29 @@ async def list_transactions(
     
     # Busca as transações
     transactions = await db.transactions.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    total = await db.transactions.count_documents(query)
-    
-    # Calcula estatísticas do filtro aplicado
-    all_filtered = await db.transactions.find(query, {"_id": 0}).to_list(10000)
     
-    total_transacoes = len(all_filtered)
-    transacoes_pagas = sum(1 for t in all_filtered if t.get("status") == "paid")
+    # Calcula estatísticas do filtro aplicado (no MongoDB, sem limite de documentos)
     # Volume total e líquido são apenas de transações PAGAS
-    volume_total = sum(t.get("valor", 0) for t in all_filtered if t.get("status") == "paid")
-    valor_liquido_total = sum(t.get("valor_liquido", 0) for t in all_filtered if t.get("status") == "paid")
+    stats = await aggregate_totals(
+        db.transactions,
+        query,
+        transacoes_pagas=when(STATUS_PAID),
+        volume_total=when(STATUS_PAID, VALOR_EXPR),
+        valor_liquido_total=when(STATUS_PAID, VALOR_LIQUIDO_EXPR)
+    )
+    total = stats["count"]
     
     # Enriquece com dados do usuário (para quando admin visualizar)
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0, "senha": 0})
+    user_data = user
     
     return {
         "transactions": transactions, 
         "total": total,
         "stats": {
-            "total_transacoes": total_transacoes,
-            "volume_total": volume_total,
-            "valor_liquido_total": valor_liquido_total,
-            "transacoes_pagas": transacoes_pagas
+            "total_transacoes": stats["count"],
+            "volume_total": stats["volume_total"],
+            "valor_liquido_total": stats["valor_liquido_total"],
+            "transacoes_pagas": stats["transacoes_pagas"]
         },
         "usuario": {
             "nome": user_data.get("nome"),
@@ -1196,98 +3103,271 @@ async def check_transaction_status(transaction_id: str):
     if not transaction:
         raise HTTPException(status_code=404, detail="Transação não encontrada")
     
+    return transaction_status_view(transaction)
+
+# Stream SSE do status: a conexão fica aberta até a transação sair de "pending".
+# Liquidações deste worker chegam na hora via publish_transaction_status; as de outros
+# workers (e expirações) são detectadas por uma única consulta periódica que cobre todos
+# os ids assistidos, então conexões ociosas não geram leituras individuais no banco.
+# O QR só é procurado para as transações em _qr_watched (stream aberto com qr_status
+# "pending"), que saem do conjunto assim que o QR é publicado.
+STATUS_STREAM_REFRESH_SECONDS = float(os.environ.get('STATUS_STREAM_REFRESH_SECONDS', '2'))
+STATUS_STREAM_KEEPALIVE_SECONDS = 15
+STATUS_STREAM_MAX_SECONDS = 30 * 60
+
+_status_subscribers = {}
+_qr_watched = set()
+_status_watcher_task = None
+
+def transaction_status_view(transaction: dict) -> dict:
+    """Campos enviados pelo stream/consulta de status (inclui o QR quando obtido em background)"""
     return {
         "status": transaction.get("status", "pending"),
-        "paid_at": transaction.get("paid_at")
+        "paid_at": transaction.get("paid_at"),
+        "qr_status": transaction.get("qr_status"),
+        "qr_code": transaction.get("qr_code"),
+        "pix_copia_cola": transaction.get("pix_copia_cola")
     }
 
+def publish_transaction_status(transaction_id: str, status: dict):
+    """Entrega o novo status aos streams abertos neste worker"""
+    if status.get("qr_status") in ("ready", "failed"):
+        _qr_watched.discard(transaction_id)
+    for queue in _status_subscribers.get(transaction_id, ()):
+        queue.put_nowait(status)
+
+async def _watch_streamed_transactions():
+    global _status_watcher_task
+    try:
+        while _status_subscribers:
+            await asyncio.sleep(STATUS_STREAM_REFRESH_SECONDS)
+            watched = list(_status_subscribers)
+            if not watched:
+                break
+            conditions = [{"id": {"$in": watched}, "status": {"$ne": "pending"}}]
+            if _qr_watched:
+                conditions.append({"id": {"$in": list(_qr_watched)}, "qr_status": {"$in": ["ready", "failed"]}})
+            try:
+                async for tx in db.transactions.find(
+                    {"$or": conditions},
+                    {"_id": 0, "id": 1, "status": 1, "paid_at": 1, "qr_status": 1, "qr_code": 1, "pix_copia_cola": 1}
+                ):
+                    publish_transaction_status(tx["id"], transaction_status_view(tx))
+            except Exception as e:
+                logger.error(f"Error refreshing streamed transactions: {e}")
+    finally:
+        _status_watcher_task = None
+
+def _subscribe_transaction_status(transaction_id: str, watch_qr: bool = False) -> asyncio.Queue:
+    global _status_watcher_task
+    queue = asyncio.Queue()
+    _status_subscribers.setdefault(transaction_id, set()).add(queue)
+    if watch_qr:
+        _qr_watched.add(transaction_id)
+    if _status_watcher_task is None:
+        _status_watcher_task = asyncio.create_task(_watch_streamed_transactions())
+    return queue
+
+def _unsubscribe_transaction_status(transaction_id: str, queue: asyncio.Queue):
+    queues = _status_subscribers.get(transaction_id)
+    if queues is not None:
+        queues.discard(queue)
+        if not queues:
+            del _status_subscribers[transaction_id]
+            _qr_watched.discard(transaction_id)
+
+def _sse_event(status: dict) -> str:
+    return f"event: status\ndata: {json.dumps(status)}\n\n"
+
+@api_router.get("/transactions/{transaction_id}/events")
+async def stream_transaction_status(transaction_id: str):
+    """Stream SSE que envia o status da transação assim que ela é paga ou expira"""
+    transaction = await db.transactions.find_one(
+        {"id": transaction_id},
+        {"_id": 0, "status": 1, "paid_at": 1, "qr_status": 1, "qr_code": 1, "pix_copia_cola": 1}
+    )
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Transação não encontrada")
+    
+    initial = transaction_status_view(transaction)
+    
+    async def events():
+        yield _sse_event(initial)
+        if initial["status"] != "pending":
+            return
+        queue = _subscribe_transaction_status(transaction_id, watch_qr=initial["qr_status"] == "pending")
+        last_sent = initial
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=STATUS_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                # O mesmo status pode chegar pela publicação local e pelo watcher; só repassa o que mudou
+                if status == last_sent:
+                    continue
+                last_sent = status
+                yield _sse_event(status)
+                if status["status"] != "pending":
+                    return
+        finally:
+            _unsubscribe_transaction_status(transaction_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ===================== WEBHOOK ROUTE =====================
 
+# Eventos do provedor são gravados em db.webhook_inbox (chave = id do evento) e respondidos na hora;
+# o crédito é aplicado em lote pelo job WEBHOOK_INBOX_JOB, que roda no worker líder.
+# Falhas são repetidas com backoff exponencial; após WEBHOOK_MAX_ATTEMPTS o evento fica como
+# "failed" (sem processed_at, portanto fora do TTL) para análise.
+WEBHOOK_INBOX_JOB = "webhook_inbox_drain"
+WEBHOOK_DRAIN_BATCH = int(os.environ.get('WEBHOOK_DRAIN_BATCH', '100'))
+WEBHOOK_DRAIN_INTERVAL = float(os.environ.get('WEBHOOK_DRAIN_INTERVAL', '0.5'))
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BACKOFF_BASE = 5      # segundos: 5, 10, 20, 40
+WEBHOOK_RETRY_BACKOFF_MAX = 600
+WEBHOOK_INBOX_RETENTION_DAYS = 7
+
+webhook_stats = {"recebidos": 0, "duplicados": 0, "processados": 0, "falhas": 0}
+_webhook_inbox_wakeup = asyncio.Event()
+
+def webhook_event_id(event: dict, raw_body: bytes) -> str:
+    """Id do evento informado pelo provedor; sem ele, o hash do corpo deduplica reentregas idênticas"""
+    event_id = event.get("id") or event.get("event_id")
+    if event_id:
+        return str(event_id)
+    return "sha256:" + hashlib.sha256(raw_body).hexdigest()
+
 @api_router.post("/webhook/fastdepix")
 async def fastdepix_webhook(
-    event: dict,
+    request: Request,
     x_signature: Optional[str] = Header(None, alias="X-Signature")
 ):
+    raw_body = await request.body()
     config = await get_config()
     webhook_secret = config.get("fastdepix_webhook_secret")
     
-    if webhook_secret and x_signature:
-        import json
-        payload = json.dumps(event, separators=(',', ':'))
+    if webhook_secret:
+        if not x_signature:
+            raise HTTPException(status_code=401, detail="Assinatura ausente")
+        # Assinatura calculada sobre os bytes recebidos, não sobre o JSON re-serializado
         expected_signature = hmac.new(
             webhook_secret.encode(),
-            payload.encode(),
+            raw_body,
             hashlib.sha256
         ).hexdigest()
         
         if not hmac.compare_digest(x_signature, expected_signature):
             raise HTTPException(status_code=401, detail="Assinatura inválida")
     
+    try:
+        event = json.loads(raw_body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Payload inválido")
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Payload inválido")
+    
+    try:
+        received_at = datetime.now(timezone.utc)
+        await db.webhook_inbox.insert_one({
+            "_id": webhook_event_id(event, raw_body),
+            "provider": "fastdepix",
+            "event": event,
+            "status": "pending",
+            "attempts": 0,
+            "received_at": received_at,
+            "next_attempt_at": received_at
+        })
+        webhook_stats["recebidos"] += 1
+        _webhook_inbox_wakeup.set()
+    except DuplicateKeyError:
+        webhook_stats["duplicados"] += 1
+    
+    return {"status": "ok"}
+
+async def apply_webhook_event(event: dict, config: dict):
+    """Aplica um evento do FastDePix (idempotente: transações já liquidadas são ignoradas)"""
     event_type = event.get("event")
     transaction_data = event.get("data", {})
     custom_id = transaction_data.get("custom_id")
     
     if event_type == "transaction.paid" and custom_id:
-        transaction = await db.transactions.find_one({"id": custom_id})
-        if transaction and transaction.get("status") != "paid":
-            await db.transactions.update_one(
-                {"id": custom_id},
-                {"$set": {"status": "paid", "paid_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
-            user = await db.users.find_one({"id": transaction["parceiro_id"]})
-            if user:
-                valor_liquido = transaction.get("valor_liquido", transaction["valor"])
-                await db.users.update_one(
-                    {"id": user["id"]},
-                    {
-                        "$inc": {
-                            "saldo_disponivel": valor_liquido,
-                            "valor_movimentado": transaction["valor"]
-                        }
-                    }
-                )
-                
-                indicador_id = user.get("indicador_id")
-                if indicador_id:
-                    # Busca o indicador para verificar se tem comissão individual
-                    indicador = await db.users.find_one({"id": indicador_id})
-                    percentual_comissao = indicador.get("comissao_indicacao_individual") if indicador and indicador.get("comissao_indicacao_individual") is not None else config.get("comissao_indicacao", 1.0)
-                    comissao = transaction["valor"] * percentual_comissao / 100
-                    await db.users.update_one(
-                        {"id": indicador_id},
-                        {"$inc": {"saldo_comissoes": comissao}}
-                    )
-                    
-                    await db.commissions.insert_one({
-                        "id": str(uuid.uuid4()),
-                        "indicador_id": indicador_id,
-                        "indicado_id": user["id"],
-                        "transacao_id": custom_id,
-                        "valor_transacao": transaction["valor"],
-                        "percentual": percentual_comissao,
-                        "valor_comissao": comissao,
-                        "status": "credited",
-                        "created_at": datetime.now(timezone.utc).isoformat()
-                    })
-                
-                updated_user = await db.users.find_one({"id": user["id"]})
-                if updated_user.get("valor_movimentado", 0) >= config.get("valor_minimo_indicacao", 1000):
-                    current_liberadas = updated_user.get("indicacoes_liberadas", 0)
-                    if current_liberadas == 0:
-                        await db.users.update_one(
-                            {"id": user["id"]},
-                            {"$set": {"indicacoes_liberadas": 1}}
-                        )
+        # Pagamento confirmado pelo provedor é creditado mesmo se a cobrança já expirou aqui
+        await settle_transaction(custom_id, config, "webhook", claim_statuses=("pending", "expired"))
+
+async def drain_webhook_inbox() -> int:
+    """Processa um lote de eventos pendentes da inbox. Retorna quantos foram lidos"""
+    events = await db.webhook_inbox.find(
+        {"status": "pending", "next_attempt_at": {"$lte": datetime.now(timezone.utc)}}
+    ).sort("next_attempt_at", 1).to_list(WEBHOOK_DRAIN_BATCH)
+    if not events:
+        return 0
     
-    return {"status": "ok"}
+    config = await get_config()
+    updates = []
+    # Saúde dos webhooks por configuração de rede: uma leitura das transações citadas no lote
+    custom_ids = list({
+        item["event"].get("data", {}).get("custom_id") for item in events
+        if item["event"].get("data", {}).get("custom_id")
+    })
+    if custom_ids:
+        referenced = await db.transactions.find(
+            {"id": {"$in": custom_ids}}, {"_id": 0, "network_admin_id": 1}
+        ).to_list(None)
+        await record_webhook_events([tx.get("network_admin_id") for tx in referenced])
+    for item in events:
+        now = datetime.now(timezone.utc)
+        try:
+            await apply_webhook_event(item["event"], config)
+            updates.append(UpdateOne(
+                {"_id": item["_id"]},
+                {"$set": {"status": "processed", "processed_at": now}, "$inc": {"attempts": 1}}
+            ))
+            webhook_stats["processados"] += 1
+        except Exception as e:
+            logger.error(f"Error applying webhook event {item['_id']}: {e}")
+            webhook_stats["falhas"] += 1
+            attempts = item.get("attempts", 0) + 1
+            update = {"status": "pending", "last_error": str(e), "failed_at": now}
+            if attempts >= WEBHOOK_MAX_ATTEMPTS:
+                update["status"] = "failed"
+            else:
+                delay = min(WEBHOOK_RETRY_BACKOFF_BASE * 2 ** (attempts - 1), WEBHOOK_RETRY_BACKOFF_MAX)
+                update["next_attempt_at"] = now + timedelta(seconds=delay)
+            updates.append(UpdateOne({"_id": item["_id"]}, {"$set": update, "$inc": {"attempts": 1}}))
+    await db.webhook_inbox.bulk_write(updates, ordered=False)
+    return len(events)
+
+async def process_webhook_inbox():
+    """Job de background que drena a inbox de webhooks"""
+    while True:
+        try:
+            processed = await drain_webhook_inbox()
+        except Exception as e:
+            logger.error(f"Error draining webhook inbox: {e}")
+            processed = 0
+        
+        if processed < WEBHOOK_DRAIN_BATCH:
+            # Acorda na hora quando o evento chega neste worker; senão, no próximo intervalo
+            _webhook_inbox_wakeup.clear()
+            try:
+                await asyncio.wait_for(_webhook_inbox_wakeup.wait(), timeout=WEBHOOK_DRAIN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
 # ===================== REFERRAL ROUTES =====================
 
 @api_router.get("/referrals")
 async def list_referrals(user: dict = Depends(get_current_user)):
     config = await get_config()
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     
     referrals = await db.referrals.find({"indicador_id": user["id"]}, {"_id": 0}).to_list(1000)
     
@@ -1328,7 +3408,7 @@ async def list_commissions(user: dict = Depends(get_current_user)):
     commissions = await db.commissions.find({"indicador_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     total = sum(c.get("valor_comissao", 0) for c in commissions)
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     
     return {
         "commissions": commissions,
@@ -1341,11 +3421,11 @@ async def list_commissions(user: dict = Depends(get_current_user)):
 @api_router.get("/withdrawals/calculate")
 async def calculate_withdrawal(valor: float, metodo: str = "pix", user: dict = Depends(get_current_user)):
     """Calcula quanto o usuário precisa ter para sacar um valor específico"""
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     config = await get_config()
     
-    # Recalcula saldo real
-    balance = await recalculate_user_balance(user["id"])
+    # Saldo real (ledger)
+    balance = await get_user_balance(user["id"])
     
     # Seleciona taxa baseado no método
     if metodo == "depix":
@@ -1375,8 +3455,8 @@ async def create_withdrawal(data: WithdrawalCreate, user: dict = Depends(get_cur
     user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
     config = await get_config()
     
-    # Recalcula saldo real
-    balance = await recalculate_user_balance(user["id"])
+    # Saldo real (ledger)
+    balance = await get_user_balance(user["id"])
     
     # Validar método de saque
     metodo = data.metodo or "pix"
@@ -1409,6 +3489,7 @@ async def create_withdrawal(data: WithdrawalCreate, user: dict = Depends(get_cur
     withdrawal = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user["id"],
+        "network_admin_id": await network_admin_of(user_data),
         "valor_solicitado": data.valor,
         "taxa_percentual": taxa_saque,
         "valor_taxa": round(valor_taxa, 2),
@@ -1425,6 +3506,7 @@ async def create_withdrawal(data: WithdrawalCreate, user: dict = Depends(get_cur
     }
     
     await db.withdrawals.insert_one(withdrawal)
+    await apply_balance_delta(user["id"], total_sacado=withdrawal["valor_total_retido"])
     
     # Deduz o valor total (valor + taxa) do saldo
     if valor_necessario <= user_data.get("saldo_disponivel", 0):
@@ -1438,6 +3520,7 @@ async def create_withdrawal(data: WithdrawalCreate, user: dict = Depends(get_cur
             {"id": user["id"]},
             {"$set": {"saldo_disponivel": 0}, "$inc": {"saldo_comissoes": -resto}}
         )
+    invalidate_user_cache(user["id"])
     
     # Notifica admins sobre novo saque
     metodo_texto = "PIX" if metodo == "pix" else "Depix"
@@ -1453,7 +3536,7 @@ async def create_withdrawal(data: WithdrawalCreate, user: dict = Depends(get_cur
 @api_router.get("/withdrawals")
 async def list_withdrawals(user: dict = Depends(get_current_user)):
     withdrawals = await db.withdrawals.find({"parceiro_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     config = await get_config()
     taxa_saque = user_data.get("taxa_saque") if user_data.get("taxa_saque") is not None else config.get("taxa_saque_padrao", 1.5)
     taxa_saque_depix = user_data.get("taxa_saque_depix") if user_data.get("taxa_saque_depix") is not None else config.get("taxa_saque_depix_padrao", 2.0)
@@ -1476,13 +3559,14 @@ async def link_sideswap_wallet(data: SideSwapWallet, user: dict = Depends(get_cu
         {"id": user["id"]},
         {"$set": {"sideswap_wallet": data.wallet_address, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    invalidate_user_cache(user["id"])
     
     return {"success": True, "wallet_address": data.wallet_address}
 
 @api_router.get("/sideswap/wallet")
 async def get_sideswap_wallet(user: dict = Depends(get_current_user)):
     """Retorna carteira SideSwap do usuário"""
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     return {"wallet_address": user_data.get("sideswap_wallet")}
 
 @api_router.delete("/sideswap/wallet")
@@ -1492,6 +3576,7 @@ async def unlink_sideswap_wallet(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$unset": {"sideswap_wallet": ""}}
     )
+    invalidate_user_cache(user["id"])
     return {"success": True}
 
 @api_router.get("/withdrawals/{withdrawal_id}")
@@ -1516,6 +3601,7 @@ async def generate_user_wallet(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"carteira_id": new_wallet_id}}
     )
+    invalidate_user_cache(user["id"])
     
     return {"carteira_id": new_wallet_id}
 
@@ -1564,7 +3650,7 @@ async def validate_transfer_wallet(carteira_id: str, user: dict = Depends(get_cu
 @api_router.get("/transfers/calculate")
 async def calculate_transfer(valor: float, user: dict = Depends(get_current_user)):
     """Calcula os valores da transferência"""
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     config = await get_config()
     taxa_transferencia = user_data.get("taxa_transferencia") if user_data.get("taxa_transferencia") is not None else config.get("taxa_transferencia_padrao", 0.5)
     valor_minimo = user_data.get("valor_minimo_transferencia") if user_data.get("valor_minimo_transferencia") is not None else config.get("valor_minimo_transferencia", 1.0)
@@ -1610,12 +3696,15 @@ async def create_transfer(data: TransferCreate, user: dict = Depends(get_current
     
     transfer_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
+    remetente_network_admin_id = await network_admin_of(user_data)
+    destinatario_network_admin_id = await network_admin_of(destinatario)
     
     # Transação de saída (remetente)
     tx_saida = {
         "id": str(uuid.uuid4()),
         "transfer_id": transfer_id,
         "parceiro_id": user["id"],
+        "network_admin_id": remetente_network_admin_id,
         "tipo": "transfer_out",
         "valor": data.valor,
         "valor_liquido": -data.valor,
@@ -1634,6 +3723,7 @@ async def create_transfer(data: TransferCreate, user: dict = Depends(get_current
         "id": str(uuid.uuid4()),
         "transfer_id": transfer_id,
         "parceiro_id": destinatario["id"],
+        "network_admin_id": destinatario_network_admin_id,
         "tipo": "transfer_in",
         "valor": round(valor_recebido, 2),
         "valor_liquido": round(valor_recebido, 2),
@@ -1661,16 +3751,20 @@ async def create_transfer(data: TransferCreate, user: dict = Depends(get_current
             {"id": user["id"]},
             {"$set": {"saldo_disponivel": 0}, "$inc": {"saldo_comissoes": -resto}}
         )
+    invalidate_user_cache(user["id"])
     
     # Atualiza saldo do destinatário
     await db.users.update_one(
         {"id": destinatario["id"]},
         {"$inc": {"saldo_disponivel": valor_recebido}}
     )
+    invalidate_user_cache(destinatario["id"])
     
     # Registro da transferência
     transfer = {
         "id": transfer_id,
+        "network_admin_id": remetente_network_admin_id,
+        "destinatario_network_admin_id": destinatario_network_admin_id,
         "remetente_id": user["id"],
         "remetente_nome": user_data.get("nome"),
         "remetente_carteira": user_data.get("carteira_id"),
@@ -1686,6 +3780,8 @@ async def create_transfer(data: TransferCreate, user: dict = Depends(get_current
     }
     
     await db.transfers.insert_one(transfer)
+    await apply_balance_delta(user["id"], total_enviado=data.valor)
+    await apply_balance_delta(destinatario["id"], total_recebido_transferencia=transfer["valor_recebido"])
     
     # Envia push notification para o destinatário
     config = await get_config()
@@ -1715,7 +3811,7 @@ async def list_transfers(user: dict = Depends(get_current_user)):
         ]
     }, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
-    user_data = await db.users.find_one({"id": user["id"]}, {"_id": 0})
+    user_data = user
     config = await get_config()
     
     taxa_transferencia = user_data.get("taxa_transferencia") if user_data.get("taxa_transferencia") is not None else config.get("taxa_transferencia_padrao", 0.5)
@@ -1778,6 +3874,7 @@ async def create_ticket(data: TicketCreate, user: dict = Depends(get_current_use
     ticket = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user["id"],
+        "network_admin_id": await network_admin_of(user),
         "parceiro_nome": user.get("nome"),
         "assunto": data.assunto,
         "prioridade": data.prioridade,
@@ -1820,9 +3917,8 @@ async def get_unread_tickets_count(user: dict = Depends(get_current_user)):
 async def get_admin_unread_tickets_count(admin: dict = Depends(get_admin_user)):
     """Conta tickets com respostas não lidas pelo admin"""
     # Para admin: tickets onde a última resposta foi do usuário ou tickets novos
-    network_ids = await get_network_user_ids(admin["id"])
     query = {
-        "parceiro_id": {"$in": network_ids},
+        **await network_filter(admin["id"]),
         "status": {"$in": ["open", "in_progress"]},
         "$or": [
             {"last_responder_role": "user"},
@@ -1895,7 +3991,7 @@ async def update_ticket_status(ticket_id: str, status: str, user: dict = Depends
 
 @api_router.get("/api-keys")
 async def get_api_keys(user: dict = Depends(get_current_user)):
-    keys = await db.api_keys.find({"parceiro_id": user["id"]}, {"_id": 0}).to_list(100)
+    keys = await db.api_keys.find({"parceiro_id": user["id"]}, {"_id": 0, "webhook_secret": 0}).to_list(100)
     return {"keys": keys}
 
 @api_router.post("/api-keys")
@@ -1913,6 +4009,35 @@ async def create_api_key(name: str, user: dict = Depends(get_current_user)):
     del key["_id"]
     return key
 
+@api_router.put("/api-keys/{key_id}/webhook")
+async def set_api_key_webhook(key_id: str, data: ApiKeyWebhookConfig, user: dict = Depends(get_current_user)):
+    """Cadastra a URL que recebe transaction.paid / transaction.expired desta API key"""
+    url = data.url.strip()
+    url_error = await merchant_webhook_url_error(url)
+    if url_error:
+        raise HTTPException(status_code=400, detail=url_error)
+    
+    key = await db.api_keys.find_one({"id": key_id, "parceiro_id": user["id"]}, {"_id": 0, "id": 1, "webhook_secret": 1})
+    if not key:
+        raise HTTPException(status_code=404, detail="Chave não encontrada")
+    
+    webhook_secret = key.get("webhook_secret") or f"whsec_{secrets.token_hex(24)}"
+    await db.api_keys.update_one(
+        {"id": key_id},
+        {"$set": {"webhook_url": url, "webhook_secret": webhook_secret}}
+    )
+    return {"webhook_url": url, "webhook_secret": webhook_secret}
+
+@api_router.delete("/api-keys/{key_id}/webhook")
+async def delete_api_key_webhook(key_id: str, user: dict = Depends(get_current_user)):
+    result = await db.api_keys.update_one(
+        {"id": key_id, "parceiro_id": user["id"]},
+        {"$set": {"webhook_url": None}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Chave não encontrada")
+    return {"message": "Webhook removido"}
+
 @api_router.delete("/api-keys/{key_id}")
 async def delete_api_key(key_id: str, user: dict = Depends(get_current_user)):
     result = await db.api_keys.delete_one({"id": key_id, "parceiro_id": user["id"]})
@@ -1931,9 +4056,7 @@ async def admin_list_users(
     admin: dict = Depends(get_admin_user)
 ):
     # Filtra apenas usuários da rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    
-    query = {"id": {"$in": network_ids}, "role": {"$ne": "admin"}}
+    query = {**await network_filter(admin["id"]), "role": {"$ne": "admin"}}
     if search:
         query["$or"] = [
             {"nome": {"$regex": search, "$options": "i"}},
@@ -1958,14 +4081,14 @@ async def admin_get_user(user_id: str, admin: dict = Depends(get_admin_user)):
 @api_router.put("/admin/users/{user_id}")
 async def admin_update_user(user_id: str, data: AdminUserUpdate, admin: dict = Depends(get_admin_user)):
     # Verifica se usuário está na rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    if user_id not in network_ids:
+    if not await is_in_admin_network(admin["id"], user_id):
         raise HTTPException(status_code=403, detail="Usuário não pertence à sua rede")
     
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        invalidate_user_cache(user_id)
     
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "senha": 0})
     return updated
@@ -1977,8 +4100,7 @@ class UserBlock(BaseModel):
 async def admin_block_user(user_id: str, data: UserBlock, admin: dict = Depends(get_admin_user)):
     """Bloqueia um usuário com motivo"""
     # Verifica se usuário está na rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    if user_id not in network_ids:
+    if not await is_in_admin_network(admin["id"], user_id):
         raise HTTPException(status_code=403, detail="Usuário não pertence à sua rede")
     
     user = await db.users.find_one({"id": user_id})
@@ -1997,6 +4119,7 @@ async def admin_block_user(user_id: str, data: UserBlock, admin: dict = Depends(
             "block_reason": data.motivo
         }}
     )
+    invalidate_user_cache(user_id)
     
     return {"message": "Usuário bloqueado com sucesso"}
 
@@ -2004,8 +4127,7 @@ async def admin_block_user(user_id: str, data: UserBlock, admin: dict = Depends(
 async def admin_unblock_user(user_id: str, admin: dict = Depends(get_admin_user)):
     """Desbloqueia um usuário"""
     # Verifica se usuário está na rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    if user_id not in network_ids:
+    if not await is_in_admin_network(admin["id"], user_id):
         raise HTTPException(status_code=403, detail="Usuário não pertence à sua rede")
     
     user = await db.users.find_one({"id": user_id})
@@ -2024,6 +4146,7 @@ async def admin_unblock_user(user_id: str, admin: dict = Depends(get_admin_user)
             "block_reason": ""
         }}
     )
+    invalidate_user_cache(user_id)
     
     return {"message": "Usuário desbloqueado com sucesso"}
 
@@ -2031,8 +4154,7 @@ async def admin_unblock_user(user_id: str, admin: dict = Depends(get_admin_user)
 async def admin_delete_user(user_id: str, admin: dict = Depends(get_admin_user)):
     """Exclui um usuário e todos os seus dados"""
     # Verifica se usuário está na rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    if user_id not in network_ids:
+    if not await is_in_admin_network(admin["id"], user_id):
         raise HTTPException(status_code=403, detail="Usuário não pertence à sua rede")
     
     user = await db.users.find_one({"id": user_id})
@@ -2042,6 +4164,15 @@ async def admin_delete_user(user_id: str, admin: dict = Depends(get_admin_user))
     if user.get("role") == "admin":
         raise HTTPException(status_code=400, detail="Não é possível excluir um administrador")
     
+    # Contrapartes de transferências e o indicador têm o ledger afetado pela exclusão
+    counterparts = {user.get("indicador_id")} if user.get("indicador_id") else set()
+    async for t in db.transfers.find(
+        {"$or": [{"remetente_id": user_id}, {"destinatario_id": user_id}]},
+        {"_id": 0, "remetente_id": 1, "destinatario_id": 1}
+    ):
+        counterparts.update([t.get("remetente_id"), t.get("destinatario_id")])
+    counterparts.discard(None)
+    
     # Exclui todas as transações do usuário
     await db.transactions.delete_many({"parceiro_id": user_id})
     
@@ -2068,6 +4199,11 @@ async def admin_delete_user(user_id: str, admin: dict = Depends(get_admin_user))
     
     # Exclui o usuário
     await db.users.delete_one({"id": user_id})
+    invalidate_user_cache(user_id)
+    
+    # Descarta os ledgers afetados (reconstruídos na próxima leitura)
+    await invalidate_user_balance(user_id, *counterparts)
+    await invalidate_network_cache(*user.get("ancestor_ids", []))
     
     return {"message": "Usuário excluído com sucesso"}
 
@@ -2076,10 +4212,8 @@ async def admin_list_withdrawals(
     status: Optional[str] = None,
     admin: dict = Depends(get_admin_user)
 ):
-    # Obtém IDs dos usuários da rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
-    
-    query = {"parceiro_id": {"$in": network_ids}}
+    # Saques da rede do admin (chave de tenant)
+    query = await network_filter(admin["id"])
     if status:
         query["status"] = status
     
@@ -2115,10 +4249,17 @@ async def admin_approve_withdrawal(
         "processed_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.withdrawals.update_one({"id": withdrawal_id}, {"$set": update_data})
+    # Transição condicional: só um processamento vence se dois admins agirem ao mesmo tempo
+    result = await db.withdrawals.update_one({"id": withdrawal_id, "status": "pending"}, {"$set": update_data})
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Saque já processado")
     
-    # Quando rejeitado, o saldo será recalculado automaticamente na próxima consulta
-    # pois saques rejeitados não são contabilizados como dedução
+    # Saques rejeitados deixam de ser contabilizados como dedução: devolve o valor retido
+    if data.status == "rejected":
+        await apply_balance_delta(
+            withdrawal["parceiro_id"],
+            total_sacado=-withdrawal.get("valor_total_retido", withdrawal.get("valor_solicitado", 0))
+        )
     
     return {"message": f"Saque {data.status}"}
 
@@ -2181,9 +4322,9 @@ async def admin_update_config(data: AdminConfig, admin: dict = Depends(get_admin
             {"$set": update_data},
             upsert=True  # Cria se não existir
         )
+        await invalidate_config_cache()
         
         # Aplica as taxas a todos os usuários da rede do admin
-        network_ids = await get_network_user_ids(admin["id"])
         user_update = {}
         
         # Mapeia os campos de config para os campos do usuário
@@ -2203,11 +4344,12 @@ async def admin_update_config(data: AdminConfig, admin: dict = Depends(get_admin
         # Atualiza todos os usuários da rede (exceto admins)
         if user_update:
             user_update["updated_at"] = datetime.now(timezone.utc).isoformat()
-            await db.users.update_many(
-                {"id": {"$in": network_ids}, "role": {"$ne": "admin"}},
+            result = await db.users.update_many(
+                {**await network_filter(admin["id"]), "role": {"$ne": "admin"}},
                 {"$set": user_update}
             )
-            logger.info(f"Taxas atualizadas para {len(network_ids)} usuários da rede do admin {admin['id']}")
+            invalidate_user_cache()
+            logger.info(f"Taxas atualizadas para {result.matched_count} usuários da rede do admin {admin['id']}")
     
     config = await get_config()
     return config
@@ -2236,44 +4378,46 @@ async def admin_upload_logo(file: UploadFile = File(...), admin: dict = Depends(
 
 @api_router.get("/admin/stats")
 async def admin_get_stats(admin: dict = Depends(get_admin_user)):
-    # Obtém IDs dos usuários da rede do admin
-    network_ids = await get_network_user_ids(admin["id"])
+    # Filtro da rede do admin (chave de tenant)
+    network = await network_filter(admin["id"])
     
-    total_users = await db.users.count_documents({"id": {"$in": network_ids}, "role": "user"})
-    active_users = await db.users.count_documents({"id": {"$in": network_ids}, "role": "user", "status": "active"})
+    total_users = await db.users.count_documents({**network, "role": "user"})
+    active_users = await db.users.count_documents({**network, "role": "user", "status": "active"})
     
-    # Busca transações excluindo transferências (que são tratadas separadamente)
-    transactions = await db.transactions.find({
-        "parceiro_id": {"$in": network_ids},
+    # Transações pagas excluindo transferências (que são tratadas separadamente)
+    paid_query = {
+        **network,
+        "status": "paid",
         "tipo": {"$nin": ["transfer_out", "transfer_in"]}
-    }, {"_id": 0}).to_list(10000)
-    
-    paid_transactions = [t for t in transactions if t.get("status") == "paid"]
-    total_transactions = len(paid_transactions)
+    }
     # Volume total usa valor bruto (para mostrar quanto foi movimentado)
-    total_volume = round(sum(t.get("valor", 0) for t in paid_transactions), 2)
-    total_taxas = round(sum(t.get("taxa_total", 0) for t in paid_transactions), 2)
+    paid_totals = await aggregate_totals(
+        db.transactions,
+        paid_query,
+        volume=VALOR_EXPR,
+        taxas={"$ifNull": ["$taxa_total", 0]}
+    )
+    total_transactions = paid_totals["count"]
+    total_volume = round(paid_totals["volume"], 2)
+    total_taxas = round(paid_totals["taxas"], 2)
     
-    pending_withdrawals = await db.withdrawals.count_documents({"parceiro_id": {"$in": network_ids}, "status": "pending"})
-    open_tickets = await db.tickets.count_documents({"user_id": {"$in": network_ids}, "status": {"$in": ["open", "in_progress"]}})
+    pending_withdrawals = await db.withdrawals.count_documents({**network, "status": "pending"})
+    open_tickets = await db.tickets.count_documents({**network, "status": {"$in": ["open", "in_progress"]}})
     
     # Calcula total sacável da rede (soma de saldo_disponivel + saldo_comissoes de todos os usuários, excluindo admins)
-    network_users = await db.users.find(
-        {"id": {"$in": network_ids}, "role": {"$ne": "admin"}}, 
-        {"_id": 0, "saldo_disponivel": 1, "saldo_comissoes": 1}
-    ).to_list(10000)
-    total_sacavel = round(sum(u.get("saldo_disponivel", 0) + u.get("saldo_comissoes", 0) for u in network_users), 2)
+    network_balances = await aggregate_totals(
+        db.users,
+        {**network, "role": {"$ne": "admin"}},
+        sacavel={"$add": [{"$ifNull": ["$saldo_disponivel", 0]}, {"$ifNull": ["$saldo_comissoes", 0]}]}
+    )
+    total_sacavel = round(network_balances["sacavel"], 2)
     
-    today = datetime.now(timezone.utc).date()
-    chart_data = []
-    for i in range(7):
-        date = (datetime.now(timezone.utc) - timedelta(days=6-i)).date()
-        day_transactions = [t for t in paid_transactions if datetime.fromisoformat(t.get("created_at", "")).date() == date]
-        chart_data.append({
-            "date": date.strftime("%d/%m"),
-            "volume": round(sum(t.get("valor", 0) for t in day_transactions), 2),
-            "count": len(day_transactions)
-        })
+    daily = await aggregate_daily_totals(db.transactions, paid_query, volume=VALOR_EXPR)
+    chart_data = [{
+        "date": day["date"].strftime("%d/%m"),
+        "volume": round(day["volume"], 2),
+        "count": day["count"]
+    } for day in daily]
     
     return {
         "total_users": total_users,
@@ -2287,6 +4431,94 @@ async def admin_get_stats(admin: dict = Depends(get_admin_user)):
         "chart_data": chart_data
     }
 
+def scope_reconciliation_report(report: dict, admin_ids: list) -> dict:
+    """Visão do relatório restrita às redes do admin: totais e itens só dessas redes"""
+    networks = [n for admin_id, n in report.pop("redes", {}).items() if admin_id in admin_ids]
+    for counter in RECONCILE_COUNTERS:
+        report[counter] = sum(n[counter] for n in networks)
+    provider_statuses = {}
+    for n in networks:
+        for status, total in n["status_provedor"].items():
+            provider_statuses[status] = provider_statuses.get(status, 0) + total
+    report["status_provedor"] = provider_statuses
+    for kind in ("correcoes", "divergencias"):
+        if kind in report:
+            report[kind] = [item for item in report[kind] if item.get("network_admin_id") in admin_ids]
+    report.pop("escopo", None)
+    return report
+
+def reconciliation_reports_filter(admin_ids: list) -> dict:
+    """Relatórios do job (todas as redes) e os disparados dentro da rede do admin"""
+    return {"$or": [{"escopo": None}, {"escopo": {"$in": admin_ids}}]}
+
+@api_router.post("/admin/reconciliation/run")
+async def admin_run_reconciliation(
+    lookback_hours: Optional[float] = Query(None, gt=0, le=24 * 30),
+    admin: dict = Depends(get_admin_user)
+):
+    """Dispara a reconciliação da rede do admin e retorna o id do relatório.
+    
+    Roda em background (sem o prazo da requisição nem cancelamento se o cliente desconectar);
+    acompanhe por GET /admin/reconciliation/reports/{id} até sair de "running".
+    """
+    config = await get_config()
+    api_key = config.get("fastdepix_api_key")
+    if not api_key:
+        raise HTTPException(status_code=400, detail="API key do FastDePix não configurada")
+    report_id = str(uuid.uuid4())
+    admin_ids = await get_network_admin_ids(admin["id"])
+    spawn_background(reconcile_with_provider(
+        api_key, config, lookback_hours,
+        trigger=f"admin:{admin['id']}", report_id=report_id, scope_admin_ids=admin_ids
+    ))
+    return {"id": report_id, "status": "running"}
+
+@api_router.get("/admin/reconciliation/reports")
+async def admin_list_reconciliation_reports(limit: int = Query(20, le=100), admin: dict = Depends(get_admin_user)):
+    admin_ids = await get_network_admin_ids(admin["id"])
+    reports = await db.reconciliation_reports.find(
+        reconciliation_reports_filter(admin_ids), {"_id": 0, "correcoes": 0, "divergencias": 0}
+    ).sort("started_at", -1).to_list(limit)
+    return {"reports": [scope_reconciliation_report(report, admin_ids) for report in reports]}
+
+@api_router.get("/admin/reconciliation/reports/{report_id}")
+async def admin_get_reconciliation_report(report_id: str, admin: dict = Depends(get_admin_user)):
+    admin_ids = await get_network_admin_ids(admin["id"])
+    report = await db.reconciliation_reports.find_one(
+        {"id": report_id, **reconciliation_reports_filter(admin_ids)}, {"_id": 0}
+    )
+    if not report:
+        raise HTTPException(status_code=404, detail="Relatório não encontrado")
+    return scope_reconciliation_report(report, admin_ids)
+
+@api_router.get("/admin/metrics")
+async def admin_get_metrics(admin: dict = Depends(get_admin_user)):
+    """Métricas internas deste worker"""
+    return {
+        "password_pool": {**password_pool_stats, "workers": PASSWORD_HASH_WORKERS},
+        "poller": {**poller_stats, "na_fila": len(_poll_heap), "concorrencia": POLL_CONCURRENCY},
+        "webhook_first": {
+            "ativo": WEBHOOK_FIRST_MODE,
+            "configuracoes": {
+                key: {
+                    "saudavel": webhook_healthy(key),
+                    "ultimo_evento": health["last_event_at"].isoformat() if health.get("last_event_at") else None,
+                    "ultima_perda": health["last_missed_at"].isoformat() if health.get("last_missed_at") else None
+                }
+                for key, health in _webhook_health.items()
+            }
+        },
+        "fastdepix": {
+            **fastdepix_stats,
+            "circuito": fastdepix_breaker_state(),
+            "falhas_seguidas": _fastdepix_breaker["failures"]
+        },
+        "webhooks": {**webhook_stats},
+        "merchant_webhooks": {**merchant_webhook_stats},
+        "status_streams": sum(len(queues) for queues in _status_subscribers.values()),
+        "leader": {"worker_id": WORKER_ID, "leases": sorted(_held_leases)}
+    }
+
 
 # ===================== BACKUP/RESTORE ENDPOINTS =====================
 
@@ -2354,6 +4586,18 @@ async def admin_restore_database(file: UploadFile = File(...), admin: dict = Dep
             "documents": len(docs)
         })
     
+    # Os ledgers de saldo e os contadores de depósito são derivados: refaz a partir dos dados restaurados
+    await db.balances.delete_many({})
+    await backfill_user_ancestry(force=True)
+    await backfill_network_admin_ids(force=True)
+    await db.deposit_counters.delete_many({})
+    await db.users.update_many({}, {"$unset": {"first_deposit_at": ""}})
+    await backfill_deposit_counters()
+    await db.config.update_one(DEPOSIT_BACKFILL_MARKER, {"$set": {"done_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+    await invalidate_config_cache()
+    await invalidate_network_cache()
+    invalidate_user_cache()
+    
     return {
         "success": True,
         "message": "Backup restaurado com sucesso",
@@ -2377,79 +4621,75 @@ async def admin_diagnostico_saldo(identificador: str, admin: dict = Depends(get_
     user_id = user_data["id"]  # Usa o ID real para as queries
     
     # Transações pagas (exclui transferências que são tratadas separadamente)
-    paid_transactions = await db.transactions.find({
+    paid_query = {
         "parceiro_id": user_id,
         "status": "paid",
         "tipo": {"$nin": ["transfer_out", "transfer_in"]}
-    }, {"_id": 0}).to_list(10000)
+    }
+    paid_totals = await aggregate_totals(
+        db.transactions,
+        paid_query,
+        valor_bruto=VALOR_EXPR,
+        valor_liquido_usado=VALOR_CREDITADO_EXPR
+    )
+    total_valor_bruto = paid_totals["valor_bruto"]
+    total_valor_liquido_usado = paid_totals["valor_liquido_usado"]
     
-    # Análise das transações
+    # Análise das transações (últimas 20 para não sobrecarregar)
     txs_analise = []
-    total_valor_bruto = 0
-    total_valor_liquido_usado = 0
-    txs_com_problema = []
-    
-    for t in paid_transactions:
-        valor = t.get("valor", 0)
+    recent_paid = await db.transactions.find(paid_query, {"_id": 0}).sort("created_at", -1).limit(20).to_list(20)
+    for t in recent_paid:
         valor_liquido = t.get("valor_liquido")
-        tipo = t.get("tipo", "pagamento")
-        
-        # Determina qual valor usar
-        if valor_liquido and valor_liquido > 0:
-            valor_usado = valor_liquido
-            fonte = "valor_liquido"
-        else:
-            valor_usado = valor
-            fonte = "valor (fallback)"
-            if valor_liquido is not None and valor_liquido <= 0:
-                txs_com_problema.append({
-                    "id": t.get("id"),
-                    "tipo": tipo,
-                    "valor": valor,
-                    "valor_liquido": valor_liquido,
-                    "problema": "valor_liquido negativo ou zero"
-                })
-        
-        total_valor_bruto += valor
-        total_valor_liquido_usado += valor_usado
-        
         txs_analise.append({
             "id": t.get("id"),
-            "tipo": tipo,
+            "tipo": t.get("tipo", "pagamento"),
             "usuario": t.get("nome_pagador", "N/A"),
-            "valor_bruto": valor,
+            "valor_bruto": t.get("valor", 0),
             "valor_liquido": valor_liquido,
-            "valor_usado_no_calculo": valor_usado,
-            "fonte": fonte,
+            "valor_usado_no_calculo": _valor_creditado(t),
+            "fonte": "valor_liquido" if valor_liquido and valor_liquido > 0 else "valor (fallback)",
             "data": t.get("created_at")
         })
     
-    # Saques
-    approved_withdrawals = await db.withdrawals.find({
-        "parceiro_id": user_id,
-        "status": "approved"
-    }, {"_id": 0}).to_list(10000)
-    total_sacado = sum(w.get("valor_total_retido", w.get("valor_solicitado", 0)) for w in approved_withdrawals)
+    # Transações cujo valor_liquido é negativo ou zero (caem no fallback para o valor bruto)
+    problem_txs = await db.transactions.find(
+        {**paid_query, "valor_liquido": {"$lte": 0}},
+        {"_id": 0, "id": 1, "tipo": 1, "valor": 1, "valor_liquido": 1}
+    ).to_list(1000)
+    txs_com_problema = [{
+        "id": t.get("id"),
+        "tipo": t.get("tipo", "pagamento"),
+        "valor": t.get("valor", 0),
+        "valor_liquido": t.get("valor_liquido"),
+        "problema": "valor_liquido negativo ou zero"
+    } for t in problem_txs]
     
-    pending_withdrawals = await db.withdrawals.find({
-        "parceiro_id": user_id,
-        "status": "pending"
-    }, {"_id": 0}).to_list(10000)
-    total_pendente_saque = sum(w.get("valor_total_retido", w.get("valor_solicitado", 0)) for w in pending_withdrawals)
+    # Saques
+    withdrawals = await aggregate_totals(
+        db.withdrawals,
+        {"parceiro_id": user_id},
+        aprovados=when({"$eq": ["$status", "approved"]}, VALOR_RETIDO_EXPR),
+        pendentes=when({"$eq": ["$status", "pending"]}, VALOR_RETIDO_EXPR)
+    )
+    total_sacado = withdrawals["aprovados"]
+    total_pendente_saque = withdrawals["pendentes"]
     
     # Transferências
-    sent_transfers = await db.transfers.find({"remetente_id": user_id}, {"_id": 0}).to_list(10000)
-    total_enviado = sum(t.get("valor", 0) for t in sent_transfers)
-    
-    received_transfers = await db.transfers.find({"destinatario_id": user_id}, {"_id": 0}).to_list(10000)
-    total_recebido_transferencia = sum(t.get("valor_recebido", t.get("valor", 0)) for t in received_transfers)
+    transfers = await aggregate_totals(
+        db.transfers,
+        {"$or": [{"remetente_id": user_id}, {"destinatario_id": user_id}]},
+        enviado=when({"$eq": ["$remetente_id", user_id]}, {"$ifNull": ["$valor_enviado", VALOR_EXPR]}),
+        recebido=when({"$eq": ["$destinatario_id", user_id]}, {"$ifNull": ["$valor_recebido", VALOR_EXPR]})
+    )
+    total_enviado = transfers["enviado"]
+    total_recebido_transferencia = transfers["recebido"]
     
     # Comissões
-    commissions = await db.commissions.find({
+    commissions = await aggregate_totals(db.commissions, {
         "indicador_id": user_id,
         "status": "credited"
-    }, {"_id": 0}).to_list(10000)
-    total_comissoes = sum(c.get("valor_comissao", 0) for c in commissions)
+    }, valor={"$ifNull": ["$valor_comissao", 0]})
+    total_comissoes = commissions["valor"]
     
     # Cálculo final
     saldo_calculado = total_valor_liquido_usado - total_sacado - total_pendente_saque - total_enviado + total_recebido_transferencia
@@ -2463,10 +4703,10 @@ async def admin_diagnostico_saldo(identificador: str, admin: dict = Depends(get_
             "saldo_comissoes_salvo": user_data.get("saldo_comissoes", 0)
         },
         "transacoes": {
-            "quantidade": len(paid_transactions),
+            "quantidade": paid_totals["count"],
             "total_valor_bruto": round(total_valor_bruto, 2),
             "total_valor_liquido_usado": round(total_valor_liquido_usado, 2),
-            "detalhes": txs_analise[:20],  # Últimas 20 para não sobrecarregar
+            "detalhes": txs_analise,
             "transacoes_com_problema": txs_com_problema
         },
         "deducoes": {
@@ -2487,6 +4727,35 @@ async def admin_diagnostico_saldo(identificador: str, admin: dict = Depends(get_
         "alertas": txs_com_problema if txs_com_problema else None
     }
 
+@api_router.post("/admin/balances/{user_id}/rebuild")
+async def admin_rebuild_balance(user_id: str, apenas_verificar: bool = False, admin: dict = Depends(get_admin_user)):
+    """Recalcula o saldo do zero e compara com o ledger. Com apenas_verificar=true não grava nada."""
+    user_data = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1})
+    if not user_data:
+        raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    
+    ledger = await db.balances.find_one({"user_id": user_id}, {"_id": 0})
+    ledger_balance = _balance_from_totals(ledger) if ledger else None
+    
+    if apenas_verificar:
+        recalculado = await recalculate_user_balance(user_id)
+    else:
+        recalculado = await rebuild_user_balance(user_id)
+    
+    divergencias = {}
+    if ledger_balance:
+        for campo, valor in recalculado.items():
+            if round(ledger_balance.get(campo, 0) - valor, 2) != 0:
+                divergencias[campo] = {"ledger": ledger_balance.get(campo, 0), "recalculado": valor}
+    
+    return {
+        "user_id": user_id,
+        "ledger": ledger_balance,
+        "recalculado": recalculado,
+        "divergencias": divergencias,
+        "reconstruido": not apenas_verificar
+    }
+
 
 # ===================== PUBLIC PAGE ROUTE =====================
 
@@ -2522,8 +4791,19 @@ async def get_public_page(codigo: str):
     }
 
 @api_router.post("/p/{codigo}/pay")
-async def create_public_payment(codigo: str, data: PublicPaymentCreate):
+async def create_public_payment(
+    codigo: str,
+    data: PublicPaymentCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    prefer: Optional[str] = Header(None)
+):
     """Criar pagamento público via link personalizado"""
+    return await run_idempotent(
+        f"public:{codigo}", idempotency_key, data,
+        lambda: _create_public_payment(codigo, data, wants_async_qr(prefer))
+    )
+
+async def _create_public_payment(codigo: str, data: PublicPaymentCreate, acquire_async: bool = False):
     user = await db.users.find_one({"codigo": codigo, "status": "active"}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="Página não encontrada")
@@ -2532,6 +4812,7 @@ async def create_public_payment(codigo: str, data: PublicPaymentCreate):
         raise HTTPException(status_code=400, detail="Valor mínimo é R$10,00")
     
     config = await get_config()
+    await check_payer_velocity(data.cpf_pagador, data.valor, config)
     
     taxa_percentual = user.get("taxa_percentual", 2.0)
     taxa_fixa = user.get("taxa_fixa", 0.99)
@@ -2541,6 +4822,7 @@ async def create_public_payment(codigo: str, data: PublicPaymentCreate):
     transaction = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user["id"],
+        "network_admin_id": await network_admin_of(user),
         "valor": data.valor,
         "valor_liquido": valor_liquido,
         "taxa_percentual": taxa_percentual,
@@ -2557,56 +4839,22 @@ async def create_public_payment(codigo: str, data: PublicPaymentCreate):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    api_key = config.get("fastdepix_api_key")
-    if api_key:
-        try:
-            cpf_cnpj_clean = (data.cpf_pagador or "").replace(".", "").replace("-", "").replace("/", "")
-            user_type = "company" if len(cpf_cnpj_clean) == 14 else "individual"
-            
-            async with httpx.AsyncClient() as client_http:
-                response = await client_http.post(
-                    "https://fastdepix.space/api/v1/transactions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "amount": data.valor,
-                        "user": {
-                            "name": data.nome_pagador,
-                            "cpf_cnpj": cpf_cnpj_clean,
-                            "user_type": user_type
-                        }
-                    },
-                    timeout=30.0
-                )
-                logger.info(f"FastDePix public payment response: {response.status_code} - {response.text}")
-                if response.status_code in [200, 201]:
-                    result = response.json()
-                    if result.get("success"):
-                        tx_data = result.get("data", {})
-                        transaction["fastdepix_id"] = tx_data.get("id")
-                        transaction["qr_code"] = tx_data.get("qr_code")
-                        transaction["pix_copia_cola"] = tx_data.get("qr_code_text")
-        except Exception as e:
-            logger.error(f"FastDePix API error: {e}")
-    
-    await db.transactions.insert_one(transaction)
-    del transaction["_id"]
-    
-    return transaction
+    payload = pix_charge_payload(data.valor, data.nome_pagador, data.cpf_pagador)
+    return await create_pix_charge(transaction, payload, config.get("fastdepix_api_key"), acquire_async)
 
 # ===================== EXTERNAL API (Para integrações de terceiros) =====================
 
-async def get_user_by_api_key(authorization: str = Header(None)):
+async def get_api_key(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="API Key inválida")
     
     api_key = authorization.replace("Bearer ", "")
-    key_doc = await db.api_keys.find_one({"key": api_key, "status": "active"})
+    key_doc = await db.api_keys.find_one({"key": api_key, "status": "active"}, {"_id": 0})
     if not key_doc:
         raise HTTPException(status_code=401, detail="API Key inválida ou inativa")
-    
+    return key_doc
+
+async def get_user_by_api_key(key_doc: dict = Depends(get_api_key)):
     user = await db.users.find_one({"id": key_doc["parceiro_id"]}, {"_id": 0})
     if not user or user.get("status") != "active":
         raise HTTPException(status_code=401, detail="Usuário inativo")
@@ -2614,13 +4862,21 @@ async def get_user_by_api_key(authorization: str = Header(None)):
     return user
 
 @api_router.post("/v1/transactions")
-async def external_create_transaction(data: ExternalTransactionCreate, user: dict = Depends(get_user_by_api_key)):
+async def external_create_transaction(
+    data: ExternalTransactionCreate,
+    user: dict = Depends(get_user_by_api_key),
+    key_doc: dict = Depends(get_api_key),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    prefer: Optional[str] = Header(None)
+):
     """API externa para criação de transações (compatível com FastDePix/CashMatrix)"""
-    if data.amount < 10:
-        raise HTTPException(status_code=400, detail="Valor mínimo é R$10,00")
-    
-    config = await get_config()
-    
+    return await run_idempotent(
+        f"api_key:{key_doc['id']}", idempotency_key, data,
+        lambda: _external_create_transaction(data, user, key_doc, wants_async_qr(prefer))
+    )
+
+def build_external_transaction(data: ExternalTransactionCreate, user: dict, key_doc: dict, network_admin_id: str):
+    """Monta o documento da transação e o payload do FastDePix para uma cobrança da API externa"""
     taxa_percentual = user.get("taxa_percentual", 2.0)
     taxa_fixa = user.get("taxa_fixa", 0.99)
     taxa_total = (data.amount * taxa_percentual / 100) + taxa_fixa
@@ -2632,6 +4888,7 @@ async def external_create_transaction(data: ExternalTransactionCreate, user: dic
     transaction = {
         "id": str(uuid.uuid4()),
         "parceiro_id": user["id"],
+        "network_admin_id": network_admin_id,
         "valor": data.amount,
         "valor_liquido": valor_liquido,
         "taxa_percentual": taxa_percentual,
@@ -2640,6 +4897,7 @@ async def external_create_transaction(data: ExternalTransactionCreate, user: dic
         "cpf_cnpj": cpf_cnpj_clean,
         "nome_pagador": data.user.name,
         "user_type": data.user.user_type,
+        "api_key_id": key_doc["id"],
         "status": "pending",
         "qr_code": None,
         "qr_code_base64": None,
@@ -2648,46 +4906,15 @@ async def external_create_transaction(data: ExternalTransactionCreate, user: dic
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    api_key = config.get("fastdepix_api_key")
-    if api_key:
-        try:
-            async with httpx.AsyncClient() as client_http:
-                # Payload para FastDePix/CashMatrix
-                payload = {
-                    "amount": data.amount,
-                    "user": {
-                        "name": data.user.name,
-                        "cpf_cnpj": cpf_cnpj_clean,
-                        "user_type": data.user.user_type
-                    }
-                }
-                # Adiciona custom_page_id apenas se informado
-                if data.custom_page_id:
-                    payload["custom_page_id"] = data.custom_page_id
-                
-                response = await client_http.post(
-                    "https://fastdepix.space/api/v1/transactions",
-                    headers={
-                        "Authorization": f"Bearer {api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=payload,
-                    timeout=30.0
-                )
-                logger.info(f"FastDePix external API response: {response.status_code} - {response.text}")
-                if response.status_code in [200, 201]:
-                    result = response.json()
-                    if result.get("success"):
-                        tx_data = result.get("data", {})
-                        transaction["fastdepix_id"] = tx_data.get("id")
-                        transaction["qr_code"] = tx_data.get("qr_code")
-                        transaction["pix_copia_cola"] = tx_data.get("qr_code_text")
-        except Exception as e:
-            logger.error(f"FastDePix API error: {e}")
-    
-    await db.transactions.insert_one(transaction)
-    del transaction["_id"]
+    # Payload para FastDePix/CashMatrix
+    payload = pix_charge_payload(data.amount, data.user.name, cpf_cnpj_clean, data.user.user_type)
+    # Adiciona custom_page_id apenas se informado
+    if data.custom_page_id:
+        payload["custom_page_id"] = data.custom_page_id
     
+    return transaction, payload
+
+def external_create_response(transaction: dict) -> dict:
     # Retorno compatível com FastDePix
     return {
         "id": transaction["id"],
@@ -2696,9 +4923,122 @@ async def external_create_transaction(data: ExternalTransactionCreate, user: dic
         "qr_code": transaction["qr_code"],
         "qr_code_base64": transaction["qr_code_base64"],
         "pix_copy_paste": transaction["pix_copia_cola"],
+        "qr_status": transaction.get("qr_status"),
         "created_at": transaction["created_at"]
     }
 
+async def _external_create_transaction(data: ExternalTransactionCreate, user: dict, key_doc: dict, acquire_async: bool = False):
+    if data.amount < 10:
+        raise HTTPException(status_code=400, detail="Valor mínimo é R$10,00")
+    
+    config = await get_config()
+    await check_payer_velocity(data.user.cpf_cnpj, data.amount, config)
+    transaction, payload = build_external_transaction(data, user, key_doc, await network_admin_of(user))
+    await create_pix_charge(transaction, payload, config.get("fastdepix_api_key"), acquire_async)
+    return external_create_response(transaction)
+
+EXTERNAL_BATCH_MAX_ITEMS = 500
+EXTERNAL_BATCH_CONCURRENCY = int(os.environ.get('EXTERNAL_BATCH_CONCURRENCY', '20'))
+
+@api_router.post("/v1/transactions/batch")
+async def external_create_transaction_batch(
+    data: ExternalTransactionBatch,
+    user: dict = Depends(get_user_by_api_key),
+    key_doc: dict = Depends(get_api_key),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    prefer: Optional[str] = Header(None)
+):
+    """API externa para criação de várias cobranças em uma requisição (resultado por item)"""
+    if not data.transactions:
+        raise HTTPException(status_code=400, detail="Informe ao menos uma transação")
+    if len(data.transactions) > EXTERNAL_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {EXTERNAL_BATCH_MAX_ITEMS} transações por lote")
+    
+    return await run_idempotent(
+        f"api_key_batch:{key_doc['id']}", idempotency_key, data,
+        lambda: _external_create_transaction_batch(data, user, key_doc, wants_async_qr(prefer))
+    )
+
+async def _external_create_transaction_batch(data: ExternalTransactionBatch, user: dict, key_doc: dict, acquire_async: bool = False):
+    config = await get_config()
+    api_key = config.get("fastdepix_api_key")
+    if api_key and not fastdepix_available():
+        raise provider_unavailable_http(ProviderUnavailable("Provedor de pagamento temporariamente indisponível"))
+    network_admin_id = await network_admin_of(user)
+    
+    results = [None] * len(data.transactions)
+    prepared = []
+    # Limites por pagador numa consulta só; itens aceitos do lote contam para os seguintes
+    payer_windows = await load_payer_windows(list({
+        documento for documento in (normalize_payer_document(item.user.cpf_cnpj) for item in data.transactions) if documento
+    })) if any(payer_limits(config)) else {}
+    for index, item in enumerate(data.transactions):
+        if item.amount < 10:
+            results[index] = {"index": index, "success": False, "error": "Valor mínimo é R$10,00"}
+            continue
+        window = payer_windows.get(normalize_payer_document(item.user.cpf_cnpj))
+        if window:
+            error = payer_limit_error(window, item.amount, config)
+            if error:
+                results[index] = {"index": index, "success": False, "error": error}
+                continue
+            window["hora"]["cobrancas"] += 1
+            window["dia"]["cobrancas"] += 1
+        transaction, payload = build_external_transaction(item, user, key_doc, network_admin_id)
+        prepared.append((index, transaction, payload))
+    
+    if api_key and acquire_async:
+        # Grava tudo como pending e obtém os QRs em background
+        for _, transaction, _ in prepared:
+            transaction["qr_status"] = "pending"
+        if prepared:
+            await db.transactions.insert_many([transaction for _, transaction, _ in prepared])
+            await record_payer_activity([transaction for _, transaction, _ in prepared])
+        semaphore = asyncio.Semaphore(EXTERNAL_BATCH_CONCURRENCY)
+        
+        async def complete(transaction: dict, payload: dict):
+            async with semaphore:
+                await complete_pix_charge(transaction, payload, api_key)
+        
+        for index, transaction, payload in prepared:
+            transaction.pop("_id", None)
+            spawn_background(complete(dict(transaction), payload))
+            results[index] = {"index": index, "success": True, "error": None, "transaction": external_create_response(transaction)}
+        return {"total": len(results), "created": len(prepared), "results": results}
+    
+    # Chamadas ao provedor em paralelo, limitadas pelo semáforo, sobre o cliente compartilhado
+    errors = [None] * len(prepared)
+    if api_key:
+        semaphore = asyncio.Semaphore(EXTERNAL_BATCH_CONCURRENCY)
+        
+        async def acquire(position: int, transaction: dict, payload: dict):
+            async with semaphore:
+                errors[position] = await request_pix_charge(transaction, payload, api_key)
+        
+        await asyncio.gather(*(
+            acquire(position, transaction, payload)
+            for position, (_, transaction, payload) in enumerate(prepared)
+        ))
+    
+    if prepared:
+        await db.transactions.insert_many([transaction for _, transaction, _ in prepared])
+        await record_payer_activity([transaction for _, transaction, _ in prepared])
+    for position, (index, transaction, _) in enumerate(prepared):
+        transaction.pop("_id", None)
+        schedule_transaction_poll(transaction)
+        results[index] = {
+            "index": index,
+            "success": errors[position] is None,
+            "error": errors[position],
+            "transaction": external_create_response(transaction)
+        }
+    
+    return {
+        "total": len(results),
+        "created": len(prepared),
+        "results": results
+    }
+
 @api_router.get("/v1/transactions/{transaction_id}")
 async def external_get_transaction(transaction_id: str, user: dict = Depends(get_user_by_api_key)):
     """API externa para consultar transação"""
@@ -2709,17 +5049,7 @@ async def external_get_transaction(transaction_id: str, user: dict = Depends(get
     if not transaction:
         raise HTTPException(status_code=404, detail="Transação não encontrada")
     
-    return {
-        "id": transaction["id"],
-        "amount": transaction["valor"],
-        "status": transaction["status"],
-        "qr_code": transaction.get("qr_code"),
-        "qr_code_base64": transaction.get("qr_code_base64"),
-        "pix_copy_paste": transaction.get("pix_copia_cola"),
-        "custom_id": transaction.get("custom_id"),
-        "paid_at": transaction.get("paid_at"),
-        "created_at": transaction["created_at"]
-    }
+    return external_transaction_view(transaction)
 
 @api_router.get("/v1/transactions")
 async def external_list_transactions(
@@ -2767,12 +5097,14 @@ async def external_list_transactions(
     
     transactions = await db.transactions.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
     
-    # Calcula estatísticas
-    all_filtered = await db.transactions.find(query, {"_id": 0}).to_list(10000)
-    total_transactions = len(all_filtered)
-    total_volume = sum(t.get("valor", 0) for t in all_filtered)
-    total_net_value = sum(t.get("valor_liquido", 0) for t in all_filtered)
-    paid_transactions = sum(1 for t in all_filtered if t.get("status") == "paid")
+    # Calcula estatísticas (no MongoDB, sem limite de documentos)
+    stats = await aggregate_totals(
+        db.transactions,
+        query,
+        total_volume=VALOR_EXPR,
+        total_net_value=VALOR_LIQUIDO_EXPR,
+        paid_transactions=when(STATUS_PAID)
+    )
     
     return {
         "data": [{
@@ -2787,10 +5119,10 @@ async def external_list_transactions(
             "paid_at": t.get("paid_at")
         } for t in transactions],
         "stats": {
-            "total_transactions": total_transactions,
-            "total_volume": total_volume,
-            "total_net_value": total_net_value,
-            "paid_transactions": paid_transactions
+            "total_transactions": stats["count"],
+            "total_volume": stats["total_volume"],
+            "total_net_value": stats["total_net_value"],
+            "paid_transactions": stats["paid_transactions"]
         }
     }
 
@@ -2817,8 +5149,8 @@ async def promote_to_admin(user_id: str, admin: dict = Depends(get_admin_user)):
         raise HTTPException(status_code=400, detail="Usuário já é admin")
     
     # Verifica se o usuário está na rede do admin
-    user_admin = await get_user_network_admin(user_id)
-    if not user_admin or user_admin["id"] != admin["id"]:
+    user_admin_id = await get_user_network_admin_id(user_id)
+    if user_admin_id != admin["id"]:
         raise HTTPException(status_code=403, detail="Usuário não pertence à sua rede")
     
     # Promove a admin
@@ -2828,10 +5160,25 @@ async def promote_to_admin(user_id: str, admin: dict = Depends(get_admin_user)):
             "role": "admin",
             "promoted_by": admin["id"],
             "is_root_admin": False,
-            "indicacoes_liberadas": 999
+            "indicacoes_liberadas": 999,
+            "network_admin_id": user_id
         }}
     )
     
+    # Indicados abaixo dele que respondiam ao admin promotor passam a responder ao novo admin
+    moved = await db.users.find(
+        {"ancestor_ids": user_id, "network_admin_id": admin["id"]},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    moved_ids = [user_id] + [m["id"] for m in moved]
+    await db.users.update_many(
+        {"id": {"$in": moved_ids[1:]}},
+        {"$set": {"network_admin_id": user_id}}
+    )
+    invalidate_user_cache(*moved_ids)
+    await restamp_network_admin(moved_ids, user_id)
+    await invalidate_network_cache()
+    
     # Cria configuração inicial para o novo admin (cópia da config do promotor)
     config = await get_config(admin["id"])
     if not config.get("admin_id"):
@@ -2852,6 +5199,7 @@ async def promote_to_admin(user_id: str, admin: dict = Depends(get_admin_user)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.admin_configs.insert_one(new_admin_config)
+    await invalidate_config_cache()
     
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "senha": 0})
     return updated
@@ -2869,18 +5217,43 @@ async def demote_from_admin(user_id: str, admin: dict = Depends(get_admin_user))
     if user.get("promoted_by") != admin["id"]:
         raise HTTPException(status_code=403, detail="Você só pode remover admins que você promoveu")
     
+    # Novo admin da rede: o admin mais próximo entre os ancestrais
+    ancestor_ids = user.get("ancestor_ids", [])
+    ancestor_admins = await db.users.find(
+        {"id": {"$in": ancestor_ids}, "role": "admin"},
+        {"_id": 0, "id": 1}
+    ).to_list(len(ancestor_ids) or 1)
+    ancestor_admin_ids = {a["id"] for a in ancestor_admins}
+    new_network_admin_id = next((a for a in ancestor_ids if a in ancestor_admin_ids), admin["id"])
+    
     # Remove de admin
     await db.users.update_one(
         {"id": user_id},
         {"$set": {
             "role": "user",
             "promoted_by": None,
-            "is_root_admin": False
+            "is_root_admin": False,
+            "network_admin_id": new_network_admin_id
         }}
     )
     
+    # Indicados que respondiam a ele voltam para o admin acima
+    moved = await db.users.find(
+        {"ancestor_ids": user_id, "network_admin_id": user_id},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    moved_ids = [user_id] + [m["id"] for m in moved]
+    await db.users.update_many(
+        {"id": {"$in": moved_ids[1:]}},
+        {"$set": {"network_admin_id": new_network_admin_id}}
+    )
+    invalidate_user_cache(*moved_ids)
+    await restamp_network_admin(moved_ids, new_network_admin_id)
+    await invalidate_network_cache()
+    
     # Remove a configuração do admin
     await db.admin_configs.delete_one({"admin_id": user_id})
+    await invalidate_config_cache()
     
     return {"message": "Admin removido com sucesso"}
 
@@ -2900,6 +5273,8 @@ async def get_public_config():
 # Include router
 app.include_router(api_router)
 
+app.add_middleware(RequestDeadlineMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -2910,4 +5285,8 @@ app.add_middleware(
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_leader_jobs()
     client.close()
+    _password_executor.shutdown(wait=False)
+    await close_fastdepix_client()
+    await close_merchant_webhook_client()
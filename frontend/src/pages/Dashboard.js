@@ -1,7 +1,7 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { Layout } from "../components/Layout";
 import { useAuth } from "../contexts/AuthContext";
-import api from "../utils/api";
+import api, { openEventStream } from "../utils/api";
 import { toast } from "sonner";
 import { Card, CardContent, CardHeader, CardTitle } from "../components/ui/card";
 import { Progress } from "../components/ui/progress";
@@ -90,6 +90,12 @@ export default function Dashboard() {
   const [depositLoading, setDepositLoading] = useState(false);
   const [depositTransaction, setDepositTransaction] = useState(null);
   const [depositTimeRemaining, setDepositTimeRemaining] = useState(null);
+  // Mesma Idempotency-Key (e mesmos dados gerados) em retentativas do mesmo depósito
+  const depositAttemptRef = useRef(null);
+
+  useEffect(() => {
+    depositAttemptRef.current = null;
+  }, [depositAmount]);
 
   useEffect(() => {
     fetchStats();
@@ -171,15 +177,22 @@ export default function Dashboard() {
 
     setDepositLoading(true);
     try {
-      const cpfValido = generateValidCPF();
-      const nomeValido = generateRandomName();
+      if (!depositAttemptRef.current) {
+        depositAttemptRef.current = {
+          key: crypto.randomUUID(),
+          cpf: generateValidCPF(),
+          nome: generateRandomName()
+        };
+      }
+      const attempt = depositAttemptRef.current;
       
       const response = await api.post('/transactions', {
         valor: valor,
-        cpf_cnpj: cpfValido,
-        nome_pagador: nomeValido,
+        cpf_cnpj: attempt.cpf,
+        nome_pagador: attempt.nome,
         descricao: "Depósito em carteira"
-      });
+      }, { headers: { "Idempotency-Key": attempt.key } });
+      depositAttemptRef.current = null;
       setDepositTransaction(response.data);
       setDepositTimeRemaining(PIX_EXPIRATION_MINUTES * 60); // Inicia timer
       toast.success("PIX gerado! Escaneie o QR Code");
@@ -207,28 +220,28 @@ export default function Dashboard() {
     }
   }, [depositTransaction, depositTimeRemaining]);
 
-  // Polling para verificar pagamento do depósito
+  // Stream SSE do status do depósito: o backend avisa assim que o pagamento é confirmado
   useEffect(() => {
     if (depositTransaction && depositTransaction.status === "pending") {
-      const interval = setInterval(async () => {
-        try {
-          const response = await api.get(`/transactions/${depositTransaction.id}/status`);
-          if (response.data.status === "paid") {
-            setDepositTransaction(prev => ({ ...prev, status: "paid" }));
-            toast.success("Depósito confirmado!");
-            fetchStats();
-            clearInterval(interval);
-          } else if (response.data.status === "expired") {
-            setDepositTransaction(prev => ({ ...prev, status: "expired" }));
-            clearInterval(interval);
-          }
-        } catch (error) {
-          console.error("Erro ao verificar status:", error);
+      const stream = openEventStream(`/transactions/${depositTransaction.id}/events`);
+      stream.addEventListener("status", (event) => {
+        const data = JSON.parse(event.data);
+        if (data.status === "pending" && data.qr_status) {
+          // QR obtido em background após a criação
+          setDepositTransaction(prev => ({ ...prev, qr_status: data.qr_status, qr_code: data.qr_code, pix_copia_cola: data.pix_copia_cola }));
+        } else if (data.status === "paid") {
+          setDepositTransaction(prev => ({ ...prev, status: "paid" }));
+          toast.success("Depósito confirmado!");
+          fetchStats();
+          stream.close();
+        } else if (data.status === "expired") {
+          setDepositTransaction(prev => ({ ...prev, status: "expired" }));
+          stream.close();
         }
-      }, 3000);
-      return () => clearInterval(interval);
+      });
+      return () => stream.close();
     }
-  }, [depositTransaction]);
+  }, [depositTransaction?.id, depositTransaction?.status]);
 
   const closeDepositModal = () => {
     setShowDepositModal(false);
@@ -1,6 +1,6 @@
 import { useState, useEffect, useRef, useCallback } from "react";
 import { useParams, Link } from "react-router-dom";
-import api from "../utils/api";
+import api, { openEventStream } from "../utils/api";
 import { Button } from "../components/ui/button";
 import { Input } from "../components/ui/input";
 import { Label } from "../components/ui/label";
@@ -84,6 +84,13 @@ export default function PublicPage() {
   const isAnonymousOverLimit = isAnonymous && valorAtual > ANONYMOUS_LIMIT;
   const pollingRef = useRef(null);
   const timerRef = useRef(null);
+  // Uma tentativa de pagamento = uma Idempotency-Key (e os mesmos dados gerados no modo anônimo).
+  // Só muda quando o formulário muda ou depois que o PIX é gerado
+  const paymentAttemptRef = useRef(null);
+
+  useEffect(() => {
+    paymentAttemptRef.current = null;
+  }, [formData, isAnonymous]);
 
   // Calcula tempo restante baseado no created_at
   const calculateTimeRemaining = useCallback(() => {
@@ -99,7 +106,7 @@ export default function PublicPage() {
     fetchPageData();
     
     return () => {
-      if (pollingRef.current) clearInterval(pollingRef.current);
+      if (pollingRef.current) pollingRef.current.close();
       if (timerRef.current) clearInterval(timerRef.current);
     };
   }, [codigo]);
@@ -119,7 +126,7 @@ export default function PublicPage() {
         if (remaining <= 0) {
           setTransaction(prev => ({ ...prev, status: "expired" }));
           clearInterval(timerRef.current);
-          clearInterval(pollingRef.current);
+          if (pollingRef.current) pollingRef.current.close();
           toast.error("Tempo esgotado! O PIX expirou.");
         }
       }, 1000);
@@ -130,34 +137,33 @@ export default function PublicPage() {
     }
   }, [transaction?.id, transaction?.status, calculateTimeRemaining]);
 
-  // Polling para verificar status (apenas consulta o backend que já faz o trabalho)
+  // Stream SSE do status: o backend avisa assim que o pagamento é confirmado
   useEffect(() => {
     if (transaction && transaction.status === "pending") {
-      pollingRef.current = setInterval(async () => {
-        try {
-          const response = await api.get(`/transactions/${transaction.id}/status`);
-          if (response.data.status === "paid") {
-            setTransaction(prev => ({ ...prev, status: "paid", paid_at: response.data.paid_at }));
-            clearInterval(pollingRef.current);
-            clearInterval(timerRef.current);
-            setShowSuccess(true);
-            toast.success("Pagamento confirmado!");
-          } else if (response.data.status === "expired") {
-            setTransaction(prev => ({ ...prev, status: "expired" }));
-            clearInterval(pollingRef.current);
-            clearInterval(timerRef.current);
-            toast.error("Tempo esgotado! O PIX expirou.");
-          }
-        } catch (error) {
-          console.error("Error checking payment status:", error);
+      const stream = openEventStream(`/transactions/${transaction.id}/events`);
+      pollingRef.current = stream;
+      stream.addEventListener("status", (event) => {
+        const data = JSON.parse(event.data);
+        if (data.status === "pending" && data.qr_status) {
+          // QR obtido em background após a criação
+          setTransaction(prev => ({ ...prev, qr_status: data.qr_status, qr_code: data.qr_code, pix_copia_cola: data.pix_copia_cola }));
+        } else if (data.status === "paid") {
+          setTransaction(prev => ({ ...prev, status: "paid", paid_at: data.paid_at }));
+          stream.close();
+          clearInterval(timerRef.current);
+          setShowSuccess(true);
+          toast.success("Pagamento confirmado!");
+        } else if (data.status === "expired") {
+          setTransaction(prev => ({ ...prev, status: "expired" }));
+          stream.close();
+          clearInterval(timerRef.current);
+          toast.error("Tempo esgotado! O PIX expirou.");
         }
-      }, 3000); // Consulta a cada 3 segundos
+      });
       
-      return () => {
-        if (pollingRef.current) clearInterval(pollingRef.current);
-      };
+      return () => stream.close();
     }
-  }, [transaction]);
+  }, [transaction?.id, transaction?.status]);
 
   const fetchPageData = async () => {
     try {
@@ -221,15 +227,23 @@ export default function PublicPage() {
 
     setCreating(true);
     try {
-      // Gera dados fictícios únicos para pagamento anônimo
-      const nomePagador = isAnonymous ? generateRandomName() : formData.nome_pagador;
-      const cpfPagador = isAnonymous ? generateValidCPF() : formData.cpf_pagador.replace(/\D/g, "");
+      // Gera dados fictícios únicos para pagamento anônimo (uma vez por tentativa)
+      if (!paymentAttemptRef.current) {
+        paymentAttemptRef.current = {
+          key: crypto.randomUUID(),
+          nome: isAnonymous ? generateRandomName() : formData.nome_pagador,
+          cpf: isAnonymous ? generateValidCPF() : formData.cpf_pagador.replace(/\D/g, "")
+        };
+      }
+      const attempt = paymentAttemptRef.current;
       
+      // Mesma chave em retentativas: o backend devolve o PIX já gerado em vez de criar outro
       const response = await api.post(`/p/${codigo}/pay`, {
         valor: valor,
-        nome_pagador: nomePagador,
-        cpf_pagador: cpfPagador
-      });
+        nome_pagador: attempt.nome,
+        cpf_pagador: attempt.cpf
+      }, { headers: { "Idempotency-Key": attempt.key } });
+      paymentAttemptRef.current = null;
       setTransaction(response.data);
       toast.success("PIX gerado com sucesso!");
     } catch (error) {
@@ -401,6 +401,36 @@ export default function AdminConfig() {
                 </div>
               </div>
 
+              <div className="grid grid-cols-2 gap-4">
+                <div className="space-y-2">
+                  <Label className="text-slate-300">Cobranças por CPF/CNPJ (por hora)</Label>
+                  <Input
+                    type="number"
+                    value={config?.limite_pagador_cobrancas_hora ?? ""}
+                    onChange={(e) => handleChange("limite_pagador_cobrancas_hora", parseInt(e.target.value, 10))}
+                    className="input-default"
+                    step="1"
+                    min="0"
+                    placeholder="0"
+                  />
+                </div>
+                <div className="space-y-2">
+                  <Label className="text-slate-300">Pago por CPF/CNPJ em 24h (R$)</Label>
+                  <Input
+                    type="number"
+                    value={config?.limite_pagador_diario ?? ""}
+                    onChange={(e) => handleChange("limite_pagador_diario", parseFloat(e.target.value))}
+                    className="input-default"
+                    step="1"
+                    min="0"
+                    placeholder="0"
+                  />
+                </div>
+              </div>
+              <p className="text-xs text-slate-500">
+                Limites por pagador somando todos os parceiros. 0 desativa
+              </p>
+
               <div className="p-4 rounded-lg bg-slate-800/50 space-y-1">
                 <p className="text-slate-300 text-sm">
                   Transação: <span className="text-green-400 font-semibold">
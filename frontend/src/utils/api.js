@@ -96,4 +96,7 @@ const api = {
   }
 };
 
+// Abre um stream SSE (EventSource) para um endpoint da API
+export const openEventStream = (url) => new EventSource(buildUrl(url));
+
 export default api;